@@ -0,0 +1,147 @@
+"""Content-addressed cache of completion responses, keyed on a canonical hash of the request body"""
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import sqlite3
+from collections import OrderedDict
+from typing import Any
+from typing import Iterable
+
+from constants import COMPLETION_CACHE_DB_TIMEOUT
+from constants import COMPLETION_CACHE_MAX_ENTRIES
+
+logger = logging.getLogger(__name__)
+
+_completion_cache: CompletionCache | None = None
+
+
+def get_request_key(url: str, data: dict[str, Any]) -> str:
+    """Return a canonical hash of a request, independent of the order of keys in the request body"""
+    request = json.dumps(
+        {"url": url, "body": data},
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+
+def is_sampled(data: dict[str, Any]) -> bool:
+    """Whether a request samples its completion, so that identical requests can return different completions. A
+    missing or null temperature means the API's default of 1."""
+    temperature = data.get("temperature")
+    return temperature is None or temperature > 0
+
+
+class CompletionCache:
+    """Two-tier cache of completion responses: an in-memory LRU tier, backed by an optional SQLite tier on disk that
+    persists across runs.
+
+    Sampled requests (temperature > 0) are not cached since they are expected to return a different completion
+    every time, unless the cache is in replay mode, in which case every request is served from the cache when
+    possible so that previous runs can be replayed at near-zero cost.
+
+    The SQLite tier may be shared by several processes, e.g. the workers of a sharded batch. A read or write that
+    can't get the database lock in time is treated as a miss or skipped, rather than failing the completion.
+    """
+
+    def __init__(
+        self,
+        path: str = None,
+        max_entries: int = COMPLETION_CACHE_MAX_ENTRIES,
+        call_types: Iterable[str] = None,
+        replay: bool = False,
+    ):
+        """
+        Parameters
+        ----------
+        path : str
+            SQLite database file for the on-disk tier; only the in-memory tier is used if not provided
+        max_entries : int
+            maximum number of entries held in the in-memory tier
+        call_types : Iterable[str]
+            call types whose completions are cached; all call types are cached if not provided
+        replay : bool
+            whether to also cache sampled requests
+        """
+        self.max_entries = max_entries
+        self.call_types = set(call_types) if call_types is not None else None
+        self.replay = replay
+        self.num_hits = 0
+        self.num_misses = 0
+        self._memory: OrderedDict[str, dict[str, Any]] = OrderedDict()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, timeout=COMPLETION_CACHE_DB_TIMEOUT)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, response TEXT NOT NULL)"
+            )
+
+    def is_cacheable(self, data: dict[str, Any], call_type: str = None) -> bool:
+        if self.call_types is not None and call_type not in self.call_types:
+            return False
+        return self.replay or not is_sampled(data)
+
+    def get(self, key: str) -> dict[str, Any] | None:
+        response = self._memory.get(key)
+        if response is not None:
+            self._memory.move_to_end(key)
+        elif self._db is not None:
+            try:
+                row = self._db.execute(
+                    "SELECT response FROM completions WHERE key = ?", (key,)
+                ).fetchone()
+            except sqlite3.OperationalError as e:
+                logger.warning(f"Completion cache read failed with error: {e!r}")
+                row = None
+            if row is not None:
+                response = json.loads(row[0])
+                self._set_in_memory(key, response)
+
+        if response is None:
+            self.num_misses += 1
+        else:
+            self.num_hits += 1
+        return response
+
+    def set(self, key: str, response: dict[str, Any]) -> None:
+        self._set_in_memory(key, response)
+        if self._db is not None:
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO completions (key, response) VALUES (?, ?)",
+                    (key, json.dumps(response, ensure_ascii=False)),
+                )
+                self._db.commit()
+            except sqlite3.OperationalError as e:
+                # the response is still cached in memory; only persisting it is skipped
+                logger.warning(f"Completion cache write failed with error: {e!r}")
+                self._db.rollback()
+
+    def _set_in_memory(self, key: str, response: dict[str, Any]) -> None:
+        self._memory[key] = response
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def close(self) -> None:
+        logger.info(
+            f"Completion cache closed with {self.num_hits} hits and {self.num_misses} misses"
+        )
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+def get_completion_cache() -> CompletionCache | None:
+    return _completion_cache
+
+
+def set_completion_cache(cache: CompletionCache | None) -> None:
+    """Set the completion cache used by all completions, or disable caching with None"""
+    global _completion_cache
+    _completion_cache = cache
@@ -2,26 +2,46 @@
 from __future__ import annotations
 
 import asyncio
-import json
 import logging
 import os
-import random
 from abc import ABC
 from abc import abstractmethod
-from collections import OrderedDict
+from array import array
+from bisect import bisect_left
 from time import time
 from typing import Any
-
-import openai
-import tiktoken
-
+from typing import Iterable
+from typing import Mapping
+
+from api.cache import get_completion_cache
+from api.cache import get_request_key
+from api.completion_log import get_completion_log
+from api.metrics import get_metrics_registry
+from api.profiling import timed
+from api.rate_limit import get_rate_limiter
+from api.retry import CompletionError
+from api.retry import CONNECTION_ERROR_TYPES
+from api.retry import DEFAULT_RETRY_POLICY
+from api.retry import get_retry_budget
+from api.retry import RetryPolicy
+from api.tokens import count_prompt_tokens
+from api.tokens import num_tokens_from_messages
+from api.tracing import end_span
+from api.tracing import get_current_span
+from api.tracing import span
+from api.tracing import start_span
+from api.tracing import use_span
 from api.utils import post_request
+from api.utils import post_stream_request
 from api.utils import Response
 from constants import DEFAULT_TIMEOUTS
 from constants import GLOBAL_TIMEOUT
+from constants import MAX_LOGPROB_TOKENS
 from constants import OPENAI_DV3_ORG
 from constants import OPENAI_MODEL_FALLBACKS
-from conversation.utils import compute_word_logprobs
+from conversation.tag_parser import ParsedTags
+from conversation.tag_parser import TagParser
+from conversation.utils import compute_word_boundaries
 
 logger = logging.getLogger(__name__)
 
@@ -29,6 +49,14 @@ BASE_API_URL = os.environ.get("OPENAI_URL", "https://api.openai.com")
 HEADERS = {"Authorization": f"Bearer {os.environ.get('OPENAI_API_KEY')}"}
 
 
+def record_completion_error(call_type: str) -> None:
+    get_metrics_registry().counter(
+        "completion_errors_total",
+        "Completion calls that failed after all retries",
+        ["call_type"],
+    ).inc(call_type=call_type)
+
+
 class CompletionType:
     TEXT = "text"
     CHAT = "chat"
@@ -55,6 +83,8 @@ class Completion(ABC):
         holds a completion response once generated
     num_generations : int
         represents the number of times the LM was queried in order to generate the full completion
+    time_to_first_token : Optional[float]
+        ms from the start of a streamed completion until its first text arrived
     completion_type : Enum[CompletionType]
         TEXT or CHAT
     """
@@ -66,6 +96,7 @@ class Completion(ABC):
     params: dict[str, Any]
     completion_response: CompletionResponse | None = None
     num_generations: int = 0
+    time_to_first_token: float | None = None
     completion_type: str = CompletionType.TEXT
 
     def __init__(
@@ -94,6 +125,7 @@ class Completion(ABC):
         completion_primer: str = "",
         messages: list[str] = None,
         settings: dict[str, Any] = None,
+        volatile_messages: list[dict[str, str]] = None,
     ) -> TextCompletion:
         completion_type = Completion.get_completion_type(settings)
         if completion_type == CompletionType.TEXT:
@@ -106,6 +138,7 @@ class Completion(ABC):
                 messages=messages,
                 completion_primer=completion_primer,
                 settings=settings,
+                volatile_messages=volatile_messages,
             )
         else:
             raise ValueError(f"Invalid completion type: {completion_type}")
@@ -116,61 +149,179 @@ class Completion(ABC):
         return settings.get("completion_type", CompletionType.TEXT)
 
     def parse_settings(self, settings: dict[str, Any]) -> dict[str, Any]:
-        return {
-            param: settings.get(param, default)
-            for param, default in self.default_params.items()
-        }
+        # prompt settings are read-only, with tuples for lists and read-only mappings for dicts; the request params
+        # are plain copies
+        params = {}
+        for param, default in self.default_params.items():
+            value = settings.get(param, default)
+            params[param] = (
+                list(value)
+                if isinstance(value, tuple)
+                else dict(value)
+                if isinstance(value, Mapping)
+                else value
+            )
+        return params
 
     @abstractmethod
     def prepare_request_body(self) -> dict[str, Any]:
         pass
 
+    @abstractmethod
+    def num_prompt_tokens(self, data: dict[str, Any]) -> int:
+        """Return the number of prompt tokens in a request body prepared by `prepare_request_body`"""
+        pass
+
+    @timed
+    def estimate_num_tokens(self, data: dict[str, Any]) -> int:
+        """Upper bound on the tokens a request will use, used to reserve rate limit budget before it is sent"""
+        return self.num_prompt_tokens(data) + (data.get("max_tokens") or 0)
+
     @staticmethod
-    async def _get_completion_with_retries(
+    async def _request_with_retries(
         url: str,
         data: dict[str, Any],
         headers: dict[str, str],
         activity_id: str,
         turn_id: str,
-        completion_type: str,
         timeout: float = GLOBAL_TIMEOUT,
-        max_retries: int = 3,
-        retry_delay: int = 1,
-    ) -> tuple[CompletionResponse | None, int]:
-        """Query the GPT Completions API up to max_retries times in case of request failure with a jitter of 1-2s"""
-        for retry in range(max_retries):
-            response = await post_request(url, data, headers, timeout=timeout)
-
-            if "error" in response.data and response.data["error"]["type"] in {
-                "server_error",
-                "tokens",
-                "requests",
-                "TimeoutError",
-            }:
-                await asyncio.sleep(retry_delay + random.random())
-                logger.info(
-                    f"activityId={activity_id} :: turnId={turn_id} :: GPT-3 API call failed with error: "
-                    f"{response.data['error']['message']} on attempt number {retry + 1}."
-                )
-            else:
-                data = response.data["choices"][0]
-                text = (
-                    data["message"]["content"]
-                    if completion_type == CompletionType.CHAT
-                    else data["text"]
+        retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+        num_tokens: int = 0,
+        stream: bool = False,
+    ) -> tuple[Response, int]:
+        """Query the GPT Completions API, retrying failed requests with backoff according to the retry policy while
+        the batch's retry budget allows. Each attempt first waits for `num_tokens` of rate limit budget for the model,
+        which is returned if the attempt fails to connect to the API.
+        Streamed requests can only be retried until their response starts, so a successful StreamResponse is
+        returned as soon as its status is known.
+
+        Returns
+        -------
+        response : Response
+            the successful response, or StreamResponse if `stream`
+        num_retries : int
+            the number of failed attempts before it
+
+        Raises
+        ------
+        CompletionError
+            if the request fails with a non-retryable error or all attempts fail
+        """
+        rate_limiter = get_rate_limiter(data["model"])
+        retry_budget = get_retry_budget()
+        retry_budget.deposit()
+        delay = retry_policy.base_delay
+
+        for attempt in range(retry_policy.max_attempts):
+            if rate_limiter:
+                with span("rate_limit.wait", model=data["model"], tokens=num_tokens):
+                    await rate_limiter.acquire(num_tokens)
+            with span("http.request", url=url, attempt=attempt + 1) as request_span:
+                if stream:
+                    response = await post_stream_request(url, data, headers, timeout=timeout)
+                else:
+                    response = await post_request(url, data, headers, timeout=timeout)
+                if request_span:
+                    request_span.set_attribute("status", response.status)
+
+            if response.status == 200 and (
+                stream
+                or isinstance(response.data, dict)
+                and "error" not in response.data
+            ):
+                return response, attempt
+
+            error = (
+                response.data.get("error") if isinstance(response.data, dict) else None
+            ) or {"type": None, "message": str(response.data)}
+            logger.info(
+                f"activityId={activity_id} :: turnId={turn_id} :: GPT-3 API call failed with error: "
+                f"{error['message']} on attempt number {attempt + 1}."
+            )
+            # the API never received a request that failed to connect, so it didn't count its tokens either
+            if rate_limiter and response.status == -1 and error["type"] in CONNECTION_ERROR_TYPES:
+                rate_limiter.release(num_tokens)
+
+            if not retry_policy.is_retryable(response.status, error["type"]):
+                raise CompletionError(
+                    f"GPT-3 API call failed with non-retryable error: {error['message']}",
+                    error_type=error["type"],
+                    status=response.status,
+                    num_attempts=attempt + 1,
                 )
-                return (
-                    CompletionResponse(
-                        text=text,
-                        message=data.get("message"),
-                        finish_reason=data["finish_reason"],
-                        usage=response.data["usage"],
-                        logprobs=data.get("logprobs"),
-                        latency=float(response.headers.get("Openai-Processing-Ms")),
-                    ),
-                    retry,
+            if attempt == retry_policy.max_attempts - 1:
+                break
+            if not retry_budget.try_withdraw():
+                raise CompletionError(
+                    f"GPT-3 API call failed and the retry budget is exhausted: {error['message']}",
+                    error_type=error["type"],
+                    status=response.status,
+                    num_attempts=attempt + 1,
                 )
 
+            delay = retry_policy.get_delay(delay, response.headers, error["type"])
+            with span("retry.sleep", delay=delay, errorType=error["type"]):
+                await asyncio.sleep(delay)
+
+        raise CompletionError(
+            f"GPT-3 API call failed after {retry_policy.max_attempts} attempts: {error['message']}",
+            error_type=error["type"],
+            status=response.status,
+            num_attempts=retry_policy.max_attempts,
+        )
+
+    @staticmethod
+    async def _get_completion_with_retries(
+        url: str,
+        data: dict[str, Any],
+        headers: dict[str, str],
+        activity_id: str,
+        turn_id: str,
+        completion_type: str,
+        timeout: float = GLOBAL_TIMEOUT,
+        retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+        num_tokens: int = 0,
+    ) -> tuple[CompletionResponse, int]:
+        """Query the GPT Completions API with retries and parse the completion response, returning the rate limit
+        budget reserved beyond the tokens actually used
+
+        Raises
+        ------
+        CompletionError
+            if the request fails with a non-retryable error or all attempts fail
+        """
+        response, num_retries = await Completion._request_with_retries(
+            url,
+            data,
+            headers,
+            activity_id,
+            turn_id,
+            timeout=timeout,
+            retry_policy=retry_policy,
+            num_tokens=num_tokens,
+        )
+
+        choice = response.data["choices"][0]
+        text = (
+            choice["message"]["content"]
+            if completion_type == CompletionType.CHAT
+            else choice["text"]
+        )
+        rate_limiter = get_rate_limiter(data["model"])
+        if rate_limiter:
+            rate_limiter.release(num_tokens - response.data["usage"]["total_tokens"])
+        return (
+            CompletionResponse(
+                text=text,
+                message=choice.get("message"),
+                finish_reason=choice["finish_reason"],
+                usage=response.data["usage"],
+                logprobs=choice.get("logprobs"),
+                latency=float(response.headers.get("Openai-Processing-Ms")),
+            ),
+            num_retries,
+        )
+
     @staticmethod
     async def log_completion(
         request: dict[str, Any],
@@ -183,6 +334,7 @@ class Completion(ABC):
         num_retries: int,
         model_fallback_from: str = None,
         stream: bool = False,
+        time_to_first_token: float = None,
         activity_id: str = None,
         turn_id: str = None,
         user_id: str = None,
@@ -191,23 +343,91 @@ class Completion(ABC):
 
         # CAREFUL: used for log-based metrics!
         prompt_plus_max_tokens = completion_response.num_prompt_tokens + max_tokens
-        logger.info(f"GPT3 USAGE:{completion_response.num_total_tokens}")
+        logger.info("GPT3 USAGE:%s", completion_response.num_total_tokens)
         logger.info(
-            f"activityId={activity_id} :: turnId={turn_id} :: "
-            f"GPT-3 API call ({model}) completed in "
-            f"<latency:{latency:.2f}ms> <maxTokens:{max_tokens}> "
-            f"<promptPlusMaxTokens:{prompt_plus_max_tokens}> "
-            f"Full Request:\n{json.dumps(request, ensure_ascii=False, indent=4)}\n\n"
-            f"API Input:\n{prompt}\n\nOutput:\n{completion_response.text}"
+            "activityId=%s :: turnId=%s :: GPT-3 API call (%s) completed in "
+            "<latency:%.2fms> <maxTokens:%s> <promptPlusMaxTokens:%s> <cachedPromptTokens:%s>%s",
+            activity_id,
+            turn_id,
+            model,
+            latency,
+            max_tokens,
+            prompt_plus_max_tokens,
+            completion_response.num_cached_prompt_tokens,
+            f" <timeToFirstToken:{time_to_first_token:.2f}ms>"
+            if time_to_first_token is not None
+            else "",
         )
 
+        registry = get_metrics_registry()
+        registry.counter(
+            "completion_calls_total",
+            "Completed calls to the completions endpoint",
+            ["call_type", "completion_type", "model"],
+        ).inc(call_type=call_type, completion_type=completion_type, model=model)
+        registry.histogram(
+            "completion_latency_ms",
+            "Latency of completion calls, including retries",
+            ["call_type"],
+        ).observe(latency, call_type=call_type)
+        if time_to_first_token is not None:
+            registry.histogram(
+                "completion_time_to_first_token_ms",
+                "Time until the first token of streamed completion calls",
+                ["call_type"],
+            ).observe(time_to_first_token, call_type=call_type)
+        registry.counter(
+            "completion_retries_total", "Retried requests of completion calls", ["call_type"]
+        ).inc(num_retries, call_type=call_type)
+        tokens = registry.counter(
+            "completion_tokens_total", "Tokens of completion calls", ["call_type", "kind"]
+        )
+        tokens.inc(completion_response.num_prompt_tokens, call_type=call_type, kind="prompt")
+        tokens.inc(
+            completion_response.num_cached_prompt_tokens, call_type=call_type, kind="cached_prompt"
+        )
+        tokens.inc(
+            completion_response.num_completion_tokens, call_type=call_type, kind="completion"
+        )
+
+        # the full request and output only go to the structured completion log, which writes off the event loop
+        completion_log = get_completion_log()
+        if completion_log:
+            completion_log.log(
+                {
+                    "activityId": activity_id,
+                    "turnId": turn_id,
+                    "userId": user_id,
+                    "callType": call_type,
+                    "completionType": completion_type,
+                    "model": model,
+                    "modelFallbackFrom": model_fallback_from,
+                    "stream": stream,
+                    "latency": latency,
+                    "timeToFirstToken": time_to_first_token,
+                    "numRetries": num_retries,
+                    "maxTokens": max_tokens,
+                    "promptTokens": completion_response.num_prompt_tokens,
+                    "cachedPromptTokens": completion_response.num_cached_prompt_tokens,
+                    "completionTokens": completion_response.num_completion_tokens,
+                    "totalTokens": completion_response.num_total_tokens,
+                    "promptPlusMaxTokens": prompt_plus_max_tokens,
+                    "finishReason": completion_response.finish_reason,
+                },
+                payload={
+                    "request": request,
+                    "prompt": prompt,
+                    "output": completion_response.text,
+                },
+            )
+
     async def _generate_single_completion(
         self,
         activity_id: str = None,
         turn_id: str = None,
         user_id: str = None,
         call_type: str = None,
-    ) -> CompletionResponse | None:
+    ) -> CompletionResponse:
         """Query the GPT-3 Completions API"""
         t0 = time()
 
@@ -218,10 +438,35 @@ class Completion(ABC):
         timeout = DEFAULT_TIMEOUTS.get(call_type, GLOBAL_TIMEOUT)
 
         # CAREFUL: used for log-based metrics!
-        logger.info(
-            f"activityId={activity_id} :: turnId={turn_id} :: "
-            f"GPT-3 API call parameters ({model}): { {**self.params, 'model': model} }"
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "activityId=%s :: turnId=%s :: GPT-3 API call parameters (%s): %s",
+                activity_id,
+                turn_id,
+                model,
+                {**self.params, "model": model},
+            )
+
+        # serve the completion from the cache if an identical request has been completed before
+        cache = get_completion_cache()
+        cache_key = (
+            get_request_key(self.api_url, data)
+            if cache and cache.is_cacheable(data, call_type)
+            else None
         )
+        cached_response = cache.get(cache_key) if cache_key else None
+        if cached_response is not None:
+            logger.info(
+                f"activityId={activity_id} :: turnId={turn_id} :: "
+                f"GPT-3 API call ({model}) served from cache"
+            )
+            current_span = get_current_span()
+            if current_span:
+                current_span.set_attribute("cached", True)
+            get_metrics_registry().counter(
+                "completion_cache_hits_total", "Completion calls served from the cache", ["call_type"]
+            ).inc(call_type=call_type)
+            return CompletionResponse.from_json(cached_response)
 
         # get completion
         try:
@@ -233,10 +478,24 @@ class Completion(ABC):
                 turn_id,
                 self.completion_type,
                 timeout=timeout,
+                num_tokens=self.estimate_num_tokens(data),
             )
+        except CompletionError as e:
+            logger.error(
+                f"activityId={activity_id} :: turnId={turn_id} :: "
+                f"Completion failed to generate with error: {e}"
+            )
+            record_completion_error(call_type)
+            raise
         except Exception as e:
             logger.error(f"Could not parse response from Completion with error: {e}")
-            return None
+            record_completion_error(call_type)
+            raise CompletionError(
+                f"Could not parse response from Completion: {e!r}"
+            ) from e
+
+        if cache_key:
+            cache.set(cache_key, completion_response.to_json())
 
         await self.log_completion(
             request=data,
@@ -266,22 +525,34 @@ class Completion(ABC):
         max_generations: int = 10,
     ):
         """Requery the completion endpoint up to N times until the finish reason is reached. Even if the max_tokens
-        is too low and the completion is truncated due to length, we can query again."""
+        is too low and the completion is truncated due to length, we can query again.
+
+        Raises
+        ------
+        CompletionError
+            if a request to the completion endpoint fails after all retries
+        """
         for i in range(max_generations):
 
             # get completion
-            completion_response = await self._generate_single_completion(
-                activity_id=activity_id,
-                turn_id=turn_id,
-                user_id=user_id,
-                call_type=call_type,
-            )
-            if completion_response is None:
-                logger.error(
-                    f"activityId={activity_id} :: turnId={turn_id} :: "
-                    f"Completion failed to generate; returning empty string"
+            with span(
+                "completion",
+                callType=call_type,
+                model=self.get_model(),
+                generation=i + 1,
+                activityId=activity_id,
+                turnId=turn_id,
+            ) as completion_span:
+                completion_response = await self._generate_single_completion(
+                    activity_id=activity_id,
+                    turn_id=turn_id,
+                    user_id=user_id,
+                    call_type=call_type,
                 )
-                break
+                if completion_span:
+                    completion_span.set_attribute(
+                        "finishReason", completion_response.finish_reason
+                    )
 
             if self.completion_response:
                 self.completion_response.update(completion_response)
@@ -326,24 +597,18 @@ class Completion(ABC):
         format: str = None,
         activity_id: str = None,
         turn_id: str = None,
-    ) -> OrderedDict[str, str]:
+    ) -> ParsedTags:
         completion = self.get_full_completion()
         if format:
-            completion = (
-                completion.replace(f"```{format}", "").replace("```", "").strip()
-            )
+            completion = TagParser.extract_fenced(completion, format)
         return self.parse_tags_from_completion(completion, tags, activity_id, turn_id)
 
     @staticmethod
+    @timed
     def parse_tags_from_completion(
         completion: str, tags: list[str], activity_id: str = None, turn_id: str = None
-    ) -> OrderedDict[str, str]:
-        """Tags are parsed from a free-form string. There are a few basic assumptions:
-
-                1. The tags are present in the string in order
-                2. Each tag is followed by a colon
-                3. Tag keys will be parsed exactly without any lowercasing, punctuation removal, etc.
-                4. No tag will occur twice in the completion string
+    ) -> ParsedTags:
+        """Parse the tags from a free-form completion string with the shared `TagParser` for the tags.
 
         Parameters
         ----------
@@ -354,33 +619,10 @@ class Completion(ABC):
 
         Returns
         -------
-        OrderedDict[str, str]
-            map of tag keys to parsed values
+        ParsedTags
+            map of tag keys to parsed values, with the tags that couldn't be parsed in `missing`
         """
-        text = completion
-        parsed_tags = OrderedDict()
-        prev_tag = "dummy_tag"
-
-        for tag in tags:
-            try:
-                prev_tag_value, text = text.split(tag + ":")
-                parsed_tags[prev_tag] = prev_tag_value.strip()
-                prev_tag = tag
-
-            except:
-                logger.info(
-                    "activityId=%s :: turnId=%s :: Couldn't parse tag [%s] from completion: %s",
-                    activity_id,
-                    turn_id,
-                    tag,
-                    completion,
-                )
-                break
-
-        parsed_tags[prev_tag] = text.strip()
-        parsed_tags.pop("dummy_tag")
-
-        return parsed_tags
+        return TagParser.for_tags(tuple(tags)).parse(completion, activity_id, turn_id)
 
 
 class TextCompletion(Completion):
@@ -405,13 +647,19 @@ class TextCompletion(Completion):
         super().__init__(prompt, completion_primer, settings)
         self.completion_type = CompletionType.TEXT
 
+    @timed
     def prepare_request_body(self) -> dict[str, Any]:
+        """The prompt is expected to start with its stable parts (the lesson prompt, then the dialogue) so that
+        requests share a prefix across turns and conversations, and the completion primer is always last"""
         return {
             "prompt": self.get_full_prompt(),
             **self.params,
             "model": self.get_model_with_fallback(),
         }
 
+    def num_prompt_tokens(self, data: dict[str, Any]) -> int:
+        return count_prompt_tokens(data["prompt"], data["model"])
+
 
 class ChatCompletion(Completion):
     """Completion object to format requests specifically for the chat completions endpoint."""
@@ -434,9 +682,11 @@ class ChatCompletion(Completion):
         messages: list[dict[str, str]] = None,
         completion_primer: str = "",
         settings: dict[str, Any] = None,
+        volatile_messages: list[dict[str, str]] = None,
     ):
         super().__init__(prompt, completion_primer, settings)
         self.messages = messages or []
+        self.volatile_messages = volatile_messages or []
         self.completion_type = CompletionType.CHAT
 
     def get_system_message(self) -> str:
@@ -445,61 +695,31 @@ class ChatCompletion(Completion):
             "content": self.prompt,
         }
 
+    @timed
     def prepare_request_body(self):
-        messages = (
-            self.messages + [{"role": "assistant", "content": self.completion_primer}]
-            if self.completion_primer
-            else self.messages
-        )
+        """Lay out the messages from the most to the least stable: the system message, the dialogue history, then
+        the messages specific to this request (e.g. regeneration instructions) and the completion primer. Requests
+        then share a byte-identical prefix across turns and conversations, which the provider's prompt caching
+        reuses."""
+        messages = [self.get_system_message(), *self.messages, *self.volatile_messages]
+        if self.completion_primer:
+            messages.append({"role": "assistant", "content": self.completion_primer})
         return {
-            "messages": [self.get_system_message(), *messages],
+            "messages": messages,
             **self.params,
             "model": self.get_model_with_fallback(),
         }
 
+    def num_prompt_tokens(self, data: dict[str, Any]) -> int:
+        try:
+            return self.num_tokens_from_messages(data["messages"], data["model"])
+        except NotImplementedError:
+            return self.num_tokens_from_messages(data["messages"])
+
     @staticmethod
     def num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613"):
-        """Return the number of tokens used by a list of messages. Taken from the cookbook example at https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb"""
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            encoding = tiktoken.get_encoding("cl100k_base")
-        if model in {
-            "gpt-3.5-turbo-0613",
-            "gpt-3.5-turbo-16k-0613",
-            "gpt-4-0314",
-            "gpt-4-32k-0314",
-            "gpt-4-0613",
-            "gpt-4-32k-0613",
-        }:
-            tokens_per_message = 3
-            tokens_per_name = 1
-        elif model == "gpt-3.5-turbo-0301":
-            tokens_per_message = (
-                4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-            )
-            tokens_per_name = -1  # if there's a name, the role is omitted
-        elif "gpt-3.5-turbo" in model:
-            return ChatCompletion.num_tokens_from_messages(
-                messages, model="gpt-3.5-turbo-0613"
-            )
-        elif "gpt-4" in model:
-            return ChatCompletion.num_tokens_from_messages(messages, model="gpt-4-0613")
-        elif "gpt-dv-speak" in model:
-            return ChatCompletion.num_tokens_from_messages(messages, model="gpt-4-0314")
-        else:
-            raise NotImplementedError(
-                f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
-            )
-        num_tokens = 0
-        for message in messages:
-            num_tokens += tokens_per_message
-            for key, value in message.items():
-                num_tokens += len(encoding.encode(value))
-                if key == "name":
-                    num_tokens += tokens_per_name
-        num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-        return num_tokens
+        """Return the number of tokens used by a list of messages, reusing the counts of messages seen before"""
+        return num_tokens_from_messages(messages, model)
 
     async def generate_streamed_completion(
         self,
@@ -511,45 +731,100 @@ class ChatCompletion(Completion):
         max_generations: int = 10,
     ):
         """Requery the completion endpoint up to N times until the finish reason is reached. Even if the max_tokens
-        is too low and the completion is truncated due to length, we can query again."""
-        role = ""
-        generation_finish_reason = ""
-        text_deltas = []
+        is too low and the completion is truncated due to length, we can query again.
+
+        Each request is streamed as server-sent events over the shared session, with the same retries and rate
+        limits as `generate_completion` until the stream starts. Token usage is read from the final event of the
+        stream when the server reports it, and counted locally otherwise.
+
+        Raises
+        ------
+        CompletionError
+            if a request fails with a non-retryable error, all attempts fail, or the stream breaks off
+        """
+        headers = HEADERS.copy()
+        timeout = DEFAULT_TIMEOUTS.get(call_type, GLOBAL_TIMEOUT)
+        t_start = time()
 
         for i in range(max_generations):
             t0 = time()
-
-            data = self.prepare_request_body()
+            data = {
+                **self.prepare_request_body(),
+                "stream": True,
+                "stream_options": {"include_usage": True},
+            }
             model = data["model"]
-            response = await openai.ChatCompletion.acreate(
-                **data,
+            num_tokens = self.estimate_num_tokens(data)
+            # the span can't be made current across the yields below, only around the request
+            completion_span = start_span(
+                "completion",
+                callType=call_type,
+                model=model,
+                generation=i + 1,
                 stream=True,
+                activityId=activity_id,
+                turnId=turn_id,
             )
+            try:
+                with use_span(completion_span):
+                    response, num_retries = await self._request_with_retries(
+                        self.api_url,
+                        data,
+                        headers,
+                        activity_id,
+                        turn_id,
+                        timeout=timeout,
+                        num_tokens=num_tokens,
+                        stream=True,
+                    )
+            except CompletionError as e:
+                record_completion_error(call_type)
+                end_span(completion_span, e)
+                raise
 
             # process streamed completion and collect metadata
-            async for chunk in response:
-                delta = chunk["choices"][0]["delta"]
-                if "role" in delta:
-                    role = delta["role"]
-                elif "content" in delta:
-                    text_deltas.append(delta["content"])
-                    yield delta["content"]
-                else:
-                    generation_finish_reason = chunk["choices"][0]["finish_reason"]
+            role, generation_finish_reason, usage, text_deltas = "assistant", None, None, []
+            try:
+                async for chunk in response.events:
+                    usage = chunk.get("usage") or usage
+                    if not chunk.get("choices"):
+                        continue
+                    choice = chunk["choices"][0]
+                    delta = choice.get("delta") or {}
+                    role = delta.get("role") or role
+                    if delta.get("content"):
+                        if self.time_to_first_token is None:
+                            self.time_to_first_token = (time() - t_start) * 1000
+                        text_deltas.append(delta["content"])
+                        yield delta["content"]
+                    generation_finish_reason = choice.get("finish_reason") or generation_finish_reason
+            except Exception as e:
+                logger.error(
+                    f"activityId={activity_id} :: turnId={turn_id} :: "
+                    f"Streamed completion failed with error: {e!r}"
+                )
+                record_completion_error(call_type)
+                end_span(completion_span, e)
+                raise CompletionError(f"Streamed completion failed: {e!r}") from e
+            except BaseException as e:
+                # e.g. the stream is closed early by the consumer or cancelled
+                end_span(completion_span, e)
+                raise
+            finally:
+                await response.events.aclose()
 
             # construct completion response
             message = {
                 "role": role,
                 "content": "".join(text_deltas),
             }
-            usage = {
-                "prompt_tokens": self.num_tokens_from_messages(
-                    [self.get_system_message(), *self.messages], self.model
-                ),
-                "completion_tokens": self.num_tokens_from_messages(
-                    [message], self.model
-                ),
-            }
+            if usage is None:
+                usage = {
+                    "prompt_tokens": self.num_prompt_tokens(data),
+                    "completion_tokens": self.num_tokens_from_messages(
+                        [message], self.model
+                    ),
+                }
             completion_response = CompletionResponse(
                 text=message["content"],
                 message=message,
@@ -557,16 +832,12 @@ class ChatCompletion(Completion):
                 usage=usage,
                 latency=(time() - t0) * 1000,
             )
-
-            if completion_response is None:
-                logger.error(
-                    f"activityId={activity_id} :: turnId={turn_id} :: "
-                    f"Completion failed to generate; returning empty string"
-                )
-                break
+            rate_limiter = get_rate_limiter(model)
+            if rate_limiter:
+                rate_limiter.release(num_tokens - completion_response.num_total_tokens)
 
             await self.log_completion(
-                request=self.prepare_request_body(),
+                request=data,
                 completion_type=self.completion_type,
                 completion_response=completion_response,
                 model=model,
@@ -574,13 +845,17 @@ class ChatCompletion(Completion):
                 max_tokens=self.get_param("max_tokens"),
                 latency=completion_response.latency,
                 prompt=self.get_full_prompt(),
-                num_retries=1,
+                num_retries=num_retries,
                 stream=True,
+                time_to_first_token=self.time_to_first_token if i == 0 else None,
                 activity_id=activity_id,
                 turn_id=turn_id,
                 user_id=user_id,
                 call_type=call_type,
             )
+            if completion_span:
+                completion_span.set_attribute("finishReason", completion_response.finish_reason)
+            end_span(completion_span)
 
             if self.completion_response:
                 self.completion_response.update(completion_response)
@@ -597,6 +872,87 @@ class ChatCompletion(Completion):
             self.completion_primer += completion_response.text
 
 
+class Logprobs:
+    """Array-backed log probabilities for the tokens of a completion and for the whitespace-separated words they form.
+    Tokens and words are stored as parallel lists and arrays, rather than a dict per token and per word, since a
+    batch of conversations holds many completions in memory. At most `max_tokens` of the most recent tokens are
+    kept, so that a completion regenerated many times can't grow without bound.
+
+    Attributes
+    ----------
+    tokens : List[str]
+        tokens of the completion
+    token_logprobs : array
+        log probability of each token
+    words : List[str]
+        whitespace-separated words of the completion
+    word_logprobs : array
+        summed log probability of each word's tokens
+    word_offsets : array
+        index of the token that each word starts at
+    """
+
+    __slots__ = ("tokens", "token_logprobs", "words", "word_logprobs", "word_offsets")
+
+    def __init__(
+        self,
+        tokens: list[str],
+        token_logprobs: Iterable[float | None],
+        max_tokens: int = MAX_LOGPROB_TOKENS,
+    ):
+        self.tokens = list(tokens)
+        self.token_logprobs = array(
+            "d", (logprob or 0.0 for logprob in token_logprobs)
+        )
+        self.words, self.word_logprobs, self.word_offsets = compute_word_boundaries(
+            self.tokens, self.token_logprobs
+        )
+        self.truncate(max_tokens)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def extend(self, other: Logprobs, max_tokens: int = MAX_LOGPROB_TOKENS) -> None:
+        offset = len(self.tokens)
+        self.tokens.extend(other.tokens)
+        self.token_logprobs.extend(other.token_logprobs)
+        self.words.extend(other.words)
+        self.word_logprobs.extend(other.word_logprobs)
+        self.word_offsets.extend(word_offset + offset for word_offset in other.word_offsets)
+        self.truncate(max_tokens)
+
+    def truncate(self, max_tokens: int) -> None:
+        """Keep only the last `max_tokens` tokens, and the words that start within them"""
+        num_dropped = len(self.tokens) - max_tokens
+        if num_dropped <= 0:
+            return
+
+        del self.tokens[:num_dropped]
+        del self.token_logprobs[:num_dropped]
+        num_dropped_words = bisect_left(self.word_offsets, num_dropped)
+        del self.words[:num_dropped_words]
+        del self.word_logprobs[:num_dropped_words]
+        self.word_offsets = array(
+            "l",
+            (
+                word_offset - num_dropped
+                for word_offset in self.word_offsets[num_dropped_words:]
+            ),
+        )
+
+    def get_token_logprobs(self) -> list[dict[str, Any]]:
+        return [
+            {"token": tok, "logprob": logprob}
+            for tok, logprob in zip(self.tokens, self.token_logprobs)
+        ]
+
+    def get_word_logprobs(self) -> list[dict[str, Any]]:
+        return [
+            {"word": word, "logprob": logprob}
+            for word, logprob in zip(self.words, self.word_logprobs)
+        ]
+
+
 class CompletionResponse:
     """Contains text completion and all api metadata returned from completion endpoint
 
@@ -606,12 +962,12 @@ class CompletionResponse:
         raw text of the generated completion
     finish_reason : str
         reason for stopping the completion: e.g. `stop`, `length`, etc.
-    token_logprobs : List[Dict[str, Any]]
-        log probabilities for all tokens in completion
-    word_logprobs : List[Dict[str, Any]]
-        log probabilities for all words in completion
+    logprobs : Optional[Logprobs]
+        log probabilities for all tokens and words in completion, if requested
     num_prompt_tokens : int
         total number of tokens in the submitted prompt
+    num_cached_prompt_tokens : int
+        number of prompt tokens served from the provider's prompt prefix cache, if reported
     num_completion_tokens : int
         total number of tokens in the generated completion
     num_total_tokens : int
@@ -620,12 +976,24 @@ class CompletionResponse:
         openai processing latency in ms
     """
 
+    __slots__ = (
+        "text",
+        "message",
+        "finish_reason",
+        "logprobs",
+        "num_prompt_tokens",
+        "num_cached_prompt_tokens",
+        "num_completion_tokens",
+        "num_total_tokens",
+        "latency",
+    )
+
     text: str
     message: dict[str, str]
     finish_reason: str
-    token_logprobs: list[dict[str, Any]] = []
-    word_logprobs: list[dict[str, Any]] = []
+    logprobs: Logprobs | None
     num_prompt_tokens: int
+    num_cached_prompt_tokens: int
     num_completion_tokens: int
     num_total_tokens: int
     latency: float
@@ -645,18 +1013,62 @@ class CompletionResponse:
         self.finish_reason = finish_reason
         self.latency = latency
         self.parse_token_usage(usage)
+        self.logprobs = None
         if logprobs:
             self.parse_logprobs(logprobs)
 
+    @property
+    def token_logprobs(self) -> list[dict[str, Any]]:
+        """log probabilities for all tokens in completion"""
+        return self.logprobs.get_token_logprobs() if self.logprobs else []
+
+    @property
+    def word_logprobs(self) -> list[dict[str, Any]]:
+        """log probabilities for all words in completion"""
+        return self.logprobs.get_word_logprobs() if self.logprobs else []
+
+    @classmethod
+    def from_json(cls, completion_response: dict[str, Any]) -> CompletionResponse:
+        """Parses a CompletionResponse from a json object created by `to_json`"""
+        message = completion_response["message"]
+        return CompletionResponse(
+            text=completion_response["text"],
+            finish_reason=completion_response["finish_reason"],
+            usage=completion_response["usage"],
+            logprobs=completion_response["logprobs"],
+            latency=completion_response["latency"],
+            message=dict(message) if message else None,
+        )
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            "text": self.text,
+            "message": dict(self.message) if self.message else None,
+            "finish_reason": self.finish_reason,
+            "usage": {
+                "prompt_tokens": self.num_prompt_tokens,
+                "completion_tokens": self.num_completion_tokens,
+                "total_tokens": self.num_total_tokens,
+                "prompt_tokens_details": {"cached_tokens": self.num_cached_prompt_tokens},
+            },
+            "logprobs": {
+                "tokens": self.logprobs.tokens,
+                "token_logprobs": self.logprobs.token_logprobs.tolist(),
+            }
+            if self.logprobs
+            else None,
+            "latency": self.latency,
+        }
+
+    @timed
     def parse_logprobs(self, logprobs: dict[str, Any]):
-        self.token_logprobs = [
-            {"token": tok, "logprob": logprobs["token_logprobs"][i]}
-            for i, tok in enumerate(logprobs["tokens"])
-        ]
-        self.word_logprobs = compute_word_logprobs(self.token_logprobs)
+        self.logprobs = Logprobs(logprobs["tokens"], logprobs["token_logprobs"])
 
     def parse_token_usage(self, usage):
         self.num_prompt_tokens = usage.get("prompt_tokens", 0)
+        self.num_cached_prompt_tokens = (usage.get("prompt_tokens_details") or {}).get(
+            "cached_tokens", 0
+        )
         self.num_completion_tokens = usage.get("completion_tokens", 0)
         self.num_total_tokens = usage.get(
             "total_tokens", self.num_prompt_tokens + self.num_completion_tokens
@@ -664,12 +1076,15 @@ class CompletionResponse:
 
     def update(self, other: CompletionResponse):
         self.text = other.text
-        if self.message:
+        if self.message and other.message:
             self.message["content"] += other.message["content"]
         self.finish_reason = other.finish_reason
         self.latency += other.latency
-        self.token_logprobs.extend(other.token_logprobs)
-        self.word_logprobs.extend(other.word_logprobs)
+        if self.logprobs and other.logprobs:
+            self.logprobs.extend(other.logprobs)
+        elif other.logprobs:
+            self.logprobs = other.logprobs
         self.num_prompt_tokens += other.num_prompt_tokens
+        self.num_cached_prompt_tokens += other.num_cached_prompt_tokens
         self.num_completion_tokens += other.num_completion_tokens
         self.num_total_tokens += other.num_total_tokens
@@ -0,0 +1,130 @@
+"""Structured log of completion calls, written as JSON lines on a background thread.
+
+Every completion call emits one record with its cheap metadata (tokens, latency, retries, ...). The request, prompt
+and output payloads are attached to a sampled fraction of records and truncated, since with long lesson prompts and
+dialogues they are most of the cost of logging. Records are put on a queue by the event loop as-is; serializing and
+writing them happens on the thread of a `QueueListener`, so logging never blocks the loop on formatting or disk I/O.
+
+Usage:
+    set_completion_log(CompletionLog("completions.jsonl", sample_rate=0.1))
+    ...
+    get_completion_log().close()
+"""
+from __future__ import annotations
+
+import json
+import logging
+import queue
+import random
+from logging.handlers import QueueHandler
+from logging.handlers import QueueListener
+from typing import Any
+
+from constants import COMPLETION_LOG_MAX_PAYLOAD_CHARS
+from constants import COMPLETION_LOG_SAMPLE_RATE
+
+completion_logger = logging.getLogger("completions")
+completion_logger.setLevel(logging.INFO)
+completion_logger.propagate = False  # records are only written to the completion log, not the application log
+
+_completion_log: CompletionLog | None = None
+
+
+def truncate_payload(payload: Any, max_chars: int) -> Any:
+    """Return a copy of a JSON payload with every string longer than `max_chars` truncated"""
+    if isinstance(payload, str):
+        if len(payload) <= max_chars:
+            return payload
+        return f"{payload[:max_chars]}...[{len(payload) - max_chars} more chars]"
+    if isinstance(payload, dict):
+        return {key: truncate_payload(value, max_chars) for key, value in payload.items()}
+    if isinstance(payload, (list, tuple)):
+        return [truncate_payload(value, max_chars) for value in payload]
+    return payload
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Formats the completion record attached to a log record as a line of JSON, truncating its payloads"""
+
+    def __init__(self, max_payload_chars: int = COMPLETION_LOG_MAX_PAYLOAD_CHARS):
+        super().__init__()
+        self.max_payload_chars = max_payload_chars
+
+    def format(self, record: logging.LogRecord) -> str:
+        completion = record.completion
+        if self.max_payload_chars is not None and "payload" in completion:
+            completion = {
+                **completion,
+                "payload": truncate_payload(completion["payload"], self.max_payload_chars),
+            }
+        return json.dumps(
+            {"timestamp": record.created, **completion}, ensure_ascii=False, default=str
+        )
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Queue handler that enqueues records unformatted, so that formatting happens on the listener's thread. The
+    default `prepare` formats the message on the calling thread."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class CompletionLog:
+    """A JSON-lines file of completion records, written by a background thread
+
+    Attributes
+    ----------
+    path : str
+        the file that records are appended to
+    sample_rate : float
+        fraction of records that include the request, prompt and output payloads
+    max_payload_chars : Optional[int]
+        strings in payloads longer than this are truncated, or None to keep them whole
+    """
+
+    def __init__(
+        self,
+        path: str,
+        sample_rate: float = COMPLETION_LOG_SAMPLE_RATE,
+        max_payload_chars: int | None = COMPLETION_LOG_MAX_PAYLOAD_CHARS,
+        seed: int = None,
+    ):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_payload_chars = max_payload_chars
+        self._random = random.Random(seed)
+
+        self._file_handler = logging.FileHandler(path, encoding="utf-8")
+        self._file_handler.setFormatter(JsonLinesFormatter(max_payload_chars))
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._queue_handler = DeferredQueueHandler(self._queue)
+        self._listener = QueueListener(self._queue, self._file_handler)
+        self._listener.start()
+        completion_logger.addHandler(self._queue_handler)
+
+    def should_log_payload(self) -> bool:
+        return self.sample_rate >= 1 or self._random.random() < self.sample_rate
+
+    def log(self, record: dict[str, Any], payload: dict[str, Any] = None) -> None:
+        """Queue a completion record to be written, with its payload if it is sampled. Neither may be modified after
+        they are logged, since they are serialized later on the writer thread."""
+        if payload is not None and self.should_log_payload():
+            record = {**record, "payload": payload}
+        completion_logger.info("completion", extra={"completion": record})
+
+    def close(self) -> None:
+        """Write all queued records and stop the writer thread"""
+        completion_logger.removeHandler(self._queue_handler)
+        self._listener.stop()
+        self._file_handler.close()
+
+
+def get_completion_log() -> CompletionLog | None:
+    return _completion_log
+
+
+def set_completion_log(completion_log: CompletionLog | None) -> None:
+    """Set the log that all completion calls are recorded to, or disable it with None"""
+    global _completion_log
+    _completion_log = completion_log
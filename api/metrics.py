@@ -0,0 +1,338 @@
+"""In-process metrics: counters and fixed-bucket histograms, collected in a registry and exported as Prometheus text
+or to Cloud Monitoring.
+
+Metrics are recorded on the event loop without locking, so recording one is a dict lookup and an increment. Each
+metric has a fixed set of label names, and keeps a separate value (or set of buckets) per combination of label
+values, e.g. per call type.
+
+Usage:
+    registry = get_metrics_registry()
+    registry.counter("conversations_total", "Conversations generated", ["status"]).inc(status="completed")
+    registry.histogram("completion_latency_ms", "Completion latency", ["call_type"]).observe(412.0, call_type="stepAgent")
+    write_prometheus("metrics.prom")
+"""
+from __future__ import annotations
+
+import logging
+import math
+import os
+from bisect import bisect_left
+from time import time
+from typing import Any
+from typing import Iterable
+from typing import Sequence
+
+from constants import CLOUD_MONITORING_MAX_TIME_SERIES_PER_REQUEST
+from constants import CLOUD_MONITORING_METRIC_PREFIX
+from constants import METRICS_LATENCY_BUCKETS_MS
+
+logger = logging.getLogger(__name__)
+
+LabelValues = tuple[str, ...]
+
+
+class Metric:
+    """Base class for metrics with a name, a description and a fixed set of label names"""
+
+    type: str = None
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+
+    def get_label_values(self, labels: dict[str, Any]) -> LabelValues:
+        if len(labels) != len(self.label_names):
+            raise ValueError(
+                f"Metric {self.name} expects labels {self.label_names}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def get_labels(self, label_values: LabelValues) -> dict[str, str]:
+        return dict(zip(self.label_names, label_values))
+
+
+class Counter(Metric):
+    """A monotonically increasing count, e.g. of calls or tokens"""
+
+    type = "counter"
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = ()):
+        super().__init__(name, description, label_names)
+        self.values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self.get_label_values(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels: Any) -> float:
+        return self.values.get(self.get_label_values(labels), 0)
+
+
+class HistogramValue:
+    """The bucket counts, sum and count of the observations of a histogram for one combination of label values"""
+
+    __slots__ = ("bucket_counts", "sum", "count")
+
+    def __init__(self, num_buckets: int):
+        self.bucket_counts = [0] * num_buckets  # non-cumulative, with a final overflow bucket
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(Metric):
+    """A distribution of observations, e.g. latencies, counted in fixed buckets given by their upper bounds"""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = METRICS_LATENCY_BUCKETS_MS,
+    ):
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(sorted(buckets))
+        self.values: dict[LabelValues, HistogramValue] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self.get_label_values(labels)
+        histogram = self.values.get(key)
+        if histogram is None:
+            histogram = self.values[key] = HistogramValue(len(self.buckets) + 1)
+        histogram.bucket_counts[bisect_left(self.buckets, value)] += 1
+        histogram.sum += value
+        histogram.count += 1
+
+    def get(self, **labels: Any) -> HistogramValue | None:
+        return self.values.get(self.get_label_values(labels))
+
+    def percentile(self, p: float, **labels: Any) -> float:
+        """Estimate the p-th percentile of the observations by interpolating linearly within its bucket, or nan if
+        there are none. Observations over the largest bucket bound are estimated at that bound."""
+        histogram = self.get(**labels)
+        if histogram is None or histogram.count == 0:
+            return float("nan")
+        rank = p / 100 * histogram.count
+        cumulative = 0
+        for i, bucket_count in enumerate(histogram.bucket_counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else min(0.0, self.buckets[0])
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.buckets[-1]
+
+
+class MetricsRegistry:
+    """The metrics of a process, by name. Metrics are created on first use and shared by name afterwards."""
+
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+        self.start_time = time()
+
+    def _get_or_create(self, cls: type, name: str, *args: Any, **kwargs: Any) -> Metric:
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, *args, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError(f"Metric {name} is already registered as a {metric.type}")
+        return metric
+
+    def counter(
+        self, name: str, description: str, label_names: Sequence[str] = ()
+    ) -> Counter:
+        return self._get_or_create(Counter, name, description, label_names)
+
+    def histogram(
+        self,
+        name: str,
+        description: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = METRICS_LATENCY_BUCKETS_MS,
+    ) -> Histogram:
+        return self._get_or_create(Histogram, name, description, label_names, buckets)
+
+    def collect(self) -> Iterable[Metric]:
+        return self.metrics.values()
+
+    def merge(self, other: MetricsRegistry) -> None:
+        """Add the values of the metrics of another registry to this one, e.g. those collected by a worker process"""
+        self.start_time = min(self.start_time, other.start_time)
+        for metric in other.collect():
+            if isinstance(metric, Counter):
+                counter = self.counter(metric.name, metric.description, metric.label_names)
+                for key, value in metric.values.items():
+                    counter.values[key] = counter.values.get(key, 0) + value
+            elif isinstance(metric, Histogram):
+                histogram = self.histogram(
+                    metric.name, metric.description, metric.label_names, metric.buckets
+                )
+                if histogram.buckets != metric.buckets:
+                    raise ValueError(f"Histogram {metric.name} has different buckets")
+                for key, value in metric.values.items():
+                    merged = histogram.values.get(key)
+                    if merged is None:
+                        merged = histogram.values[key] = HistogramValue(len(histogram.buckets) + 1)
+                    for i, bucket_count in enumerate(value.bucket_counts):
+                        merged.bucket_counts[i] += bucket_count
+                    merged.sum += value.sum
+                    merged.count += value.count
+
+
+_metrics_registry = MetricsRegistry()
+
+
+def get_metrics_registry() -> MetricsRegistry:
+    return _metrics_registry
+
+
+def reset_metrics_registry(registry: MetricsRegistry = None) -> MetricsRegistry:
+    """Replace the metrics registry, e.g. at the start of a batch, and return the new registry"""
+    global _metrics_registry
+    _metrics_registry = registry or MetricsRegistry()
+    return _metrics_registry
+
+
+def format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return (
+        "{"
+        + ",".join(
+            f'{name}="{escape_label_value(value)}"' for name, value in labels.items()
+        )
+        + "}"
+    )
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_number(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def to_prometheus(registry: MetricsRegistry = None) -> str:
+    """Render the metrics of a registry in the Prometheus text exposition format"""
+    registry = registry or get_metrics_registry()
+    lines = []
+    for metric in registry.collect():
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        if isinstance(metric, Counter):
+            for label_values, value in metric.values.items():
+                labels = format_labels(metric.get_labels(label_values))
+                lines.append(f"{metric.name}{labels} {format_number(value)}")
+        elif isinstance(metric, Histogram):
+            for label_values, histogram in metric.values.items():
+                labels = metric.get_labels(label_values)
+                cumulative = 0
+                for bound, bucket_count in zip(
+                    (*metric.buckets, math.inf), histogram.bucket_counts
+                ):
+                    cumulative += bucket_count
+                    bucket_labels = format_labels({**labels, "le": format_number(bound)})
+                    lines.append(f"{metric.name}_bucket{bucket_labels} {cumulative}")
+                lines.append(
+                    f"{metric.name}_sum{format_labels(labels)} {format_number(histogram.sum)}"
+                )
+                lines.append(f"{metric.name}_count{format_labels(labels)} {histogram.count}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path: str, registry: MetricsRegistry = None) -> None:
+    """Write the metrics of a registry to a file in the Prometheus text format, e.g. for the node exporter's textfile
+    collector. The file is replaced atomically, so a scrape never sees a partial file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(to_prometheus(registry))
+    os.replace(tmp_path, path)
+
+
+class CloudMonitoringExporter:
+    """Exports the metrics of a registry to Cloud Monitoring as custom metrics, in batches of time series.
+
+    Counters are exported as cumulative values and histograms as cumulative distributions, both since the start of
+    the registry. The client is any object with a `create_time_series(request=...)` method taking a request dict,
+    such as `google.cloud.monitoring_v3.MetricServiceClient`, which is created if no client is given.
+    """
+
+    def __init__(
+        self,
+        project_id: str,
+        client: Any = None,
+        metric_prefix: str = CLOUD_MONITORING_METRIC_PREFIX,
+        resource: dict[str, Any] = None,
+    ):
+        if client is None:
+            # only import the Cloud Monitoring client when exporting to it, since it is slow to import
+            from google.cloud import monitoring_v3
+
+            client = monitoring_v3.MetricServiceClient()
+        self.project_id = project_id
+        self.client = client
+        self.metric_prefix = metric_prefix
+        self.resource = resource or {"type": "global", "labels": {"project_id": project_id}}
+
+    def get_time_series(self, registry: MetricsRegistry = None) -> list[dict[str, Any]]:
+        registry = registry or get_metrics_registry()
+        now = time()
+        interval = {
+            "start_time": {
+                "seconds": int(registry.start_time),
+                "nanos": int(registry.start_time % 1 * 1e9),
+            },
+            "end_time": {"seconds": int(now), "nanos": int(now % 1 * 1e9)},
+        }
+        time_series = []
+        for metric in registry.collect():
+            for label_values, value in metric.values.items():
+                if isinstance(metric, Counter):
+                    point_value, value_type = {"double_value": float(value)}, "DOUBLE"
+                else:
+                    point_value, value_type = {
+                        "distribution_value": {
+                            "count": value.count,
+                            "mean": value.sum / value.count if value.count else 0.0,
+                            "bucket_options": {
+                                "explicit_buckets": {"bounds": list(metric.buckets)}
+                            },
+                            "bucket_counts": list(value.bucket_counts),
+                        }
+                    }, "DISTRIBUTION"
+                time_series.append(
+                    {
+                        "metric": {
+                            "type": f"{self.metric_prefix}/{metric.name}",
+                            "labels": metric.get_labels(label_values),
+                        },
+                        "resource": self.resource,
+                        "metric_kind": "CUMULATIVE",
+                        "value_type": value_type,
+                        "points": [{"interval": interval, "value": point_value}],
+                    }
+                )
+        return time_series
+
+    def export(self, registry: MetricsRegistry = None) -> int:
+        """Write the current values of all metrics, and return the number of time series written"""
+        time_series = self.get_time_series(registry)
+        for i in range(0, len(time_series), CLOUD_MONITORING_MAX_TIME_SERIES_PER_REQUEST):
+            self.client.create_time_series(
+                request={
+                    "name": f"projects/{self.project_id}",
+                    "time_series": time_series[
+                        i : i + CLOUD_MONITORING_MAX_TIME_SERIES_PER_REQUEST
+                    ],
+                }
+            )
+        logger.info(
+            f"Exported {len(time_series)} time series to Cloud Monitoring project {self.project_id}"
+        )
+        return len(time_series)
@@ -0,0 +1,199 @@
+"""Opt-in profiling of the event loop that all conversations of a batch share.
+
+CPU work such as tag parsing, word logprobs, prompt rendering and log formatting runs inline on the loop, so when it
+adds up the loop itself, rather than the API, becomes the bottleneck. Three tools show when and where that happens:
+
+- `LoopLagMonitor` measures how late the loop runs a callback scheduled at a fixed interval, i.e. how long
+  callbacks wait for the loop, as the `event_loop_lag_ms` histogram.
+- `timed` wraps a synchronous hot path and records its duration as the `function_duration_ms` histogram, labeled
+  by function. Timers cost a flag check per call until they are enabled with `set_timers_enabled`.
+- `SamplingProfiler` samples the stack of the loop's thread from a background thread and writes the counts of
+  each stack in the collapsed format that flamegraph.pl, speedscope and similar tools read.
+
+Usage:
+    set_timers_enabled(True)
+    async with LoopLagMonitor():
+        with SamplingProfiler("profile.folded"):
+            ...
+"""
+from __future__ import annotations
+
+import asyncio
+import functools
+import logging
+import os
+import sys
+import threading
+from collections import Counter
+from time import perf_counter
+from types import FrameType
+from typing import Callable
+from typing import TypeVar
+
+from api.metrics import get_metrics_registry
+from api.metrics import Histogram
+from constants import FUNCTION_DURATION_BUCKETS_MS
+from constants import LOOP_LAG_BUCKETS_MS
+from constants import LOOP_LAG_INTERVAL
+from constants import LOOP_LAG_WARNING_MS
+from constants import PROFILER_SAMPLE_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+F = TypeVar("F", bound=Callable)
+
+_timers_enabled = False
+
+
+def get_timers_enabled() -> bool:
+    return _timers_enabled
+
+
+def set_timers_enabled(enabled: bool) -> None:
+    """Enable or disable recording the duration of functions wrapped with `timed`"""
+    global _timers_enabled
+    _timers_enabled = enabled
+
+
+def timed(func: F) -> F:
+    """Record the duration of each call of a synchronous function in the `function_duration_ms` histogram while
+    timers are enabled"""
+    name = f"{func.__module__}.{func.__qualname__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _timers_enabled:
+            return func(*args, **kwargs)
+        t0 = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            get_metrics_registry().histogram(
+                "function_duration_ms",
+                "Time spent in hot-path functions on the event loop",
+                ["function"],
+                buckets=FUNCTION_DURATION_BUCKETS_MS,
+            ).observe((perf_counter() - t0) * 1000, function=name)
+
+    return wrapper
+
+
+class LoopLagMonitor:
+    """Measures the lag of the running event loop: a probe sleeps for `interval` seconds at a time, and any time
+    beyond that until it runs again was spent waiting for other callbacks to yield the loop.
+
+    Attributes
+    ----------
+    interval : float
+        seconds between probes
+    max_lag : float
+        the largest lag seen, in ms
+    histogram : Optional[Histogram]
+        the lags seen, once the monitor is started
+    """
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.max_lag = 0.0
+        self.histogram: Histogram | None = None
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self.histogram = get_metrics_registry().histogram(
+            "event_loop_lag_ms",
+            "Delay of callbacks scheduled on the event loop beyond their due time",
+            buckets=LOOP_LAG_BUCKETS_MS,
+        )
+        self._task = asyncio.create_task(self._probe(), name="loop-lag-monitor")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _probe(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            t0 = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - t0 - self.interval, 0.0) * 1000
+            self.histogram.observe(lag)
+            if lag > self.max_lag:
+                self.max_lag = lag
+            if lag > LOOP_LAG_WARNING_MS:
+                logger.warning(f"Event loop blocked for <loopLag:{lag:.2f}ms>")
+
+    async def __aenter__(self) -> LoopLagMonitor:
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.stop()
+
+
+def get_frame_label(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Samples the stack of a thread (by default, the one that starts the profiler, i.e. the event loop's) every
+    `interval` seconds from a background thread, and writes the count of each sampled stack to `path` in the
+    collapsed format, one `outermost;...;innermost count` line per stack. Samples of an idle loop end in the
+    selector's `select`.
+
+    The sampler holds the GIL while it walks a stack, so the overhead grows as the interval shrinks; the default of
+    5ms costs a few percent.
+    """
+
+    def __init__(self, path: str, interval: float = PROFILER_SAMPLE_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self._thread_id: int | None = None
+        self._stop = threading.Event()
+        self._sampler: threading.Thread | None = None
+
+    def start(self, thread_id: int = None) -> None:
+        self._thread_id = thread_id or threading.get_ident()
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sample, name="sampling-profiler", daemon=True)
+        self._sampler.start()
+
+    def stop(self) -> None:
+        """Stop sampling and write the collapsed stacks"""
+        if self._sampler is None:
+            return
+        self._stop.set()
+        self._sampler.join()
+        self._sampler = None
+        self.write()
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)  # pylint: disable=protected-access
+            stack = []
+            while frame is not None:
+                stack.append(get_frame_label(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self) -> None:
+        with open(self.path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        logger.info(
+            f"Wrote {sum(self.stacks.values())} stack samples ({len(self.stacks)} stacks) to {self.path}"
+        )
+
+    def __enter__(self) -> SamplingProfiler:
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
@@ -0,0 +1,176 @@
+"""Client-side admission control that paces requests to stay under the per-model rate limits of the OpenAI API"""
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import logging
+import multiprocessing
+from multiprocessing.context import BaseContext
+from time import monotonic
+from typing import MutableSequence
+from weakref import WeakKeyDictionary
+
+from constants import OPENAI_MODEL_RATE_LIMITS
+from constants import RATE_LIMIT_WAIT_WARNING
+
+logger = logging.getLogger(__name__)
+
+# rate limiters are shared by all requests made from the same event loop
+_rate_limiters: WeakKeyDictionary[
+    asyncio.AbstractEventLoop, dict[str, RateLimiter]
+] = WeakKeyDictionary()
+# rate limit budget shared with other processes, e.g. the worker processes of a batch
+_shared_rate_limits: SharedRateLimits | None = None
+
+
+class TokenBucket:
+    """A bucket holding up to `capacity` units that continuously refills at `capacity` units per minute.
+
+    The level of the bucket and the time it was last refilled are kept in `state`, which is a shared memory array
+    for a bucket shared between processes.
+    """
+
+    def __init__(self, capacity: float, state: MutableSequence[float] = None):
+        self.capacity = float(capacity)
+        self.refill_rate = self.capacity / 60
+        self.state = state if state is not None else [self.capacity, monotonic()]
+
+    @property
+    def level(self) -> float:
+        return self.state[0]
+
+    @level.setter
+    def level(self, level: float) -> None:
+        self.state[0] = level
+
+    @property
+    def updated_at(self) -> float:
+        return self.state[1]
+
+    @updated_at.setter
+    def updated_at(self, updated_at: float) -> None:
+        self.state[1] = updated_at
+
+    def refill(self, now: float) -> None:
+        self.level = min(
+            self.capacity, self.level + (now - self.updated_at) * self.refill_rate
+        )
+        self.updated_at = now
+
+    def time_until_available(self, amount: float) -> float:
+        """Seconds until the bucket holds `amount` units; the bucket must be refilled first"""
+        return max(0.0, (amount - self.level) / self.refill_rate)
+
+    def consume(self, amount: float) -> None:
+        self.level -= amount
+
+    def release(self, amount: float) -> None:
+        self.level = min(self.capacity, self.level + amount)
+
+
+class SharedRateLimits:
+    """The rate limit budget of all models with rate limits, shared by processes such as the worker processes of a
+    batch: the state of the request and token buckets of each model in shared memory, guarded by one lock.
+
+    It is created in the parent process and passed to the child processes when they are started, where it is used
+    by the rate limiters created after `set_shared_rate_limits`. The buckets are refilled by the monotonic clock,
+    which is system-wide, so all processes agree on their level.
+    """
+
+    def __init__(self, context: BaseContext = multiprocessing):
+        self.lock = context.Lock()
+        now = monotonic()
+        self.states = {
+            model: (
+                context.Array("d", [limits["rpm"], now], lock=False),
+                context.Array("d", [limits["tpm"], now], lock=False),
+            )
+            for model, limits in OPENAI_MODEL_RATE_LIMITS.items()
+        }
+
+
+class RateLimiter:
+    """Paces requests for a single model using one token bucket for requests and one for tokens.
+
+    Each request must acquire budget for one request plus its estimated token cost (prompt + max_tokens) before it
+    is sent. Waiters are admitted in FIFO order so that a large request is never starved by a stream of small ones.
+    With `shared` rate limits, the buckets are shared with the rate limiters of other processes; requests are then
+    admitted in FIFO order within each process.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: int,
+        tokens_per_minute: int,
+        model: str = None,
+        shared: SharedRateLimits = None,
+    ):
+        self.model = model
+        requests_state, tokens_state = shared.states[model] if shared else (None, None)
+        self.requests = TokenBucket(requests_per_minute, requests_state)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_state)
+        self._lock = asyncio.Lock()
+        # only held to update the buckets, so blocking the event loop on it is brief
+        self._shared_lock = shared.lock if shared else contextlib.nullcontext()
+
+    async def acquire(self, num_tokens: int) -> float:
+        """Wait until budget is available for a request costing `num_tokens` tokens and consume it.
+
+        Returns
+        -------
+        float
+            seconds spent waiting for budget
+        """
+        num_tokens = min(num_tokens, self.tokens.capacity)
+        t0 = monotonic()
+        async with self._lock:
+            while True:
+                with self._shared_lock:
+                    now = monotonic()
+                    self.requests.refill(now)
+                    self.tokens.refill(now)
+                    wait = max(
+                        self.requests.time_until_available(1),
+                        self.tokens.time_until_available(num_tokens),
+                    )
+                    if wait <= 0:
+                        self.requests.consume(1)
+                        self.tokens.consume(num_tokens)
+                        break
+                await asyncio.sleep(wait)
+        waited = monotonic() - t0
+        if waited > RATE_LIMIT_WAIT_WARNING:
+            logger.warning(
+                f"Waited {waited:.2f}s for rate limit budget of {num_tokens} tokens for model {self.model}"
+            )
+        return waited
+
+    def release(self, num_tokens: int) -> None:
+        """Return unused token budget, e.g. when a completion used fewer tokens than max_tokens or a request got no
+        response"""
+        if num_tokens > 0:
+            with self._shared_lock:
+                self.tokens.release(num_tokens)
+
+
+def get_rate_limiter(model: str) -> RateLimiter | None:
+    """Return the rate limiter shared by all requests to `model` on the running event loop, or None if no rate
+    limits are configured for the model. Its budget is also shared with other processes if shared rate limits are
+    set."""
+    limits = OPENAI_MODEL_RATE_LIMITS.get(model)
+    if limits is None:
+        return None
+
+    loop_rate_limiters = _rate_limiters.setdefault(asyncio.get_running_loop(), {})
+    if model not in loop_rate_limiters:
+        loop_rate_limiters[model] = RateLimiter(
+            limits["rpm"], limits["tpm"], model, _shared_rate_limits
+        )
+    return loop_rate_limiters[model]
+
+
+def set_shared_rate_limits(shared: SharedRateLimits | None) -> None:
+    """Share the budget of rate limiters created from now on with other processes, so that processes sharing an API
+    key together stay under its limits, or stop sharing it with None"""
+    global _shared_rate_limits
+    _shared_rate_limits = shared
@@ -0,0 +1,115 @@
+"""Record-and-replay layer for requests made through `api.utils.post_request`.
+
+In record mode every request/response pair is appended to a cassette file (JSONL). In replay mode requests are
+served from the cassette instead of the network: identical requests are answered with their recorded responses in
+the order they were recorded, so a replayed run is deterministic and never touches the API.
+"""
+from __future__ import annotations
+
+import base64
+import json
+import logging
+from collections import defaultdict
+from collections import deque
+from typing import Any
+
+from multidict import CIMultiDict
+
+from api.cache import get_request_key
+
+logger = logging.getLogger(__name__)
+
+_cassette: Cassette | None = None
+
+
+class CassetteMode:
+    RECORD = "record"
+    REPLAY = "replay"
+
+
+class CassetteMissError(Exception):
+    """Raised in replay mode for a request that isn't in the cassette"""
+
+
+class Cassette:
+    """A file of recorded request/response pairs"""
+
+    def __init__(self, path: str, mode: str = CassetteMode.REPLAY):
+        if mode not in {CassetteMode.RECORD, CassetteMode.REPLAY}:
+            raise ValueError(f"Invalid cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self._file = None
+        self._responses: dict[str, deque[tuple[int, dict[str, str], Any]]] = defaultdict(deque)
+
+        if mode == CassetteMode.RECORD:
+            self._file = open(path, "a", encoding="utf-8")
+        else:
+            self._load()
+
+    def _load(self) -> None:
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                interaction = json.loads(line)
+                data = interaction["data"]
+                if interaction.get("isBinary"):
+                    data = base64.b64decode(data)
+                self._responses[interaction["key"]].append(
+                    (interaction["status"], interaction["headers"], data)
+                )
+        logger.info(
+            f"Loaded {sum(map(len, self._responses.values()))} recorded responses from {self.path}"
+        )
+
+    def record(
+        self,
+        url: str,
+        data: Any,
+        status: int,
+        headers: dict[str, str],
+        response_data: Any,
+    ) -> None:
+        is_binary = isinstance(response_data, bytes)
+        interaction = {
+            "key": get_request_key(url, data),
+            "url": url,
+            "request": data,
+            "status": status,
+            "headers": dict(headers),
+            # binary bodies (e.g. audio) are stored as base64, since they needn't be valid UTF-8
+            "data": base64.b64encode(response_data).decode("ascii")
+            if is_binary
+            else response_data,
+            "isBinary": is_binary,
+        }
+        self._file.write(json.dumps(interaction, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def replay(self, url: str, data: Any) -> tuple[int, CIMultiDict[str], Any]:
+        """Return the status, headers and body recorded for a request. Repeated identical requests are answered
+        with the recorded responses in order, and with the last one once they run out. Headers are returned
+        case-insensitive, like those of a live response."""
+        responses = self._responses.get(get_request_key(url, data))
+        if not responses:
+            raise CassetteMissError(f"No recorded response for request to {url}")
+        status, headers, response_data = (
+            responses.popleft() if len(responses) > 1 else responses[0]
+        )
+        return status, CIMultiDict(headers), response_data
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def get_cassette() -> Cassette | None:
+    return _cassette
+
+
+def set_cassette(cassette: Cassette | None) -> None:
+    """Set the cassette that all requests are recorded to or replayed from, or disable recording with None"""
+    global _cassette
+    _cassette = cassette
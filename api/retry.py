@@ -0,0 +1,181 @@
+"""Retry policy for requests to the OpenAI API: decorrelated-jitter exponential backoff that honors the server's
+rate limit reset headers, and a retry budget shared by a whole batch so that an outage doesn't multiply load."""
+from __future__ import annotations
+
+import math
+import random
+import re
+from dataclasses import dataclass
+from dataclasses import field
+from email.utils import parsedate_to_datetime
+from time import time
+
+RETRYABLE_STATUSES = frozenset({-1, 408, 409, 429, 500, 502, 503, 504})
+RETRYABLE_ERROR_TYPES = frozenset(
+    {"server_error", "tokens", "requests", "TimeoutError", "ClientConnectorError"}
+)
+# error types of requests that failed to connect to the API, so that the API never received them
+CONNECTION_ERROR_TYPES = frozenset(
+    {
+        "ClientConnectorError",
+        "ClientConnectorDNSError",
+        "ClientConnectorSSLError",
+        "ClientConnectorCertificateError",
+        "ClientProxyConnectionError",
+        "ConnectionTimeoutError",
+    }
+)
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+class CompletionError(Exception):
+    """Raised when a completion request fails with a non-retryable error or runs out of retries"""
+
+    def __init__(
+        self,
+        message: str,
+        error_type: str = None,
+        status: int = None,
+        num_attempts: int = 0,
+    ):
+        super().__init__(message)
+        self.error_type = error_type
+        self.status = status
+        self.num_attempts = num_attempts
+
+
+@dataclass
+class RetryBudget:
+    """Limits retries to a fraction of all requests made. Every request deposits `ratio` retries into the budget
+    (up to `max_balance`) and every retry withdraws one, so that once a provider starts failing most requests the
+    retries stop instead of multiplying the load.
+
+    Attributes
+    ----------
+    ratio : float
+        number of retries earned by each request
+    min_balance : float
+        retries available before any request has been made
+    max_balance : float
+        maximum number of retries that can be saved up
+    """
+
+    ratio: float = 0.2
+    min_balance: float = 10
+    max_balance: float = 1000
+    balance: float = field(init=False)
+
+    def __post_init__(self):
+        self.balance = self.min_balance
+
+    def deposit(self) -> None:
+        self.balance = min(self.max_balance, self.balance + self.ratio)
+
+    def try_withdraw(self) -> bool:
+        if self.balance < 1:
+            return False
+        self.balance -= 1
+        return True
+
+
+_retry_budget = RetryBudget()
+
+
+def get_retry_budget() -> RetryBudget:
+    return _retry_budget
+
+
+def reset_retry_budget(budget: RetryBudget = None) -> RetryBudget:
+    """Start a new retry budget, e.g. at the start of a batch"""
+    global _retry_budget
+    _retry_budget = budget or RetryBudget()
+    return _retry_budget
+
+
+def parse_duration(value: str) -> float | None:
+    """Parse a duration such as `1s`, `6m0s` or `20ms` as returned in the `x-ratelimit-reset-*` headers"""
+    parts = DURATION_PATTERN.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def parse_seconds(value: str) -> float | None:
+    """Parse a non-negative, finite number of seconds (or milliseconds), or return None if it's malformed"""
+    try:
+        seconds = float(value)
+    except ValueError:
+        return None
+    return seconds if math.isfinite(seconds) and seconds >= 0 else None
+
+
+def parse_retry_after(value: str) -> float | None:
+    """Parse a Retry-After header given either in seconds or as an HTTP date"""
+    seconds = parse_seconds(value)
+    if seconds is not None:
+        return seconds
+    try:
+        return parsedate_to_datetime(value).timestamp() - time()
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """Decides whether and how long to wait before retrying a failed request.
+
+    Attributes
+    ----------
+    max_attempts : int
+        maximum number of attempts, including the first one
+    base_delay : float
+        minimum delay between attempts in seconds
+    max_delay : float
+        maximum delay between attempts in seconds
+    """
+
+    max_attempts: int = 5
+    base_delay: float = 1.0
+    max_delay: float = 60.0
+
+    def is_retryable(self, status: int, error_type: str = None) -> bool:
+        return status in RETRYABLE_STATUSES or error_type in RETRYABLE_ERROR_TYPES
+
+    def get_backoff(self, prev_delay: float) -> float:
+        """Decorrelated jitter: a random delay between the base delay and three times the previous delay"""
+        return min(
+            self.max_delay,
+            random.uniform(self.base_delay, max(self.base_delay, prev_delay * 3)),
+        )
+
+    @staticmethod
+    def get_server_delay(headers: dict[str, str], error_type: str = None) -> float | None:
+        """Return the delay requested by the server through the Retry-After or rate limit reset headers"""
+        retry_after_ms = parse_seconds(headers.get("retry-after-ms", ""))
+        if retry_after_ms is not None:
+            return retry_after_ms / 1000
+        retry_after = parse_retry_after(headers.get("Retry-After", ""))
+        if retry_after is not None:
+            return retry_after
+
+        resets = {
+            kind: parse_duration(headers.get(f"x-ratelimit-reset-{kind}", ""))
+            for kind in ["requests", "tokens"]
+        }
+        if resets.get(error_type) is not None:
+            return resets[error_type]
+        return max((reset for reset in resets.values() if reset is not None), default=None)
+
+    def get_delay(
+        self, prev_delay: float, headers: dict[str, str], error_type: str = None
+    ) -> float:
+        """Return the delay before the next attempt: the jittered backoff, or longer if the server asks for it"""
+        delay = self.get_backoff(prev_delay)
+        server_delay = self.get_server_delay(headers, error_type)
+        if server_delay is not None:
+            delay = max(delay, server_delay)
+        return min(delay, self.max_delay)
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
@@ -0,0 +1,328 @@
+"""A local stub of the OpenAI completions API, for exercising and load testing the pipeline offline.
+
+The stub serves `/v1/completions` and `/v1/chat/completions`, streamed as server-sent events when requested, with
+configurable latency, error rates and rate limit responses. Prompt prefix caching is simulated by reporting the
+tokens of the longest prefix of whole messages (or prompt lines) seen in an earlier request as cached. Chat completions follow the YAML schema given in the
+system message, so that lesson prompts and user profiles get well-formed responses for all their tags.
+
+Usage:
+    python -m api.stub_server --port 8080 --latency-ms 400 --error-rate 0.01
+    OPENAI_URL=http://localhost:8080 python -m batch --input scenarios.jsonl --output conversations.jsonl
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import random
+import re
+from dataclasses import dataclass
+from typing import Any
+
+from aiohttp import web
+
+from constants import END_CONVERSATION_TAG
+
+SCHEMA_PATTERN = re.compile(r"```yaml\n(.*?)```", re.DOTALL)
+TOKEN_PATTERN = re.compile(r"\s?\S+|\s")
+STUB_PROMPT_CACHE_MAX_ENTRIES = 100000
+WORDS = [
+    "hola", "café", "gracias", "por", "favor", "quiero", "un", "una", "con", "leche", "pastel", "sí",
+    "claro", "cuánto", "es", "muy", "bien", "para", "mi", "equipo", "y", "también", "de", "nada",
+]
+
+
+@dataclass
+class StubConfig:
+    """Behavior of the stub server
+
+    Attributes
+    ----------
+    latency_ms : float
+        median response latency in ms
+    latency_distribution : str
+        `fixed`, `uniform` (between 0 and twice the median) or `lognormal`
+    latency_sigma : float
+        shape of the lognormal latency distribution
+    error_rate : float
+        fraction of requests that fail with a 500 server error
+    rate_limit_rate : float
+        fraction of requests that are rejected with a 429 rate limit error
+    rate_limit_reset_ms : float
+        the reset time reported in the headers of rate limited responses
+    end_probability : float
+        probability that the end-conversation tag of a response is True
+    response_words : int
+        number of words in each response, before truncation to max_tokens
+    token_latency_ms : float
+        delay before each token of a streamed response, in ms
+    seed : int
+        seed for all random behavior
+    """
+
+    latency_ms: float = 500
+    latency_distribution: str = "lognormal"
+    latency_sigma: float = 0.5
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    rate_limit_reset_ms: float = 1000
+    end_probability: float = 0.1
+    response_words: int = 12
+    token_latency_ms: float = 20
+    seed: int = None
+
+
+class StubCompletionServer:
+    def __init__(self, config: StubConfig):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.num_requests = 0
+        self.prompt_prefixes: set[int] = set()  # hashes of the message or line prefixes of earlier prompts
+
+    def get_latency(self) -> float:
+        """Return a latency in seconds drawn from the configured distribution"""
+        median = self.config.latency_ms / 1000
+        if self.config.latency_distribution == "fixed":
+            return median
+        if self.config.latency_distribution == "uniform":
+            return self.random.uniform(0, 2 * median)
+        return self.random.lognormvariate(0, self.config.latency_sigma) * median
+
+    def get_sentence(self, max_tokens: int) -> tuple[str, str]:
+        """Return a random sentence and the finish reason, truncating the sentence to max_tokens words"""
+        words = self.random.choices(WORDS, k=self.config.response_words)
+        if max_tokens and len(words) > max_tokens:
+            return " ".join(words[:max_tokens]), "length"
+        return " ".join(words), "stop"
+
+    def get_cached_prompt_tokens(self, parts: list[str]) -> int:
+        """Return the number of tokens in the longest prefix of the prompt parts seen in an earlier request, and
+        remember all prefixes of this prompt"""
+        if len(self.prompt_prefixes) > STUB_PROMPT_CACHE_MAX_ENTRIES:
+            self.prompt_prefixes.clear()
+        num_cached_tokens, num_tokens, prefix_hash, cached = 0, 0, 0, True
+        for part in parts:
+            prefix_hash = hash((prefix_hash, part))
+            num_tokens += len(part.split())
+            if cached and prefix_hash in self.prompt_prefixes:
+                num_cached_tokens = num_tokens
+            else:
+                cached = False
+                self.prompt_prefixes.add(prefix_hash)
+        return num_cached_tokens
+
+    def get_end_conversation_value(self) -> str:
+        return str(self.random.random() < self.config.end_probability)
+
+    def get_logprobs(self, text: str) -> dict[str, Any]:
+        tokens = TOKEN_PATTERN.findall(text)
+        return {
+            "tokens": tokens,
+            "token_logprobs": [self.random.uniform(-0.1, 0) for _ in tokens],
+        }
+
+    async def handle_request(
+        self, request: web.Request, completion_type: str
+    ) -> web.Response:
+        body = await request.json()
+        self.num_requests += 1
+        await asyncio.sleep(self.get_latency())
+
+        roll = self.random.random()
+        if roll < self.config.rate_limit_rate:
+            reset = f"{self.config.rate_limit_reset_ms:.0f}ms"
+            return web.json_response(
+                {"error": {"type": "requests", "message": "Rate limit reached for requests"}},
+                status=429,
+                headers={
+                    "Retry-After": f"{self.config.rate_limit_reset_ms / 1000:.3f}",
+                    "x-ratelimit-reset-requests": reset,
+                    "x-ratelimit-reset-tokens": reset,
+                },
+            )
+        if roll < self.config.rate_limit_rate + self.config.error_rate:
+            return web.json_response(
+                {"error": {"type": "server_error", "message": "The server had an error"}},
+                status=500,
+            )
+
+        if completion_type == "chat":
+            choice, num_prompt_tokens = self.get_chat_choice(body)
+            num_cached_tokens = self.get_cached_prompt_tokens(
+                [m["content"] for m in body["messages"]]
+            )
+        else:
+            choice, num_prompt_tokens = self.get_text_choice(body)
+            num_cached_tokens = self.get_cached_prompt_tokens(body["prompt"].split("\n"))
+        text = choice["message"]["content"] if "message" in choice else choice["text"]
+        num_completion_tokens = len(TOKEN_PATTERN.findall(text))
+        usage = {
+            "prompt_tokens": num_prompt_tokens,
+            "completion_tokens": num_completion_tokens,
+            "total_tokens": num_prompt_tokens + num_completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": num_cached_tokens},
+        }
+        headers = {
+            "Openai-Processing-Ms": f"{self.get_latency() * 1000:.0f}",
+            "x-ratelimit-remaining-requests": "1000",
+            "x-ratelimit-remaining-tokens": "100000",
+        }
+
+        if body.get("stream"):
+            return await self.stream_choice(request, body, completion_type, choice, usage, headers)
+
+        return web.json_response(
+            {
+                "object": f"{completion_type}.completion",
+                "model": body.get("model"),
+                "choices": [{"index": 0, **choice}],
+                "usage": usage,
+            },
+            headers=headers,
+        )
+
+    async def stream_choice(
+        self,
+        request: web.Request,
+        body: dict[str, Any],
+        completion_type: str,
+        choice: dict[str, Any],
+        usage: dict[str, int],
+        headers: dict[str, str],
+    ) -> web.StreamResponse:
+        """Stream a choice as server-sent events, one token per event, spread over the configured token latency"""
+        response = web.StreamResponse(
+            headers={**headers, "Content-Type": "text/event-stream", "Cache-Control": "no-cache"}
+        )
+        await response.prepare(request)
+
+        async def send(chunk: dict[str, Any]) -> None:
+            event = {"object": f"{completion_type}.completion.chunk", "model": body.get("model"), **chunk}
+            await response.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+        if completion_type == "chat":
+            await send({"choices": [{"index": 0, "delta": {"role": "assistant"}, "finish_reason": None}]})
+            text = choice["message"]["content"]
+        else:
+            text = choice["text"]
+
+        for token in TOKEN_PATTERN.findall(text):
+            await asyncio.sleep(self.config.token_latency_ms / 1000)
+            content = {"delta": {"content": token}} if completion_type == "chat" else {"text": token}
+            await send({"choices": [{"index": 0, **content, "finish_reason": None}]})
+
+        final_choice = {"index": 0, "finish_reason": choice["finish_reason"]}
+        final_choice.update({"delta": {}} if completion_type == "chat" else {"text": ""})
+        await send({"choices": [final_choice]})
+        if (body.get("stream_options") or {}).get("include_usage"):
+            await send({"choices": [], "usage": usage})
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    def get_chat_choice(self, body: dict[str, Any]) -> tuple[dict[str, Any], int]:
+        """Respond in the YAML schema found in the system message, or with a plain sentence if there is none"""
+        messages = body["messages"]
+        schemas = SCHEMA_PATTERN.findall(messages[0]["content"]) if messages else []
+        sentence, finish_reason = self.get_sentence(body.get("max_tokens"))
+
+        if schemas:
+            lines = []
+            for line in schemas[-1].strip().splitlines():
+                tag = line.split(":")[0]
+                value = (
+                    self.get_end_conversation_value()
+                    if tag == END_CONVERSATION_TAG
+                    else sentence
+                )
+                lines.append(f"{tag}: {value}")
+            content = "```yaml\n" + "\n".join(lines) + "\n```"
+        else:
+            content = sentence
+
+        num_prompt_tokens = sum(len(m["content"].split()) for m in messages)
+        return {
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": finish_reason,
+        }, num_prompt_tokens
+
+    def get_text_choice(self, body: dict[str, Any]) -> tuple[dict[str, Any], int]:
+        """Respond with a sentence for the primed tag, followed by the end-conversation tag"""
+        sentence, finish_reason = self.get_sentence(body.get("max_tokens"))
+        text = f" {sentence}"
+        if finish_reason == "stop":
+            text += f"\n{END_CONVERSATION_TAG}: {self.get_end_conversation_value()}"
+
+        choice = {"text": text, "finish_reason": finish_reason}
+        if body.get("logprobs"):
+            choice["logprobs"] = self.get_logprobs(text)
+        return choice, len(body["prompt"].split())
+
+
+def create_app(config: StubConfig) -> web.Application:
+    server = StubCompletionServer(config)
+
+    async def completions(request: web.Request) -> web.Response:
+        return await server.handle_request(request, "text")
+
+    async def chat_completions(request: web.Request) -> web.Response:
+        return await server.handle_request(request, "chat")
+
+    app = web.Application()
+    app["server"] = server
+    app.router.add_post("/v1/completions", completions)
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    return app
+
+
+async def start_stub_server(
+    config: StubConfig, host: str = "localhost", port: int = 8080
+) -> web.AppRunner:
+    """Start the stub server on the running event loop; stop it with `await runner.cleanup()`"""
+    runner = web.AppRunner(create_app(config))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def parse_args(argv: list[str] = None) -> argparse.Namespace:
+    defaults = StubConfig()
+    parser = argparse.ArgumentParser(description="Run a local stub of the OpenAI completions API.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency-ms", type=float, default=defaults.latency_ms)
+    parser.add_argument(
+        "--latency-distribution",
+        choices=["fixed", "uniform", "lognormal"],
+        default=defaults.latency_distribution,
+    )
+    parser.add_argument("--latency-sigma", type=float, default=defaults.latency_sigma)
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate)
+    parser.add_argument("--rate-limit-rate", type=float, default=defaults.rate_limit_rate)
+    parser.add_argument("--rate-limit-reset-ms", type=float, default=defaults.rate_limit_reset_ms)
+    parser.add_argument("--end-probability", type=float, default=defaults.end_probability)
+    parser.add_argument("--response-words", type=int, default=defaults.response_words)
+    parser.add_argument("--token-latency-ms", type=float, default=defaults.token_latency_ms)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] = None) -> None:
+    args = parse_args(argv)
+    config = StubConfig(
+        latency_ms=args.latency_ms,
+        latency_distribution=args.latency_distribution,
+        latency_sigma=args.latency_sigma,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        rate_limit_reset_ms=args.rate_limit_reset_ms,
+        end_probability=args.end_probability,
+        response_words=args.response_words,
+        token_latency_ms=args.token_latency_ms,
+        seed=args.seed,
+    )
+    web.run_app(create_app(config), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
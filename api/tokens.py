@@ -0,0 +1,100 @@
+"""Token counting for prompts and chat messages.
+
+The tiktoken encoding of each model is loaded once, and token counts are memoized by content, so that counting the
+prompt of a growing conversation only encodes the content that is new since the previous turn.
+"""
+from __future__ import annotations
+
+from functools import lru_cache
+from typing import Iterable
+
+import tiktoken
+
+from constants import TOKEN_COUNT_CACHE_MAX_ENTRIES
+
+DEFAULT_CHAT_MODEL = "gpt-3.5-turbo-0613"
+REPLY_PRIMER_NUM_TOKENS = 3  # every reply is primed with <|start|>assistant<|message|>
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """Return the tiktoken encoding of a model, falling back to cl100k_base for models tiktoken doesn't know"""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+@lru_cache(maxsize=None)
+def get_chat_format(model: str) -> tuple[str, int, int]:
+    """Return the model whose encoding and message format are used to count the tokens of chat messages for a model,
+    along with the number of tokens added per message and per name. Adapted from the cookbook example at
+    https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+
+    Raises
+    ------
+    NotImplementedError
+        for models whose message format is unknown
+    """
+    if model in {
+        "gpt-3.5-turbo-0613",
+        "gpt-3.5-turbo-16k-0613",
+        "gpt-4-0314",
+        "gpt-4-32k-0314",
+        "gpt-4-0613",
+        "gpt-4-32k-0613",
+    }:
+        return model, 3, 1
+    elif model == "gpt-3.5-turbo-0301":
+        # every message follows <|start|>{role/name}\n{content}<|end|>\n; if there's a name, the role is omitted
+        return model, 4, -1
+    elif "gpt-3.5-turbo" in model:
+        return get_chat_format("gpt-3.5-turbo-0613")
+    elif "gpt-4" in model:
+        return get_chat_format("gpt-4-0613")
+    elif "gpt-dv-speak" in model:
+        return get_chat_format("gpt-4-0314")
+    raise NotImplementedError(
+        f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
+    )
+
+
+@lru_cache(maxsize=TOKEN_COUNT_CACHE_MAX_ENTRIES)
+def _count_tokens(encoding_name: str, text: str) -> int:
+    return len(tiktoken.get_encoding(encoding_name).encode(text))
+
+
+def count_tokens(text: str, model: str) -> int:
+    """Return the number of tokens in a string, memoized by content"""
+    return _count_tokens(get_encoding(model).name, text)
+
+
+def count_prompt_tokens(prompt: str, model: str) -> int:
+    """Return the number of tokens in a multi-line prompt, counted line by line so that only lines that weren't
+    counted before are encoded. Tokens can't merge across the split lines, so the count is an upper bound that is
+    at most a few tokens over the exact count."""
+    encoding_name = get_encoding(model).name
+    lines = prompt.split("\n")
+    return len(lines) - 1 + sum(_count_tokens(encoding_name, line) for line in lines)
+
+
+def count_message_tokens(message: dict[str, str], model: str = DEFAULT_CHAT_MODEL) -> int:
+    """Return the number of tokens a chat message adds to a request, including the tokens that delimit it"""
+    format_model, tokens_per_message, tokens_per_name = get_chat_format(model)
+    encoding_name = get_encoding(format_model).name
+    num_tokens = tokens_per_message
+    for key, value in message.items():
+        num_tokens += _count_tokens(encoding_name, value)
+        if key == "name":
+            num_tokens += tokens_per_name
+    return num_tokens
+
+
+def num_tokens_from_messages(
+    messages: Iterable[dict[str, str]], model: str = DEFAULT_CHAT_MODEL
+) -> int:
+    """Return the number of tokens used by a list of messages"""
+    return (
+        sum(count_message_tokens(message, model) for message in messages)
+        + REPLY_PRIMER_NUM_TOKENS
+    )
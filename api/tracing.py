@@ -0,0 +1,330 @@
+"""Lightweight tracing of where the wall-clock time of a conversation goes.
+
+Spans are nested through a context variable, so a span opened in a coroutine is the parent of the spans opened in
+the coroutines it awaits, and of the tasks it creates. A conversation is traced as
+
+    conversation -> turn -> step.user -> completion -> rate_limit.wait / http.request / retry.sleep
+                         -> step.agent -> agent.generation -> completion -> ...
+
+with an `http.request` span per attempt of a request, numbered by its `attempt` attribute, and the waits for rate
+limit budget and between retries in between. Agent responses have an `agent.generation` span per attempt to
+generate a valid response, except the response that ends a conversation at the turn limit, which is traced from
+`completion` down. The conversation span and the spans below its turns carry the `activityId` of the conversation,
+and the step and completion spans also the `turnId` of the turn they generate. When no tracer is set, `span` returns a shared no-op context manager, so tracing
+costs nothing unless it is enabled.
+
+Finished traces are exported to Chrome trace JSON files (one per conversation, viewable offline in chrome://tracing
+or Perfetto), or kept in memory in the shape of an OTLP JSON export for tests.
+
+Usage:
+    set_tracer(Tracer([ChromeTraceExporter("traces/")]))
+    with span("conversation", scenarioId="cafe"):
+        ...
+"""
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import random
+from contextvars import ContextVar
+from time import time_ns
+from typing import Any
+from typing import ContextManager
+from typing import Iterator
+from typing import Sequence
+
+logger = logging.getLogger(__name__)
+
+TRACER_NAME = "conversation-simulator"
+
+_current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+_tracer: Tracer | None = None
+_ids = random.Random()
+_no_span = contextlib.nullcontext()
+
+
+class SpanStatus:
+    OK = "ok"
+    ERROR = "error"
+    CANCELLED = "cancelled"
+
+
+class Span:
+    """A timed operation within a trace, with attributes such as the call type or activity and turn IDs"""
+
+    __slots__ = (
+        "name",
+        "trace_id",
+        "span_id",
+        "parent_span_id",
+        "start_time_ns",
+        "end_time_ns",
+        "attributes",
+        "status",
+        "error",
+        "task_name",
+    )
+
+    def __init__(self, name: str, parent: Span | None, attributes: dict[str, Any]):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else _ids.getrandbits(128)
+        self.span_id = _ids.getrandbits(64)
+        self.parent_span_id = parent.span_id if parent else None
+        self.start_time_ns = time_ns()
+        self.end_time_ns: int | None = None
+        self.attributes = attributes
+        self.status = SpanStatus.OK
+        self.error: str | None = None
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        self.task_name = task.get_name() if task else "main"
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def record_error(self, error: BaseException) -> None:
+        """Mark the span as failed with an error, e.g. one that is handled within the span"""
+        if isinstance(error, asyncio.CancelledError):
+            self.status = SpanStatus.CANCELLED
+        else:
+            self.status, self.error = SpanStatus.ERROR, repr(error)
+
+    @property
+    def duration_ns(self) -> int:
+        return (self.end_time_ns or time_ns()) - self.start_time_ns
+
+
+class SpanExporter:
+    """Receives finished spans. `end_trace` is called once the root span of a trace has finished."""
+
+    def export_span(self, span: Span) -> None:
+        pass
+
+    def end_trace(self, trace_id: int) -> None:
+        pass
+
+    def shutdown(self) -> None:
+        pass
+
+
+class Tracer:
+    """Passes finished spans to its exporters"""
+
+    def __init__(self, exporters: Sequence[SpanExporter]):
+        self.exporters = list(exporters)
+
+    def on_end(self, span: Span) -> None:
+        for exporter in self.exporters:
+            try:
+                exporter.export_span(span)
+                if span.parent_span_id is None:
+                    exporter.end_trace(span.trace_id)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error(f"Failed to export span {span.name} with error: {e!r}")
+
+    def shutdown(self) -> None:
+        for exporter in self.exporters:
+            exporter.shutdown()
+
+
+def get_tracer() -> Tracer | None:
+    return _tracer
+
+
+def set_tracer(tracer: Tracer | None) -> None:
+    """Set the tracer that all spans are reported to, or disable tracing with None"""
+    global _tracer
+    _tracer = tracer
+
+
+def get_current_span() -> Span | None:
+    return _current_span.get()
+
+
+def start_span(name: str, **attributes: Any) -> Span | None:
+    """Start a span as a child of the current span without making it current, or return None if tracing is
+    disabled. This is for async generators, which can't hold the current span across their yields since they may be
+    closed in another context; the span is made current around the awaits between yields with `use_span`, and
+    finished with `end_span`."""
+    if _tracer is None:
+        return None
+    return Span(
+        name,
+        _current_span.get(),
+        {key: value for key, value in attributes.items() if value is not None},
+    )
+
+
+def end_span(span: Span | None, error: BaseException = None) -> None:
+    """Finish a span, with the error that ended it if any, and pass it to the tracer's exporters"""
+    if span is None:
+        return
+    if error is not None:
+        span.record_error(error)
+    span.end_time_ns = time_ns()
+    if _tracer is not None:
+        _tracer.on_end(span)
+
+
+@contextlib.contextmanager
+def use_span(span: Span | None) -> Iterator[Span | None]:
+    """Make a span current within the block, without finishing it"""
+    if span is None:
+        yield None
+        return
+    token = _current_span.set(span)
+    try:
+        yield span
+    finally:
+        _current_span.reset(token)
+
+
+@contextlib.contextmanager
+def _span(name: str, attributes: dict[str, Any]) -> Iterator[Span]:
+    current = Span(name, _current_span.get(), attributes)
+    try:
+        with use_span(current):
+            yield current
+    except BaseException as e:
+        end_span(current, e)
+        raise
+    end_span(current)
+
+
+def span(name: str, **attributes: Any) -> ContextManager[Span | None]:
+    """Open a span as a child of the current span, or a root span if there is none, and finish it when the block
+    exits. Yields None if tracing is disabled. Attributes with a None value are dropped."""
+    if _tracer is None:
+        return _no_span
+    return _span(
+        name, {key: value for key, value in attributes.items() if value is not None}
+    )
+
+
+class ChromeTraceExporter(SpanExporter):
+    """Writes each finished trace to `<directory>/<trace id>.json` in the Chrome trace event format. The spans of
+    each asyncio task are drawn on a lane of their own, so that concurrent spans (e.g. speculative candidates) don't
+    overlap."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._spans: dict[int, list[Span]] = {}
+
+    def export_span(self, span: Span) -> None:
+        self._spans.setdefault(span.trace_id, []).append(span)
+
+    def end_trace(self, trace_id: int) -> None:
+        spans = self._spans.pop(trace_id, [])
+        path = os.path.join(self.directory, f"{trace_id:032x}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_chrome_trace(spans), f, ensure_ascii=False, default=str)
+
+    @staticmethod
+    def to_chrome_trace(spans: list[Span]) -> dict[str, Any]:
+        spans = sorted(spans, key=lambda s: (s.start_time_ns, -s.duration_ns))
+        lanes: dict[str, int] = {}
+        events = []
+        for s in spans:
+            if s.task_name not in lanes:
+                lanes[s.task_name] = len(lanes) + 1
+                events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": 1,
+                        "tid": lanes[s.task_name],
+                        "args": {"name": s.task_name},
+                    }
+                )
+            events.append(
+                {
+                    "name": s.name,
+                    "cat": s.status,
+                    "ph": "X",
+                    "ts": s.start_time_ns / 1000,
+                    "dur": s.duration_ns / 1000,
+                    "pid": 1,
+                    "tid": lanes[s.task_name],
+                    "args": {**s.attributes, **({"error": s.error} if s.error else {})},
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def shutdown(self) -> None:
+        # write out traces whose root span never finished, e.g. of an interrupted batch
+        for trace_id in list(self._spans):
+            self.end_trace(trace_id)
+
+
+def to_otlp_value(value: Any) -> dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class InMemorySpanExporter(SpanExporter):
+    """Keeps finished spans in memory, e.g. to check the spans of a test run"""
+
+    def __init__(self):
+        self.spans: list[Span] = []
+
+    def export_span(self, span: Span) -> None:
+        self.spans.append(span)
+
+    def get_finished_spans(self) -> list[Span]:
+        return list(self.spans)
+
+    def clear(self) -> None:
+        self.spans.clear()
+
+    def to_otlp(self) -> dict[str, Any]:
+        """Return the finished spans in the shape of an OTLP/JSON trace export request"""
+        status_codes = {SpanStatus.OK: 1, SpanStatus.ERROR: 2, SpanStatus.CANCELLED: 2}
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {"key": "service.name", "value": {"stringValue": TRACER_NAME}}
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": TRACER_NAME},
+                            "spans": [
+                                {
+                                    "traceId": f"{s.trace_id:032x}",
+                                    "spanId": f"{s.span_id:016x}",
+                                    "parentSpanId": f"{s.parent_span_id:016x}"
+                                    if s.parent_span_id is not None
+                                    else "",
+                                    "name": s.name,
+                                    "kind": 1,  # SPAN_KIND_INTERNAL
+                                    "startTimeUnixNano": str(s.start_time_ns),
+                                    "endTimeUnixNano": str(s.end_time_ns),
+                                    "attributes": [
+                                        {"key": key, "value": to_otlp_value(value)}
+                                        for key, value in s.attributes.items()
+                                    ],
+                                    "status": {
+                                        "code": status_codes[s.status],
+                                        **({"message": s.error} if s.error else {}),
+                                    },
+                                }
+                                for s in self.spans
+                            ],
+                        }
+                    ],
+                }
+            ]
+        }
@@ -1,15 +1,69 @@
 from __future__ import annotations
 
+import asyncio
+import json
 import logging
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
 from typing import Any
+from typing import AsyncIterator
+from weakref import WeakKeyDictionary
 
 from aiohttp import ClientSession
+from aiohttp import ClientTimeout
+from aiohttp import TCPConnector
 
+from api.recording import CassetteMode
+from api.recording import get_cassette
 from constants import GLOBAL_TIMEOUT
+from constants import HTTP_CONNECTION_LIMIT
+from constants import HTTP_CONNECTION_LIMIT_PER_HOST
+from constants import HTTP_DNS_CACHE_TTL
+from constants import HTTP_KEEPALIVE_TIMEOUT
 
 logger = logging.getLogger(__name__)
-session: ClientSession | None = None  # stores aiohttp ClientSession object
+
+# one pooled aiohttp ClientSession per event loop, created lazily on first use
+_sessions: WeakKeyDictionary[
+    asyncio.AbstractEventLoop, ClientSession
+] = WeakKeyDictionary()
+
+
+def get_session() -> ClientSession:
+    """Return the pooled ClientSession for the running event loop, creating it if it doesn't exist yet"""
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        connector = TCPConnector(
+            limit=HTTP_CONNECTION_LIMIT,
+            limit_per_host=HTTP_CONNECTION_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        )
+        session = ClientSession(connector=connector)
+        _sessions[loop] = session
+    return session
+
+
+async def close_session() -> None:
+    """Close the pooled ClientSession for the running event loop, if one was created"""
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
+
+
+@asynccontextmanager
+async def managed_session() -> AsyncIterator[ClientSession]:
+    """Keep the pooled ClientSession, and its warm connections, open for the duration of a batch of requests and
+    close it on exit:
+
+        async with managed_session():
+            await asyncio.gather(*requests)
+    """
+    try:
+        yield get_session()
+    finally:
+        await close_session()
 
 
 @dataclass
@@ -21,6 +75,14 @@ class Response:
     data: Any
 
 
+@dataclass
+class StreamResponse(Response):
+    """A response whose body is streamed as server-sent events. `events` yields the data of each event, parsed from
+    JSON, as it arrives; for unsuccessful responses `data` holds the error body and `events` yields nothing."""
+
+    events: AsyncIterator[Any] = None
+
+
 async def post_request(
     url: str,
     data: Any,
@@ -50,7 +112,17 @@ async def post_request(
     ----------
     Response
         an object containing the response body, headers, and status
+
+    Raises
+    ------
+    CassetteMissError
+        if a cassette is being replayed and the request wasn't recorded
     """
+    cassette = get_cassette()
+    if cassette and cassette.mode == CassetteMode.REPLAY:
+        status, response_headers, response_data = cassette.replay(url, data)
+        return Response(status, response_headers, data=response_data)
+
     try:
         data_arg = "json" if is_data_json else "data"
         request_args = {
@@ -62,7 +134,7 @@ async def post_request(
         if chunked:
             request_args["chunked"] = True
 
-        async with session.post(url, **request_args) as resp:  # type: ignore
+        async with get_session().post(url, **request_args) as resp:
 
             if "application/json" in resp.headers.get("Content-Type", {}):
                 response_data = await resp.json()
@@ -72,6 +144,8 @@ async def post_request(
             if resp.status != 200:
                 logger.error("Error with API request: %s", response_data)
         response = Response(resp.status, resp.headers, data=response_data)
+        if cassette and cassette.mode == CassetteMode.RECORD:
+            cassette.record(url, data, resp.status, resp.headers, response_data)
     except Exception as error:  # pylint: disable=broad-except
         logger.error("API request failed with error: %s", repr(error))
         if "response" not in locals():
@@ -81,3 +155,119 @@ async def post_request(
                 {"error": dict.fromkeys(["type", "message"], type(error).__name__)},
             )
     return response
+
+
+async def iter_events(events: list[Any]) -> AsyncIterator[Any]:
+    for event in events:
+        yield event
+
+
+async def parse_server_sent_events(lines: AsyncIterator[bytes]) -> AsyncIterator[Any]:
+    """Parse server-sent events from a stream of lines, yielding the data of each event parsed from JSON until the
+    `[DONE]` event or the end of the stream"""
+    data_lines = []
+    async for line in lines:
+        line = line.decode("utf-8").rstrip("\r\n")
+
+        # a blank line dispatches the event
+        if not line:
+            data, data_lines = "\n".join(data_lines), []
+            if data == "[DONE]":
+                return
+            if data:
+                yield json.loads(data)
+            continue
+
+        field, _, value = line.partition(":")
+        if field == "data":
+            data_lines.append(value[1:] if value.startswith(" ") else value)
+
+    data = "\n".join(data_lines)
+    if data and data != "[DONE]":
+        yield json.loads(data)
+
+
+async def post_stream_request(
+    url: str,
+    data: Any,
+    headers: dict[str, str],
+    timeout: int = GLOBAL_TIMEOUT,
+) -> StreamResponse:
+    """Make an asynchronous post request to an external API that streams its response as server-sent events, on the
+    pooled session. Unlike `post_request`, the timeout applies to connecting and to each read rather than to the
+    whole response, so that long streams aren't cut off.
+
+    The connection is held until `events` is exhausted or closed with `await response.events.aclose()`.
+
+    Parameters
+    ----------
+    url :  str
+        external API url
+    data : Any
+        request body, converted to json
+    headers : Dict[str, str]
+        request headers
+    timeout : int
+        connect and read timeout in seconds
+
+    Returns
+    ----------
+    StreamResponse
+        an object containing the streamed events, headers, and status
+
+    Raises
+    ------
+    CassetteMissError
+        if a cassette is being replayed and the request wasn't recorded
+    """
+    cassette = get_cassette()
+    if cassette and cassette.mode == CassetteMode.REPLAY:
+        status, response_headers, response_data = cassette.replay(url, data)
+        if status == 200:
+            return StreamResponse(status, response_headers, None, iter_events(response_data))
+        return StreamResponse(status, response_headers, response_data, iter_events([]))
+
+    try:
+        resp = await get_session().post(
+            url,
+            json=data,
+            headers=headers,
+            timeout=ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout),
+        )
+    except Exception as error:  # pylint: disable=broad-except
+        logger.error("API request failed with error: %s", repr(error))
+        return StreamResponse(
+            -1,
+            {},
+            {"error": dict.fromkeys(["type", "message"], type(error).__name__)},
+            iter_events([]),
+        )
+
+    if resp.status != 200:
+        try:
+            if "application/json" in resp.headers.get("Content-Type", {}):
+                response_data = await resp.json()
+            else:
+                response_data = await resp.read()
+        finally:
+            resp.release()
+        logger.error("Error with API request: %s", response_data)
+        if cassette and cassette.mode == CassetteMode.RECORD:
+            cassette.record(url, data, resp.status, resp.headers, response_data)
+        return StreamResponse(resp.status, resp.headers, response_data, iter_events([]))
+
+    is_recording = cassette is not None and cassette.mode == CassetteMode.RECORD
+
+    async def events() -> AsyncIterator[Any]:
+        recorded_events = []
+        try:
+            async for event in parse_server_sent_events(resp.content):
+                if is_recording:
+                    recorded_events.append(event)
+                yield event
+        finally:
+            resp.release()
+        if is_recording:
+            cassette.record(url, data, resp.status, resp.headers, recorded_events)
+
+    return StreamResponse(resp.status, resp.headers, None, events())
@@ -1,10 +1,10 @@
 import asyncio
 from collections import OrderedDict
-import aiohttp
 
 import streamlit as st
-import api.utils
 
+from api.utils import managed_session
+from batch import gather_bounded
 from conversation.prompt import LessonPrompt, Prompt
 from generate_conversation import generate_conversation
 from sample_prompts.agent_prompt import agent_prompt as sample_agent_prompt
@@ -12,13 +12,12 @@ from sample_prompts.user_prompt import user_prompt as sample_user_prompt
 
 
 async def generate_conversations(user_prompt, agent_prompt, initial_agent_dialogue_tags, num_conversations):
-    api.utils.session = aiohttp.ClientSession()
-    tasks = []
-    for i in range(num_conversations):
-        tasks.append(generate_conversation(agent_prompt, user_prompt, initial_agent_dialogue_tags))
+    async with managed_session():
+        tasks = []
+        for i in range(num_conversations):
+            tasks.append(generate_conversation(agent_prompt, user_prompt, initial_agent_dialogue_tags))
 
-    conversations = await asyncio.gather(*tasks)
-    await api.utils.session.close()
+        conversations = await gather_bounded(tasks)
 
     return conversations
 
@@ -0,0 +1,834 @@
+"""Headless batch runner that generates simulated conversations for a file of scenario specs.
+
+Each line of the input JSONL file is a scenario spec; every finished conversation is streamed to the output JSONL
+file as soon as it completes, so memory usage stays flat no matter how many conversations are generated.
+
+With `--workers N`, the batch is sharded across N worker processes to use more than one core, and the output is
+written in the order of the input instead.
+
+Usage:
+    python -m batch --input scenarios.jsonl --output conversations.jsonl --concurrency 50
+    python -m batch --input scenarios.jsonl --output conversations.jsonl --concurrency 200 --workers 4
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import heapq
+import json
+import logging
+import math
+import multiprocessing
+import queue
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from dataclasses import field
+from time import time
+from typing import Any
+from typing import AsyncIterator
+from typing import Awaitable
+from typing import Callable
+from typing import Iterable
+from typing import Iterator
+from typing import TypeVar
+
+from cuid import cuid
+
+from api.cache import CompletionCache
+from api.cache import set_completion_cache
+from api.completion_log import CompletionLog
+from api.completion_log import set_completion_log
+from api.metrics import CloudMonitoringExporter
+from api.metrics import get_metrics_registry
+from api.metrics import reset_metrics_registry
+from api.metrics import write_prometheus
+from api.profiling import LoopLagMonitor
+from api.profiling import SamplingProfiler
+from api.profiling import set_timers_enabled
+from api.rate_limit import set_shared_rate_limits
+from api.rate_limit import SharedRateLimits
+from api.recording import Cassette
+from api.recording import CassetteMode
+from api.recording import set_cassette
+from api.retry import reset_retry_budget
+from api.tracing import ChromeTraceExporter
+from api.tracing import set_tracer
+from api.tracing import span
+from api.tracing import Tracer
+from api.utils import managed_session
+from constants import AGENT_LABEL
+from constants import BATCH_PROGRESS_INTERVAL
+from constants import BATCH_WORKER_POLL_INTERVAL
+from constants import BATCH_WORKER_REORDER_WINDOW
+from constants import COMPLETION_LOG_MAX_PAYLOAD_CHARS
+from constants import COMPLETION_LOG_SAMPLE_RATE
+from constants import DEFAULT_MAX_CONCURRENT_CONVERSATIONS
+from constants import DIALOGUE_TAGS
+from constants import LESSON
+from constants import NUM_CONVERSATIONS
+from constants import PROFILER_SAMPLE_INTERVAL
+from constants import PROMPT
+from constants import PROMPT_SETTINGS
+from constants import SCENARIO_ID
+from constants import USER_LABEL
+from constants import USER_PROFILE
+from conversation.prompt import LessonPrompt
+from generate_conversation import generate_conversation
+from sample_prompts.agent_prompt import agent_prompt as sample_agent_prompt
+from sample_prompts.user_prompt import user_prompt as sample_user_prompt
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+_DONE = object()
+# kinds of messages that worker processes put on the results queue
+_RESULT = "result"
+_METRICS = "metrics"
+
+
+@dataclass
+class Scenario:
+    """A scenario to simulate: the lesson prompt driving the agent, the user profile driving the simulated user, the
+    tags of the opening agent turn and the number of conversations to generate."""
+
+    scenario_id: str
+    lesson_prompt: LessonPrompt
+    user_prompt: LessonPrompt
+    initial_dialogue_tags: OrderedDict[str, str]
+    num_conversations: int = 1
+
+    @classmethod
+    def from_json(cls, scenario: dict[str, Any], default_id: str) -> Scenario:
+        """Parses a Scenario from a json object of the following format:
+
+        Parameters
+        ----------
+        scenario : Dict[str, Any]
+            A dictionary containing the following fields:
+                {
+                    "scenarioId": string,
+                    "lesson": {
+                        "prompt": string,
+                        "promptSettings": {},
+                        "completionTags": [string, ...],
+                        "userLabel": string,
+                        "agentLabel": string
+                    },
+                    "userProfile": {
+                        "prompt": string,
+                        "promptSettings": {},
+                        "userLabel": string,
+                        "agentLabel": string
+                    },
+                    "dialogueTags": [
+                        {
+                            "tag": string,
+                            "value": string
+                        },
+                        ...
+                    ],
+                    "numConversations": int
+                }
+            All fields are optional; the sample prompts are used for a missing lesson or user profile. As in the
+            app, the user profile labels are the simulated user's own label and the lesson agent's label.
+        default_id : str
+            the scenario id used if the spec doesn't provide one
+        """
+        lesson_prompt = (
+            LessonPrompt.from_json(scenario[LESSON])
+            if LESSON in scenario
+            else sample_agent_prompt
+        )
+        user_profile = scenario.get(
+            USER_PROFILE,
+            {
+                PROMPT: sample_user_prompt.prompt,
+                PROMPT_SETTINGS: sample_user_prompt.settings,
+                USER_LABEL: sample_user_prompt.user_label,
+                AGENT_LABEL: sample_user_prompt.agent_label,
+            },
+        )
+        # the simulated user is prompted as the "agent" of its own conversation, so the labels are swapped
+        user_prompt = LessonPrompt(
+            prompt=user_profile[PROMPT],
+            settings=user_profile[PROMPT_SETTINGS],
+            tags=[user_profile[USER_LABEL]],
+            user_label=user_profile[AGENT_LABEL],
+            agent_label=user_profile[USER_LABEL],
+        )
+        if DIALOGUE_TAGS in scenario:
+            initial_dialogue_tags = OrderedDict(
+                (tag["tag"], tag["value"]) for tag in scenario[DIALOGUE_TAGS]
+            )
+        else:
+            initial_dialogue_tags = OrderedDict(
+                [
+                    (lesson_prompt.agent_label, "¡Siguiente! Hola. ¿Qué desea tomar?"),
+                    *((tag, "False") for tag in lesson_prompt.tags[1:]),
+                ]
+            )
+
+        return Scenario(
+            scenario_id=str(scenario.get(SCENARIO_ID, default_id)),
+            lesson_prompt=lesson_prompt,
+            user_prompt=user_prompt,
+            initial_dialogue_tags=initial_dialogue_tags,
+            num_conversations=int(scenario.get(NUM_CONVERSATIONS, 1)),
+        )
+
+
+@dataclass
+class ConversationJob:
+    """A single conversation to generate for a scenario"""
+
+    scenario: Scenario
+    index: int
+
+
+@dataclass
+class BatchProgress:
+    """Running counts for a batch, logged periodically while the batch is in flight"""
+
+    completed: int = 0
+    failed: int = 0
+    start_time: float = field(default_factory=time)
+    last_logged: float = field(default_factory=time)
+
+    def record(self, result: dict[str, Any]) -> None:
+        if result["error"] is None:
+            self.completed += 1
+        else:
+            self.failed += 1
+
+    def log(self, force: bool = False) -> bool:
+        """Log the progress if it wasn't logged in the last interval, and return whether it was logged"""
+        now = time()
+        if not force and now - self.last_logged < BATCH_PROGRESS_INTERVAL:
+            return False
+        self.last_logged = now
+        elapsed = now - self.start_time
+        finished = self.completed + self.failed
+        logger.info(
+            f"Batch progress: {finished} conversations finished ({self.failed} failed) in {elapsed:.0f}s "
+            f"<rate:{finished / elapsed if elapsed else 0:.2f}/s>"
+        )
+        return True
+
+
+def read_scenarios(path: str) -> Iterator[Scenario]:
+    """Lazily read scenario specs from a JSONL file, one scenario per non-empty line"""
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            yield Scenario.from_json(json.loads(line), default_id=str(line_no))
+
+
+def iter_jobs(scenarios: Iterable[Scenario]) -> Iterator[ConversationJob]:
+    for scenario in scenarios:
+        for index in range(scenario.num_conversations):
+            yield ConversationJob(scenario, index)
+
+
+async def run_job(job: ConversationJob, speculative: int = 1) -> dict[str, Any]:
+    """Generate the conversation for a job, capturing any error in the result instead of raising"""
+    t0 = time()
+    conversation, error = None, None
+    activity_id = cuid()
+    with span(
+        "conversation",
+        scenarioId=job.scenario.scenario_id,
+        conversationIndex=job.index,
+        activityId=activity_id,
+    ) as conversation_span:
+        try:
+            conversation = await generate_conversation(
+                job.scenario.lesson_prompt,
+                job.scenario.user_prompt,
+                job.scenario.initial_dialogue_tags,
+                speculative=speculative,
+                activity_id=activity_id,
+            )
+        except Exception as e:  # pylint: disable=broad-except
+            logger.error(
+                f"activityId={activity_id} :: scenarioId={job.scenario.scenario_id} :: conversation {job.index} "
+                f"failed with error: {e!r}"
+            )
+            error = repr(e)
+            if conversation_span:
+                conversation_span.record_error(e)
+
+    latency = (time() - t0) * 1000
+    registry = get_metrics_registry()
+    registry.counter(
+        "conversations_total", "Finished conversations", ["status"]
+    ).inc(status="failed" if error else "completed")
+    registry.histogram(
+        "conversation_latency_ms", "Time to generate a conversation", ["status"]
+    ).observe(latency, status="failed" if error else "completed")
+
+    return {
+        "scenarioId": job.scenario.scenario_id,
+        "conversationIndex": job.index,
+        "conversation": conversation,
+        "error": error,
+        "latency": latency,
+    }
+
+
+async def run_unordered(
+    items: Iterable[T], concurrency: int, run: Callable[[T], Awaitable[R]]
+) -> AsyncIterator[R]:
+    """Run `run` on each item with at most `concurrency` in flight, yielding results in order of completion. Items
+    are pulled lazily from the iterable, so only the in-flight items are ever held in memory. An error raised by
+    `run` or by the iterable (e.g. on a malformed scenario spec) is raised as soon as it occurs."""
+    items = iter(items)
+    results: asyncio.Queue = asyncio.Queue()
+
+    async def worker() -> None:
+        try:
+            for item in items:
+                await results.put(await run(item))
+        except Exception as e:  # pylint: disable=broad-except
+            await results.put(e)
+            return
+        await results.put(_DONE)  # signals that this worker has run out of items
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    num_finished_workers = 0
+    try:
+        while num_finished_workers < len(workers):
+            result = await results.get()
+            if result is _DONE:
+                num_finished_workers += 1
+                continue
+            if isinstance(result, Exception):
+                raise result
+            yield result
+    finally:
+        for task in workers:
+            task.cancel()
+
+
+async def run_conversations(
+    jobs: Iterable[ConversationJob],
+    concurrency: int = DEFAULT_MAX_CONCURRENT_CONVERSATIONS,
+    speculative: int = 1,
+) -> AsyncIterator[dict[str, Any]]:
+    """Generate conversations with at most `concurrency` in flight, yielding results in order of completion.
+
+    Jobs are pulled lazily from the iterable, so only the in-flight conversations are ever held in memory. With
+    `speculative` > 1, each agent turn races that many candidate responses and keeps the first valid one.
+    """
+    async for result in run_unordered(jobs, concurrency, lambda job: run_job(job, speculative)):
+        yield result
+
+
+async def gather_bounded(
+    aws: Iterable[Awaitable[Any]],
+    limit: int = DEFAULT_MAX_CONCURRENT_CONVERSATIONS,
+) -> list[Any]:
+    """Like asyncio.gather, but with at most `limit` awaitables running at once"""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(aw: Awaitable[Any]) -> Any:
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(*(run(aw) for aw in aws))
+
+
+@asynccontextmanager
+async def batch_session(
+    cache: CompletionCache = None,
+    cassette: Cassette = None,
+    completion_log: CompletionLog = None,
+    tracer: Tracer = None,
+    monitor_loop_lag: bool = False,
+    time_hot_paths: bool = False,
+    profiler: SamplingProfiler = None,
+) -> AsyncIterator[None]:
+    """Set up the state that the conversations of a batch share on the running event loop (a fresh retry budget and
+    metrics registry, the shared session, and the given cache, cassette, completion log, tracer and profiling), and
+    close and reset all of it on exit"""
+    reset_retry_budget()
+    reset_metrics_registry()
+    set_completion_cache(cache)
+    set_cassette(cassette)
+    set_completion_log(completion_log)
+    set_tracer(tracer)
+    set_timers_enabled(time_hot_paths)
+    loop_lag_monitor = LoopLagMonitor() if monitor_loop_lag else None
+    if loop_lag_monitor:
+        loop_lag_monitor.start()
+    if profiler:
+        profiler.start()
+    try:
+        async with managed_session():
+            yield
+    finally:
+        if loop_lag_monitor:
+            await loop_lag_monitor.stop()
+            loop_lag = loop_lag_monitor.histogram
+            # CAREFUL: used for log-based metrics!
+            logger.info(
+                f"Event loop lag <p50:{loop_lag.percentile(50):.2f}ms> <p99:{loop_lag.percentile(99):.2f}ms> "
+                f"<max:{loop_lag_monitor.max_lag:.2f}ms>"
+            )
+        if profiler:
+            profiler.stop()
+        if cache:
+            cache.close()
+        if cassette:
+            cassette.close()
+        if completion_log:
+            completion_log.close()
+        if tracer:
+            tracer.shutdown()
+        set_completion_cache(None)
+        set_cassette(None)
+        set_completion_log(None)
+        set_tracer(None)
+        set_timers_enabled(False)
+
+
+async def write_results(
+    results: AsyncIterator[dict[str, Any]],
+    output_path: str,
+    progress: BatchProgress,
+    metrics_out: str = None,
+) -> None:
+    """Append each result to `output_path` as a JSON line as soon as it arrives, logging progress periodically"""
+    with open(output_path, "a", encoding="utf-8") as out:
+        async for result in results:
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush()
+            progress.record(result)
+            if progress.log() and metrics_out:
+                write_prometheus(metrics_out)
+
+
+def finish_batch(
+    progress: BatchProgress,
+    metrics_out: str = None,
+    metrics_exporter: CloudMonitoringExporter = None,
+) -> None:
+    progress.log(force=True)
+    if metrics_out:
+        write_prometheus(metrics_out)
+    if metrics_exporter:
+        metrics_exporter.export()
+
+
+async def run_batch(
+    input_path: str,
+    output_path: str,
+    concurrency: int = DEFAULT_MAX_CONCURRENT_CONVERSATIONS,
+    cache: CompletionCache = None,
+    cassette: Cassette = None,
+    speculative: int = 1,
+    completion_log: CompletionLog = None,
+    metrics_out: str = None,
+    metrics_exporter: CloudMonitoringExporter = None,
+    tracer: Tracer = None,
+    monitor_loop_lag: bool = False,
+    time_hot_paths: bool = False,
+    profiler: SamplingProfiler = None,
+) -> BatchProgress:
+    """Generate all conversations specified in `input_path` and append them to `output_path` as JSON lines,
+    optionally serving completions from a completion cache, recording or replaying requests with a cassette and
+    recording completion calls to a structured completion log, and tracing each conversation with a tracer.
+
+    Metrics of the batch are collected in a fresh registry. They are written in the Prometheus text format to
+    `metrics_out` whenever progress is logged and when the batch finishes, and exported to Cloud Monitoring with
+    `metrics_exporter` when the batch finishes.
+
+    To find out whether the event loop, rather than the API, is the bottleneck, the batch can record the lag of the
+    loop and the duration of hot-path functions as metrics, and sample the loop's stacks with a profiler."""
+    progress = BatchProgress()
+    async with batch_session(
+        cache, cassette, completion_log, tracer, monitor_loop_lag, time_hot_paths, profiler
+    ):
+        await write_results(
+            run_conversations(iter_jobs(read_scenarios(input_path)), concurrency, speculative),
+            output_path,
+            progress,
+            metrics_out,
+        )
+    finish_batch(progress, metrics_out, metrics_exporter)
+    return progress
+
+
+@dataclass
+class Shard:
+    """The part of a batch generated by one of `num_shards` worker processes: the jobs it takes from the batch's job
+    queue whenever it has capacity for another conversation"""
+
+    index: int
+    num_shards: int
+
+    def get_path(self, path: str) -> str:
+        """Path of the shard's own copy of a file that worker processes can't share"""
+        return f"{path}.{self.index}"
+
+
+def get_batch_options(args: argparse.Namespace, shard: Shard = None) -> dict[str, Any]:
+    """Create the cache, cassette, completion log, tracer and profiler of a batch from its command line arguments,
+    as keyword arguments of `run_batch` or `batch_session`. The files that worker processes write line by line get
+    a copy per shard."""
+    get_path = shard.get_path if shard else lambda path: path
+    cache = None
+    if args.cache or args.replay:
+        cache = CompletionCache(
+            path=args.cache,
+            call_types=args.cache_call_types.split(",")
+            if args.cache_call_types
+            else None,
+            replay=args.replay,
+        )
+    cassette = None
+    if args.cassette:
+        cassette = Cassette(
+            get_path(args.cassette)
+            if args.cassette_mode == CassetteMode.RECORD
+            else args.cassette,
+            args.cassette_mode,
+        )
+    completion_log = (
+        CompletionLog(
+            get_path(args.completion_log),
+            sample_rate=args.completion_log_sample_rate,
+            max_payload_chars=args.completion_log_max_chars,
+        )
+        if args.completion_log
+        else None
+    )
+    return {
+        "cache": cache,
+        "cassette": cassette,
+        "completion_log": completion_log,
+        "tracer": Tracer([ChromeTraceExporter(args.trace_dir)]) if args.trace_dir else None,
+        "monitor_loop_lag": args.monitor_loop_lag,
+        "time_hot_paths": args.time_hot_paths,
+        "profiler": SamplingProfiler(get_path(args.profile_out), args.profile_interval)
+        if args.profile_out
+        else None,
+    }
+
+
+class JobReader:
+    """Takes the jobs of a sharded batch off the batch's job queue for the tasks of a worker process, one job per
+    call of `get`, so that jobs go to the workers with free capacity. The queue is read by a daemon thread, so that a
+    worker that fails isn't kept alive waiting for jobs. The end of the jobs, None, is put back on the queue for the
+    other tasks and workers."""
+
+    def __init__(self, jobs: multiprocessing.Queue):
+        self.jobs = jobs
+        self.loop = asyncio.get_running_loop()
+        self.requests: queue.SimpleQueue[asyncio.Future] = queue.SimpleQueue()
+        threading.Thread(target=self._read, name="job-reader", daemon=True).start()
+
+    async def get(self) -> tuple[int, ConversationJob] | None:
+        """Return the next job with its position in the batch, or None once all jobs are handed out"""
+        future = self.loop.create_future()
+        self.requests.put(future)
+        return await future
+
+    def _read(self) -> None:
+        while True:
+            future = self.requests.get()
+            item = self.jobs.get()
+            if item is None:
+                self.jobs.put(None)
+            self.loop.call_soon_threadsafe(self._set_result, future, item)
+
+    @staticmethod
+    def _set_result(future: asyncio.Future, item: tuple[int, ConversationJob] | None) -> None:
+        if not future.cancelled():
+            future.set_result(item)
+
+
+async def run_shard(
+    args: argparse.Namespace,
+    shard: Shard,
+    jobs: multiprocessing.Queue,
+    results: multiprocessing.Queue,
+) -> None:
+    """Generate the conversations of the jobs taken from the `jobs` queue, putting each result on the `results`
+    queue with its position in the batch, and the shard's metrics once the jobs run out"""
+
+    async def run_jobs(job_reader: JobReader) -> None:
+        while True:
+            item = await job_reader.get()
+            if item is None:
+                return
+            seq, job = item
+            results.put((_RESULT, (seq, await run_job(job, args.speculative))))
+
+    # the concurrency of the batch is split between the shards
+    concurrency = math.ceil(args.concurrency / shard.num_shards)
+    async with batch_session(**get_batch_options(args, shard)):
+        job_reader = JobReader(jobs)
+        await asyncio.gather(*(run_jobs(job_reader) for _ in range(concurrency)))
+        registry = get_metrics_registry()
+    results.put((_METRICS, registry))
+
+
+def run_worker(
+    args: argparse.Namespace,
+    shard: Shard,
+    jobs: multiprocessing.Queue,
+    results: multiprocessing.Queue,
+    rate_limits: SharedRateLimits,
+) -> None:
+    """Entry point of a worker process of a sharded batch, with its own event loop and session. The workers draw on
+    the same rate limit budget, so that together they stay under the rate limits, and a worker that is idle or done
+    leaves its budget to the others."""
+    logging.basicConfig(level=args.log_level.upper())
+    set_shared_rate_limits(rate_limits)
+    asyncio.run(run_shard(args, shard, jobs, results))
+
+
+async def merge_shard_results(
+    jobs: Iterable[ConversationJob],
+    job_queue: multiprocessing.Queue,
+    results: multiprocessing.Queue,
+    workers: list[multiprocessing.Process],
+) -> AsyncIterator[dict[str, Any]]:
+    """Hand out the jobs of a sharded batch to its workers through `job_queue`, and yield their results in job
+    order, holding back results that arrive ahead of their turn. Jobs are only handed out up to the reorder window
+    ahead of the next result to yield, followed by None once they run out. The metrics of each worker are merged
+    into this process's registry as it finishes.
+
+    Raises
+    ------
+    RuntimeError
+        if a worker process exits without finishing its shard
+    """
+    loop = asyncio.get_running_loop()
+    jobs = iter(jobs)
+    num_jobs = 0  # number of jobs handed out, i.e. the position of the next one
+    next_seq = 0  # position of the next result to yield
+    pending: list[tuple[int, dict[str, Any]]] = []  # heap of results by position in the batch
+
+    def hand_out_jobs() -> None:
+        nonlocal jobs, num_jobs
+        while jobs is not None and num_jobs < next_seq + BATCH_WORKER_REORDER_WINDOW:
+            job = next(jobs, None)
+            if job is None:
+                job_queue.put(None)
+                jobs = None
+            else:
+                job_queue.put((num_jobs, job))
+                num_jobs += 1
+
+    hand_out_jobs()
+    num_finished_workers = 0
+    while num_finished_workers < len(workers):
+        try:
+            kind, payload = await loop.run_in_executor(
+                None, results.get, True, BATCH_WORKER_POLL_INTERVAL
+            )
+        except queue.Empty:
+            for worker in workers:
+                if worker.exitcode not in (None, 0):
+                    raise RuntimeError(
+                        f"Batch worker {worker.name} exited with code {worker.exitcode}"
+                    )
+            continue
+
+        if kind == _METRICS:
+            get_metrics_registry().merge(payload)
+            num_finished_workers += 1
+            continue
+        heapq.heappush(pending, payload)
+        while pending and pending[0][0] == next_seq:
+            yield heapq.heappop(pending)[1]
+            next_seq += 1
+        hand_out_jobs()
+
+
+async def run_sharded_batch(
+    args: argparse.Namespace, num_workers: int
+) -> BatchProgress:
+    """Generate the conversations of a batch across `num_workers` worker processes, to use more than one core for
+    the CPU work of the conversations. This process reads the jobs and hands them out to whichever worker has capacity
+    for another conversation, and merges their results back into the output file in the order of the jobs (rather
+    than in order of completion as with `run_batch`).
+
+    Metrics are collected per worker and merged into this process's registry as each worker finishes, so metrics
+    written before the batch finishes only include the finished workers. The files of a completion log, profiler
+    and recording cassette are written per worker, with the worker's index appended to their path."""
+    progress = BatchProgress()
+    reset_metrics_registry()
+    context = multiprocessing.get_context("spawn")
+    job_queue = context.Queue()
+    results = context.Queue()
+    rate_limits = SharedRateLimits(context)
+    workers = [
+        context.Process(
+            target=run_worker,
+            args=(args, Shard(index, num_workers), job_queue, results, rate_limits),
+            name=f"batch-worker-{index}",
+            daemon=True,
+        )
+        for index in range(num_workers)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        await write_results(
+            merge_shard_results(
+                iter_jobs(read_scenarios(args.input)), job_queue, results, workers
+            ),
+            args.output,
+            progress,
+            args.metrics_out,
+        )
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+    finish_batch(
+        progress,
+        args.metrics_out,
+        CloudMonitoringExporter(args.cloud_monitoring_project)
+        if args.cloud_monitoring_project
+        else None,
+    )
+    return progress
+
+
+def parse_args(argv: list[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Generate simulated conversations for a JSONL file of scenario specs."
+    )
+    parser.add_argument(
+        "--input", required=True, help="JSONL file with one scenario spec per line"
+    )
+    parser.add_argument(
+        "--output", required=True, help="JSONL file that finished conversations are appended to"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_MAX_CONCURRENT_CONVERSATIONS,
+        help="maximum number of conversations in flight",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of worker processes to shard the batch across, each with its own event loop and an equal share "
+        "of the concurrency, sharing the rate limits; with more than one, results are written in the order of the "
+        "input",
+    )
+    parser.add_argument(
+        "--speculative",
+        type=int,
+        default=1,
+        help="number of candidate agent responses to race per turn, keeping the first valid one",
+    )
+    parser.add_argument(
+        "--cache",
+        help="SQLite file to cache completions in, so identical requests are only completed once across runs",
+    )
+    parser.add_argument(
+        "--cache-call-types",
+        help="comma-separated call types to cache completions for, e.g. stepAgent,endConversation; default all",
+    )
+    parser.add_argument(
+        "--replay",
+        action="store_true",
+        help="also serve sampled (temperature > 0) completions from the cache, to replay a previous run",
+    )
+    parser.add_argument(
+        "--cassette", help="JSONL file that API requests are recorded to or replayed from"
+    )
+    parser.add_argument(
+        "--cassette-mode",
+        choices=[CassetteMode.RECORD, CassetteMode.REPLAY],
+        default=CassetteMode.REPLAY,
+    )
+    parser.add_argument(
+        "--completion-log",
+        help="JSONL file that a structured record of every completion call is appended to",
+    )
+    parser.add_argument(
+        "--completion-log-sample-rate",
+        type=float,
+        default=COMPLETION_LOG_SAMPLE_RATE,
+        help="fraction of completion log records that include the request, prompt and output",
+    )
+    parser.add_argument(
+        "--completion-log-max-chars",
+        type=int,
+        default=COMPLETION_LOG_MAX_PAYLOAD_CHARS,
+        help="strings in completion log payloads are truncated to this many characters",
+    )
+    parser.add_argument(
+        "--metrics-out",
+        help="file that batch metrics are written to in the Prometheus text format, e.g. for a textfile collector",
+    )
+    parser.add_argument(
+        "--cloud-monitoring-project",
+        help="Google Cloud project that batch metrics are exported to with Cloud Monitoring",
+    )
+    parser.add_argument(
+        "--trace-dir",
+        help="directory that a Chrome trace JSON file is written to for each conversation, "
+        "to see where its time went in chrome://tracing or Perfetto",
+    )
+    parser.add_argument(
+        "--monitor-loop-lag",
+        action="store_true",
+        help="record how long callbacks wait for the event loop, as the event_loop_lag_ms metric",
+    )
+    parser.add_argument(
+        "--time-hot-paths",
+        action="store_true",
+        help="record the duration of hot-path functions on the event loop, as the function_duration_ms metric",
+    )
+    parser.add_argument(
+        "--profile-out",
+        help="file that stack samples of the event loop are written to, in the collapsed format of flamegraph.pl",
+    )
+    parser.add_argument(
+        "--profile-interval",
+        type=float,
+        default=PROFILER_SAMPLE_INTERVAL,
+        help="seconds between stack samples of the profiler",
+    )
+    parser.add_argument("--log-level", default="INFO")
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] = None) -> None:
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper())
+    if args.workers > 1:
+        asyncio.run(run_sharded_batch(args, args.workers))
+        return
+    asyncio.run(
+        run_batch(
+            args.input,
+            args.output,
+            args.concurrency,
+            speculative=args.speculative,
+            metrics_out=args.metrics_out,
+            metrics_exporter=CloudMonitoringExporter(args.cloud_monitoring_project)
+            if args.cloud_monitoring_project
+            else None,
+            **get_batch_options(args),
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""End-to-end benchmark of conversation generation throughput and latency against the local stub server.
+
+For each concurrency level, conversations are generated in a fresh process against a stub completion server running
+in its own process, so that the measured CPU time and memory belong to the conversation pipeline alone. Call counts
+and latency percentiles are read from the metrics registry, so they match what a batch exports.
+
+Usage:
+    python -m benchmarks.conversation_throughput --concurrency 1 10 100 1000 --latency-ms 300
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import resource
+import socket
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any
+
+DEFAULT_CONCURRENCY_LEVELS = [1, 10, 100, 1000]
+PERCENTILES = [50, 95, 99]
+
+
+def start_stub_server(args: argparse.Namespace) -> subprocess.Popen:
+    """Start the stub server in a separate process and wait until it accepts connections"""
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "api.stub_server",
+            "--port",
+            str(args.port),
+            "--latency-ms",
+            str(args.latency_ms),
+            "--latency-distribution",
+            args.latency_distribution,
+            "--error-rate",
+            str(args.error_rate),
+            "--rate-limit-rate",
+            str(args.rate_limit_rate),
+            "--end-probability",
+            str(args.end_probability),
+            "--seed",
+            str(args.seed),
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("localhost", args.port), timeout=0.1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Stub server failed to start")
+
+
+def run_level(
+    concurrency: int, num_conversations: int, base_url: str, rate_limit: bool
+) -> dict[str, Any]:
+    """Generate `num_conversations` conversations with `concurrency` in flight and return the measurements. Runs in
+    a fresh process."""
+    from api.completion import ChatCompletion
+    from api.completion import TextCompletion
+    from api.metrics import reset_metrics_registry
+    from api.utils import managed_session
+    from batch import ConversationJob
+    from batch import run_conversations
+    from batch import Scenario
+    from constants import CallType
+    from constants import OPENAI_MODEL_RATE_LIMITS
+
+    logging.basicConfig(level=logging.WARNING)
+    TextCompletion.api_url = f"{base_url}/v1/completions"
+    ChatCompletion.api_url = f"{base_url}/v1/chat/completions"
+    if not rate_limit:
+        OPENAI_MODEL_RATE_LIMITS.clear()
+    registry = reset_metrics_registry()
+
+    async def run() -> list[dict[str, Any]]:
+        scenario = Scenario.from_json({}, default_id="benchmark")
+        jobs = (ConversationJob(scenario, i) for i in range(num_conversations))
+        async with managed_session():
+            return [result async for result in run_conversations(jobs, concurrency)]
+
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    results = asyncio.run(run())
+    cpu_time, wall_time = time.process_time() - cpu_start, time.perf_counter() - wall_start
+
+    # every simulated user turn is generated by a single call and answered by exactly one agent turn
+    calls = registry.counter(
+        "completion_calls_total", "", ["call_type", "completion_type", "model"]
+    )
+    num_calls = defaultdict(int)
+    for (call_type, _, _), value in calls.values.items():
+        num_calls[call_type] += value
+    num_agent_turns = num_calls[CallType.USER]
+    num_turns = 2 * num_agent_turns
+    num_agent_calls = num_calls[CallType.AGENT] + num_calls[CallType.END_CONVERSATION]
+    latency = registry.histogram("completion_latency_ms", "", ["call_type"])
+    return {
+        "concurrency": concurrency,
+        "conversations": num_conversations,
+        "failed": sum(result["error"] is not None for result in results),
+        "wallSeconds": wall_time,
+        "conversationsPerSecond": num_conversations / wall_time,
+        "turnsPerSecond": num_turns / wall_time,
+        "cpuSeconds": cpu_time,
+        "cpuMsPerTurn": cpu_time * 1000 / num_turns if num_turns else float("nan"),
+        "peakRssMb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "regenerationsPerAgentTurn": num_agent_calls / num_agent_turns - 1
+        if num_agent_turns
+        else float("nan"),
+        "latencyMs": {
+            call_type: {f"p{p}": latency.percentile(p, call_type=call_type) for p in PERCENTILES}
+            for (call_type,) in latency.values
+        },
+    }
+
+
+def print_report(results: list[dict[str, Any]]) -> None:
+    print(
+        f"{'concurrency':>11} {'convs':>6} {'failed':>6} {'conv/s':>8} {'turns/s':>8} "
+        f"{'cpu ms/turn':>11} {'peak MB':>8} {'regen/turn':>10}"
+    )
+    for result in results:
+        print(
+            f"{result['concurrency']:>11} {result['conversations']:>6} {result['failed']:>6} "
+            f"{result['conversationsPerSecond']:>8.2f} {result['turnsPerSecond']:>8.1f} "
+            f"{result['cpuMsPerTurn']:>11.2f} {result['peakRssMb']:>8.1f} "
+            f"{result['regenerationsPerAgentTurn']:>10.2f}"
+        )
+
+    print(f"\n{'concurrency':>11} {'call type':>16} " + " ".join(f"{f'p{p} ms':>9}" for p in PERCENTILES))
+    for result in results:
+        for call_type, latency in sorted(result["latencyMs"].items(), key=lambda x: str(x[0])):
+            print(
+                f"{result['concurrency']:>11} {str(call_type):>16} "
+                + " ".join(f"{latency[f'p{p}']:>9.1f}" for p in PERCENTILES)
+            )
+
+
+def parse_args(argv: list[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--concurrency", type=int, nargs="+", default=DEFAULT_CONCURRENCY_LEVELS
+    )
+    parser.add_argument(
+        "--conversations",
+        type=int,
+        help="conversations per concurrency level; defaults to twice the concurrency, and at least 10",
+    )
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument(
+        "--latency-distribution",
+        choices=["fixed", "uniform", "lognormal"],
+        default="lognormal",
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--end-probability", type=float, default=0.15)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--rate-limit",
+        action="store_true",
+        help="pace requests with the configured per-model rate limits",
+    )
+    parser.add_argument("--json", help="file to write the results to as JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] = None) -> None:
+    args = parse_args(argv)
+    stub_server = start_stub_server(args)
+    results = []
+    try:
+        for concurrency in args.concurrency:
+            num_conversations = args.conversations or max(10, 2 * concurrency)
+            with ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                results.append(
+                    executor.submit(
+                        run_level,
+                        concurrency,
+                        num_conversations,
+                        f"http://localhost:{args.port}",
+                        args.rate_limit,
+                    ).result()
+                )
+    finally:
+        stub_server.terminate()
+
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
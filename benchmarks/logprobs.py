@@ -0,0 +1,142 @@
+"""Micro-benchmarks for the logprob post-processing that runs on every text completion: computing word logprobs from
+token logprobs and checking the confidence of the end-conversation tag.
+
+The current implementations are compared against the original dict-based ones, which are kept here as the reference
+that the current implementations must match exactly.
+
+Usage:
+    python -m benchmarks.logprobs --tokens 100 1000 --number 2000
+"""
+from __future__ import annotations
+
+import argparse
+import logging
+import math
+import random
+import timeit
+from typing import Any
+
+from constants import DEFAULT_END_CONVERSATION_THRESHOLD
+from constants import END_CONVERSATION_TAG
+from conversation.utils import compute_word_boundaries
+from conversation.utils import override_end_conversation_tag
+
+WORD_PIECES = ["hol", "a", "caf", "é", "gra", "cias", "por", "fav", "or", "¿", "qué", "?", ",", "."]
+
+
+def reference_compute_word_logprobs(
+    token_logprobs: list[dict[str, Any]]
+) -> list[dict[str, float]]:
+    """The original token-by-token implementation of `compute_word_logprobs`"""
+    word_logprobs = []
+    curr_word, curr_logprob = "", 0
+
+    for row in token_logprobs:
+        tok, logprob = row["token"], row["logprob"]
+
+        if not tok.strip():
+            word_logprobs.append((curr_word, curr_logprob))
+            curr_word, curr_logprob = "", 0
+
+        elif tok.startswith((" ", "\t", "\n")) or tok == "<|endoftext|>":
+            word_logprobs.append((curr_word, curr_logprob))
+            curr_word, curr_logprob = tok.strip(), logprob
+
+        elif tok.endswith((" ", "\t", "\n")):
+            word_logprobs.append((curr_word + tok.strip(), curr_logprob + logprob))
+            curr_word, curr_logprob = "", 0
+
+        else:
+            curr_word += tok
+            curr_logprob += logprob
+
+    word_logprobs.append((curr_word, curr_logprob))
+
+    return [
+        {"word": word, "logprob": logprob}
+        for word, logprob in word_logprobs
+        if word != ""
+    ]
+
+
+def reference_override_end_conversation_tag(
+    word_logprobs: list[dict[str, Any]],
+    threshold: float = DEFAULT_END_CONVERSATION_THRESHOLD,
+) -> bool:
+    """The original linear scan of `override_end_conversation_tag`, without logging"""
+    end_conversation_final_word = END_CONVERSATION_TAG.split()[-1] + ":"
+    for i in range(len(word_logprobs) - 1):
+        if end_conversation_final_word != word_logprobs[i]["word"]:
+            continue
+        next_word = word_logprobs[i + 1]["word"].lower()
+        next_prob = math.exp(word_logprobs[i + 1]["logprob"])
+        return next_word == "true" and next_prob <= threshold
+    return False
+
+
+def generate_tokens(num_tokens: int, rng: random.Random) -> tuple[list[str], list[float]]:
+    """Generate GPT-like tokens for an agent response followed by the end-conversation tag"""
+    tokens = []
+    while len(tokens) < num_tokens:
+        piece = rng.choice(WORD_PIECES)
+        roll = rng.random()
+        if roll < 0.5:
+            piece = " " + piece
+        elif roll < 0.55:
+            piece += " "
+        elif roll < 0.6:
+            piece = "\n"
+        tokens.append(piece)
+    tokens += ["\n", "(", "Conversation", " Finished", "):", " True"]
+    return tokens, [rng.uniform(-2, 0) for _ in tokens]
+
+
+def check_results(tokens: list[str], logprobs: list[float]) -> None:
+    expected = reference_compute_word_logprobs(
+        [{"token": tok, "logprob": logprob} for tok, logprob in zip(tokens, logprobs)]
+    )
+    words, word_logprobs, _ = compute_word_boundaries(tokens, logprobs)
+    assert words == [row["word"] for row in expected]
+    assert list(word_logprobs) == [row["logprob"] for row in expected]
+    assert override_end_conversation_tag(
+        words, word_logprobs
+    ) == reference_override_end_conversation_tag(expected)
+
+
+def run(num_tokens: int, number: int, rng: random.Random) -> None:
+    tokens, logprobs = generate_tokens(num_tokens, rng)
+    check_results(tokens, logprobs)
+
+    def reference() -> None:
+        word_logprobs = reference_compute_word_logprobs(
+            [{"token": tok, "logprob": logprob} for tok, logprob in zip(tokens, logprobs)]
+        )
+        reference_override_end_conversation_tag(word_logprobs)
+
+    def current() -> None:
+        words, word_logprobs, _ = compute_word_boundaries(tokens, logprobs)
+        override_end_conversation_tag(words, word_logprobs)
+
+    for name, fn in [("reference", reference), ("current", current)]:
+        seconds = min(timeit.repeat(fn, number=number, repeat=5)) / number
+        print(f"{num_tokens:>8} tokens {name:>10}: {seconds * 1e6:>9.1f} µs/completion")
+
+
+def main(argv: list[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--tokens", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--number", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    # the override logs a warning for every low-confidence end-conversation tag
+    logging.disable(logging.WARNING)
+    rng = random.Random(args.seed)
+    for _ in range(1000):
+        check_results(*generate_tokens(rng.randint(0, 50), rng))
+    for num_tokens in args.tokens:
+        run(num_tokens, args.number, rng)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""Measure the requests of many concurrent conversations generated from the same lesson prompt and user profile.
+
+Conversations are generated concurrently (with both the chat and the text completion paths) against an in-process
+stub server, and the settings, number of logit biases and body size of the requests of each call type are reported.
+The settings and prompt sent with each call should not vary within a call type, e.g. because stop sequences or logit
+biases accumulate across turns or conversations; only the dialogue part of a request may grow. That the shared
+prompts are left unchanged is checked by tests/test_prompt.py.
+
+Usage:
+    python -m benchmarks.request_size --conversations 1000
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from typing import Any
+
+from api.completion import ChatCompletion
+from api.completion import Completion
+from api.completion import TextCompletion
+from api.stub_server import start_stub_server
+from api.stub_server import StubConfig
+from api.utils import managed_session
+from batch import ConversationJob
+from batch import run_conversations
+from batch import Scenario
+from constants import AGENT_LABEL
+from constants import CallType
+from constants import LESSON
+from constants import OPENAI_MODEL_RATE_LIMITS
+from constants import PROMPT
+from constants import PROMPT_SETTINGS
+from constants import TAGS
+from constants import USER_LABEL
+from generate_conversation import fill_prompt_guidelines
+from sample_prompts.agent_prompt import agent_prompt as sample_agent_prompt
+
+TEXT_SETTINGS = {"completion_type": "text", "model": "text-davinci-003", "logprobs": 1}
+
+
+def get_scenarios() -> list[Scenario]:
+    text_lesson = {
+        PROMPT: sample_agent_prompt.prompt,
+        PROMPT_SETTINGS: {**sample_agent_prompt.settings, **TEXT_SETTINGS},
+        TAGS: list(sample_agent_prompt.tags),
+        USER_LABEL: sample_agent_prompt.user_label,
+        AGENT_LABEL: sample_agent_prompt.agent_label,
+    }
+    return [
+        Scenario.from_json({}, default_id="chat"),
+        Scenario.from_json({LESSON: text_lesson}, default_id="text"),
+    ]
+
+
+def get_request_parts(request: dict[str, Any], call_type: str) -> tuple[str, str, int]:
+    """Split a request body into its settings and its prompt (or system message), serialized, and the size of its
+    logit biases. Logit biases are set only on regenerations, from the previous response of the call."""
+    settings = {
+        k: v for k, v in request.items() if k not in ("prompt", "messages", "logit_bias")
+    }
+    if call_type == CallType.END_CONVERSATION:
+        prompt = None  # the graceful ending prompt is filled in with the last turns
+    elif "messages" in request:
+        prompt = request["messages"][0]["content"]
+    else:
+        lesson_prompt = fill_prompt_guidelines(
+            sample_agent_prompt.prompt, sample_agent_prompt.agent_label
+        )
+        prompt = request["prompt"][: len(lesson_prompt)]
+    return json.dumps(settings, sort_keys=True), prompt, len(request.get("logit_bias") or {})
+
+
+async def run(num_conversations: int, concurrency: int, port: int) -> dict[str, Any]:
+    base_url = f"http://localhost:{port}"
+    TextCompletion.api_url = f"{base_url}/v1/completions"
+    ChatCompletion.api_url = f"{base_url}/v1/chat/completions"
+    OPENAI_MODEL_RATE_LIMITS.clear()
+
+    # record the settings and prompt of every request by wrapping the completion logger
+    requests = defaultdict(lambda: defaultdict(set))
+    log_completion = Completion.log_completion
+
+    async def record_completion(**kwargs) -> None:
+        settings, prompt, num_logit_biases = get_request_parts(
+            kwargs["request"], kwargs["call_type"]
+        )
+        key = (kwargs["completion_type"], kwargs["call_type"])
+        requests[key]["settings"].add(settings)
+        requests[key]["prompts"].add(prompt)
+        requests[key]["logitBiases"].add(num_logit_biases)
+        requests[key]["bodyBytes"].add(len(json.dumps(kwargs["request"])))
+
+    Completion.log_completion = staticmethod(record_completion)
+
+    scenarios = get_scenarios()
+    config = StubConfig(latency_ms=5, latency_distribution="fixed", token_latency_ms=0, seed=0)
+    runner = await start_stub_server(config, port=port)
+    try:
+        jobs = (
+            ConversationJob(scenarios[i % len(scenarios)], i)
+            for i in range(num_conversations)
+        )
+        async with managed_session():
+            results = [result async for result in run_conversations(jobs, concurrency)]
+    finally:
+        await runner.cleanup()
+        Completion.log_completion = log_completion
+
+    return {
+        "conversations": num_conversations,
+        "failed": sum(result["error"] is not None for result in results),
+        "requests": {
+            f"{completion_type} {call_type}": {
+                "settings": [json.loads(settings) for settings in parts["settings"]],
+                "numPrompts": len(parts["prompts"]),
+                "maxLogitBiases": max(parts["logitBiases"]),
+                "maxBodyBytes": max(parts["bodyBytes"]),
+            }
+            for (completion_type, call_type), parts in requests.items()
+        },
+    }
+
+
+def main(argv: list[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--conversations", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=8090)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.ERROR)
+    result = asyncio.run(run(args.conversations, args.concurrency, args.port))
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Micro-benchmark of parsing structured `tag: value` completions, comparing the compiled `TagParser` against the
+original split-based implementation, which is kept here as the reference that the parser must match.
+
+Usage:
+    python -m benchmarks.tag_parsing --words 50 1000 --number 2000
+"""
+from __future__ import annotations
+
+import argparse
+import logging
+import random
+import timeit
+from collections import OrderedDict
+
+from conversation.tag_parser import TagParser
+
+TAGS = ["Thought", "TUTOR", "Translation", "Grammar Feedback", "(Conversation Finished)"]
+WORDS = ["hola", "café", "gracias", "por", "favor", "quiero", "un", "con", "leche", "sí", "claro", "muy", "bien"]
+
+
+def reference_parse_tags(completion: str, tags: list[str]) -> OrderedDict[str, str]:
+    """The original `Completion.parse_tags_from_completion`, without logging"""
+    text = completion
+    parsed_tags = OrderedDict()
+    prev_tag = "dummy_tag"
+
+    for tag in tags:
+        try:
+            prev_tag_value, text = text.split(tag + ":")
+            parsed_tags[prev_tag] = prev_tag_value.strip()
+            prev_tag = tag
+        except:
+            break
+
+    parsed_tags[prev_tag] = text.strip()
+    parsed_tags.pop("dummy_tag")
+
+    return parsed_tags
+
+
+def reference_get_parsed_tags(completion: str, tags: list[str], format: str = None) -> OrderedDict[str, str]:
+    """The original `Completion.get_parsed_tags`"""
+    if format:
+        completion = completion.replace(f"```{format}", "").replace("```", "").strip()
+    return reference_parse_tags(completion, tags)
+
+
+def generate_completion(num_words: int, rng: random.Random, tags: list[str] = TAGS) -> str:
+    """Generate a completion with a value of `num_words` words for each tag, occasionally dropping or repeating tags"""
+    lines = []
+    for tag in tags:
+        roll = rng.random()
+        if roll < 0.05:
+            continue
+        value = " ".join(rng.choices(WORDS, k=num_words))
+        lines.append(f"{tag}: {value}")
+        if roll > 0.97:
+            lines.append(f"{tag}: {value}")
+    return "\n".join(lines)
+
+
+def check_results(completion: str, tags: list[str]) -> None:
+    parsed_tags = TagParser.for_tags(tuple(tags)).parse(completion)
+    assert parsed_tags == reference_parse_tags(completion, tags)
+    assert [tag for tag in tags if tag not in parsed_tags] == list(parsed_tags.missing)
+
+
+def run(num_words: int, number: int, rng: random.Random) -> None:
+    completion = generate_completion(num_words, random.Random(0), tags=TAGS)
+    fenced_completion = f"```yaml\n{completion}\n```"
+    parser = TagParser.for_tags(tuple(TAGS))
+
+    benchmarks = [
+        ("reference", lambda: reference_parse_tags(completion, TAGS)),
+        ("current", lambda: parser.parse(completion)),
+        ("reference yaml", lambda: reference_get_parsed_tags(fenced_completion, TAGS, "yaml")),
+        ("current yaml", lambda: parser.parse(TagParser.extract_fenced(fenced_completion, "yaml"))),
+    ]
+    for name, fn in benchmarks:
+        seconds = min(timeit.repeat(fn, number=number, repeat=5)) / number
+        print(f"{len(completion):>8} chars {name:>15}: {seconds * 1e6:>9.2f} µs/completion")
+
+
+def main(argv: list[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--words", type=int, nargs="+", default=[50, 1000])
+    parser.add_argument("--number", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    # the parser logs every tag it can't parse
+    logging.disable(logging.INFO)
+    rng = random.Random(args.seed)
+    for _ in range(1000):
+        tags = rng.sample(TAGS, rng.randint(0, len(TAGS)))
+        check_results(generate_completion(rng.randint(0, 5), rng, tags), tags)
+    for num_words in args.words:
+        run(num_words, args.number, rng)
+
+
+if __name__ == "__main__":
+    main()
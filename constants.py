@@ -3,6 +3,20 @@ from __future__ import annotations
 OPENAI_DEFAULT_ORG = "org-rLNji6jLWwehfYmefEU2cZCW"
 OPENAI_DV3_ORG = "org-9CE5iEdYD0tXQvriOfqEa4l8"
 OPENAI_MODEL_FALLBACKS = {"gpt-dv-speak": "gpt-4"}
+# Requests-per-minute and tokens-per-minute limits by model; requests are paced to stay under them
+OPENAI_MODEL_RATE_LIMITS = {
+    "gpt-3.5-turbo": {"rpm": 3500, "tpm": 90000},
+    "gpt-4": {"rpm": 200, "tpm": 40000},
+    "gpt-dv-speak": {"rpm": 200, "tpm": 40000},
+    "text-davinci-002": {"rpm": 3000, "tpm": 250000},
+    "text-davinci-003": {"rpm": 3000, "tpm": 250000},
+}
+# Each attempt of a request reserves its estimated tokens (prompt + max_tokens). Tokens the completion didn't use are
+# returned once it succeeds, and the whole reservation is returned when an attempt fails to connect to the API, so the
+# API never received it. Other failed attempts keep their reservation, since the API may have counted their tokens:
+# attempts that time out or lose their connection after the request was sent, and attempts that fail with an error
+# response. Repeated failures like these over-reserve and pace requests below the limits until the buckets refill.
+RATE_LIMIT_WAIT_WARNING = 10.0  # seconds; longer waits for rate limit budget are logged as a warning
 
 
 MP3 = "mp3"
@@ -21,14 +35,97 @@ AGENT_LABEL = "agentLabel"
 USER_LABEL = "userLabel"
 DIALOGUE_TAGS = "dialogueTags"
 TAGS = "completionTags"
+LESSON = "lesson"
+USER_PROFILE = "userProfile"
+SCENARIO_ID = "scenarioId"
+NUM_CONVERSATIONS = "numConversations"
 CHAT_COMPLETION_FORMAT = "yaml"
 
 
+# Connection pool for the shared aiohttp session
+HTTP_CONNECTION_LIMIT = 200
+HTTP_CONNECTION_LIMIT_PER_HOST = 100
+HTTP_KEEPALIVE_TIMEOUT = 60  # seconds an idle connection is kept open for reuse
+HTTP_DNS_CACHE_TTL = 300  # seconds
+
+
+class CallType:
+    AGENT = "stepAgent"
+    USER = "stepUser"
+    END_CONVERSATION = "endConversation"
+
+
 # Default timeouts by LM call_type
 GLOBAL_TIMEOUT = 300
 DEFAULT_TIMEOUTS = {
-    "stepAgent": 5,
+    CallType.AGENT: 5,
+}
+
+
+# Completion cache
+COMPLETION_CACHE_MAX_ENTRIES = 10000  # entries held in the in-memory tier
+# seconds to wait for the SQLite tier while another process (e.g. a batch worker) holds its write lock; this blocks
+# the event loop, so it is kept short and a write that still can't get the lock is skipped
+COMPLETION_CACHE_DB_TIMEOUT = 1.0
+
+
+# Completion log
+COMPLETION_LOG_SAMPLE_RATE = 1.0  # fraction of completion records that include the request, prompt and output
+COMPLETION_LOG_MAX_PAYLOAD_CHARS = 2000  # strings in logged payloads are truncated to this length
+
+
+# Metrics
+METRICS_LATENCY_BUCKETS_MS = (
+    10, 25, 50, 100, 200, 300, 400, 500, 750, 1000, 1500, 2000, 3000, 5000, 7500, 10000, 20000, 30000, 60000, 120000,
+)
+METRICS_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 40, 80)  # e.g. turns per conversation
+CLOUD_MONITORING_METRIC_PREFIX = "custom.googleapis.com/conversation_simulator"
+CLOUD_MONITORING_MAX_TIME_SERIES_PER_REQUEST = 200
+
+
+# Profiling
+LOOP_LAG_INTERVAL = 0.05  # seconds between event loop lag probes
+LOOP_LAG_WARNING_MS = 100  # loop lag above this is logged as a warning
+LOOP_LAG_BUCKETS_MS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+FUNCTION_DURATION_BUCKETS_MS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100)
+PROFILER_SAMPLE_INTERVAL = 0.005  # seconds between stack samples of the sampling profiler
+
+
+# Batch generation
+DEFAULT_MAX_CONCURRENT_CONVERSATIONS = 20
+BATCH_PROGRESS_INTERVAL = 30  # seconds between progress log lines
+# With worker processes, results are written in job order, so jobs are only handed out to the workers up to this
+# many jobs ahead of the next one to be written; this bounds the results held back for ordering
+BATCH_WORKER_REORDER_WINDOW = 1000
+BATCH_WORKER_POLL_INTERVAL = 0.1  # seconds between checks that the workers are alive while waiting for results
+
+
+# Maximum number of token logprobs kept per completion; older tokens are dropped once it is exceeded
+MAX_LOGPROB_TOKENS = 2048
+
+
+# Token counting
+TOKEN_COUNT_CACHE_MAX_ENTRIES = 50000  # memoized token counts of message contents and prompt lines
+# Context window sizes in tokens by model, matched by the longest model name prefix; older dialogue turns are
+# trimmed so that the prompt and the completion fit in the context window. Models not listed are never trimmed.
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16385,
+    "gpt-3.5-turbo-1106": 16385,
+    "gpt-3.5-turbo-0125": 16385,
+    "gpt-3.5-turbo-instruct": 4096,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "gpt-dv-speak": 8192,
+    "text-davinci-002": 4097,
+    "text-davinci-003": 4097,
 }
+CONTEXT_WINDOW_MARGIN = 32  # tokens kept free for completion primers and token count estimation error
+# Dialogues are trimmed in steps of this many turns, so that the first turn of a trimmed dialogue (and so the prefix
+# of its requests, which the provider's prompt caching reuses) only moves every few turns rather than on every turn
+CONTEXT_TRIM_CHECKPOINT_TURNS = 8
 
 
 ANNOTATION_MIN_TOKEN_LENGTH = 4
@@ -0,0 +1,116 @@
+"""Context budgeting: trim the oldest turns of a dialogue so that a request fits in the context window of its model.
+
+The prompt (i.e. the system message of chat completions) and the last `DIALOGUE_CONTEXT_NUM_TURNS` turns are always
+kept, so a request may still exceed the context window if they alone don't fit. Turns are trimmed in steps of
+`CONTEXT_TRIM_CHECKPOINT_TURNS`, so that consecutive requests of a conversation keep sharing a prefix.
+"""
+from __future__ import annotations
+
+import logging
+from typing import Any
+
+from api.completion import ChatCompletion
+from api.completion import Completion
+from api.completion import CompletionType
+from api.completion import TextCompletion
+from api.tokens import count_message_tokens
+from api.tokens import count_prompt_tokens
+from api.tokens import DEFAULT_CHAT_MODEL
+from api.tokens import get_chat_format
+from api.tokens import REPLY_PRIMER_NUM_TOKENS
+from constants import CONTEXT_TRIM_CHECKPOINT_TURNS
+from constants import CONTEXT_WINDOW_MARGIN
+from constants import DIALOGUE_CONTEXT_NUM_TURNS
+from constants import MODEL_CONTEXT_WINDOWS
+from conversation.dialogue import Dialogue
+from conversation.dialogue import TEXT_FORMAT
+
+logger = logging.getLogger(__name__)
+
+
+def get_context_window(model: str) -> int | None:
+    """Return the context window of a model, by the longest matching model name prefix, or None if it is unknown"""
+    matches = [prefix for prefix in MODEL_CONTEXT_WINDOWS if model.startswith(prefix)]
+    return MODEL_CONTEXT_WINDOWS[max(matches, key=len)] if matches else None
+
+
+def get_context_start(
+    dialogue: Dialogue,
+    prompt: str,
+    settings: dict[str, Any],
+    format: str | None = TEXT_FORMAT,
+    tags: bool = False,
+    suffix: str | list[dict[str, str]] = None,
+) -> int:
+    """Return the index of the first dialogue turn to include in a request, so that the prompt, the dialogue from
+    that turn and `max_tokens` of completion fit in the context window of the model
+
+    Parameters
+    ----------
+    dialogue : Dialogue
+        the dialogue to trim
+    prompt : str
+        the prompt preceding the dialogue, or the system message of chat completions
+    settings : Dict[str, Any]
+        the settings of the completion, from which the model and `max_tokens` are taken
+    format : Optional[str]
+        `TEXT_FORMAT` for text completions, or the format of the dialogue messages of chat completions
+    tags : bool
+        whether the dialogue is rendered with all tags
+    suffix : Optional[Union[str, List[Dict[str, str]]]]
+        any text (for text completions) or messages (for chat completions) added to the request after the dialogue
+
+    Returns
+    -------
+    int
+        the index of the first turn to include, or 0 if the whole dialogue fits or the model's context window is
+        unknown
+    """
+    text = Completion.get_completion_type(settings) == CompletionType.TEXT
+    default_params = (TextCompletion if text else ChatCompletion).default_params
+    model = settings.get("model") or default_params["model"]
+    context_window = get_context_window(model)
+    if context_window is None:
+        return 0
+
+    if text:
+        budget = context_window - count_prompt_tokens(prompt, model) - 1
+        if suffix:
+            budget -= count_prompt_tokens(suffix, model)
+    else:
+        try:
+            get_chat_format(model)
+        except NotImplementedError:
+            model = DEFAULT_CHAT_MODEL
+        budget = (
+            context_window
+            - count_message_tokens({"role": "system", "content": prompt}, model)
+            - REPLY_PRIMER_NUM_TOKENS
+            - sum(count_message_tokens(message, model) for message in suffix or [])
+        )
+    budget -= (
+        settings.get("max_tokens", default_params["max_tokens"]) or 0
+    ) + CONTEXT_WINDOW_MARGIN
+
+    num_tokens = (
+        dialogue.count_dialogue_tokens(model, tags)
+        if format == TEXT_FORMAT
+        else dialogue.count_message_tokens(model, format, tags)
+    )
+    if num_tokens <= budget:
+        return 0
+
+    counts = dialogue.get_token_counts(model, format, tags)
+    start, last_start = 0, max(len(counts) - DIALOGUE_CONTEXT_NUM_TURNS, 0)
+    while start < last_start and (
+        num_tokens > budget or start % CONTEXT_TRIM_CHECKPOINT_TURNS
+    ):
+        # each dropped turn of a text dialogue also drops the newline joining it to the next turn
+        num_tokens -= counts[start] + (format == TEXT_FORMAT)
+        start += 1
+
+    logger.info(
+        f"Trimmed {start} of {len(counts)} dialogue turns to fit the context window of {model}: "
+        f"<dialogueTokens:{num_tokens}> <budgetTokens:{budget}>"
+    )
+    return start
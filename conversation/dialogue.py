@@ -7,11 +7,18 @@ from typing import Dict
 from typing import List
 from typing import Tuple
 
+from api.profiling import timed
+from api.tokens import count_message_tokens
+from api.tokens import count_tokens
 from constants import DIALOGUE_TAGS
 from constants import Speaker
 
 
 class Turn:
+    """An immutable turn of a dialogue. Turns are slotted since a batch of conversations holds many of them."""
+
+    __slots__ = ("id", "speaker", "speaker_label", "text", "tags")
+
     def __init__(
         self,
         turn_id: str,
@@ -20,11 +27,17 @@ class Turn:
         text: str,
         tags: OrderedDict[str, str],
     ):
-        self.id = turn_id
-        self.speaker = speaker
-        self.speaker_label = speaker_label
-        self.text = text
-        self.tags = tags
+        object.__setattr__(self, "id", turn_id)
+        object.__setattr__(self, "speaker", speaker)
+        object.__setattr__(self, "speaker_label", speaker_label)
+        object.__setattr__(self, "text", text)
+        object.__setattr__(self, "tags", tags)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
 
     def get_turn(self) -> str:
         """Get turn constructed with only the speaker and text"""
@@ -38,9 +51,60 @@ class Turn:
         return self.speaker == Speaker.USER
 
 
+def relabel_turn(
+    turn: Turn, user_label: str, agent_label: str, swap_speakers: bool = False
+) -> Turn:
+    """Copy a turn with the speaker label for its speaker, optionally swapping the user and agent speakers"""
+    speaker = turn.speaker
+    if swap_speakers:
+        speaker = Speaker.AGENT if speaker == Speaker.USER else Speaker.USER
+    return Turn(
+        turn.id,
+        speaker,
+        user_label if speaker == Speaker.USER else agent_label,
+        turn.text,
+        {} if swap_speakers else turn.tags,
+    )
+
+
+def get_turn_as_message(turn: Turn, format: str = None, tags: bool = True) -> dict[str, str]:
+    """Get a turn as a message for Chat-style completions"""
+    content = turn.get_turn_with_tags() if tags else turn.get_turn()
+    return {
+        "role": turn.speaker if turn.speaker == Speaker.USER else "assistant",
+        "content": f"```{format}\n{content}\n```" if format else content,
+    }
+
+
+TEXT_FORMAT = "text"
+
+
+def count_turn_tokens(turn: Turn, model: str, format: str | None, tags: bool) -> int:
+    """Count the tokens of a turn as rendered in a text prompt, or as a chat message in the given format"""
+    if format == TEXT_FORMAT:
+        return count_tokens(turn.get_turn_with_tags() if tags else turn.get_turn(), model)
+    return count_message_tokens(get_turn_as_message(turn, format, tags), model)
+
+
 class Dialogue:
-    def __init__(self, turns: list[Turn]):
+    """An append-only sequence of turns. Renderings of the dialogue (plain text, tagged text and chat messages) and
+    their token counts are cached on first use and extended incrementally as turns are appended, so rendering the
+    dialogue on every turn of a conversation doesn't re-render or re-count all previous turns. Turns must only be
+    added through `append`."""
+
+    def __init__(
+        self, turns: list[Turn], user_label: str = None, agent_label: str = None
+    ):
         self.turns = turns
+        self.user_label = user_label  # speaker labels of the turns, if known
+        self.agent_label = agent_label
+        self._texts: dict[bool, str] = {}  # joined dialogue text, by whether tags are included
+        self._messages: dict[tuple[str | None, bool], list[dict[str, str]]] = {}
+        self._views: dict[tuple[str, str, bool], Dialogue] = {}
+        # token counts of each rendered turn and their running totals, by model, message format and whether tags
+        # are included; a format of `TEXT_FORMAT` stands for the plain text rendering
+        self._token_counts: dict[tuple[str, str | None, bool], list[int]] = {}
+        self._token_totals: dict[tuple[str, str | None, bool], int] = {}
 
     @classmethod
     def from_turns(
@@ -50,16 +114,9 @@ class Dialogue:
         agent_label: str = Speaker.AGENT,
     ) -> Dialogue:
         return Dialogue(
-            [
-                Turn(
-                    turn.id,
-                    turn.speaker,
-                    user_label if turn.speaker == Speaker.USER else agent_label,
-                    turn.text,
-                    turn.tags,
-                )
-                for turn in turns
-            ]
+            [relabel_turn(turn, user_label, agent_label) for turn in turns],
+            user_label,
+            agent_label,
         )
 
     @classmethod
@@ -107,7 +164,9 @@ class Dialogue:
                     ),
                 )
                 for turn in turns
-            ]
+            ],
+            user_label,
+            agent_label,
         )
 
     def __getitem__(self, idx):
@@ -116,28 +175,106 @@ class Dialogue:
     def __len__(self):
         return len(self.turns)
 
+    @timed
     def append(self, turn: Turn) -> None:
         self.turns.append(turn)
 
-    def get_dialogue(self) -> str:
-        """Get dialogue constructed with only the speaker and text"""
-        return "\n".join(turn.get_turn() for turn in self.turns)
-
-    def get_dialogue_with_tags(self) -> str:
-        """Get dialogue constructed with all tags"""
-        return "\n".join(turn.get_turn_with_tags() for turn in self.turns)
-
-    def get_dialogue_as_messages(self, format=None, tags=True) -> list[dict[str, str]]:
-        """Get dialogue as a list of turns for Chat-style completions"""
-        return [
-            {
-                "role": turn.speaker if turn.speaker == Speaker.USER else "assistant",
-                "content": f"```{format}\n{turn.get_turn_with_tags() if tags else turn.get_turn()}\n```"
-                if format
-                else (turn.get_turn_with_tags() if tags else turn.get_turn()),
-            }
-            for turn in self.turns
-        ]
+        # extend cached renderings and views with the new turn
+        for tags, text in self._texts.items():
+            rendered_turn = turn.get_turn_with_tags() if tags else turn.get_turn()
+            self._texts[tags] = (
+                f"{text}\n{rendered_turn}" if len(self.turns) > 1 else rendered_turn
+            )
+        for (format, tags), messages in self._messages.items():
+            messages.append(get_turn_as_message(turn, format, tags))
+        for (model, format, tags), counts in self._token_counts.items():
+            num_tokens = count_turn_tokens(turn, model, format, tags)
+            counts.append(num_tokens)
+            self._token_totals[model, format, tags] += num_tokens
+        for (user_label, agent_label, swap_speakers), view in self._views.items():
+            view.append(relabel_turn(turn, user_label, agent_label, swap_speakers))
+
+    @timed
+    def get_view(
+        self, user_label: str, agent_label: str, swap_speakers: bool = False
+    ) -> Dialogue:
+        """Get the dialogue with new speaker labels, and optionally with the user and agent speakers swapped, e.g. to
+        prompt a simulated user with the dialogue from its own point of view. The view is cached and kept up to date
+        as turns are appended to this dialogue."""
+        if not swap_speakers and (user_label, agent_label) == (
+            self.user_label,
+            self.agent_label,
+        ):
+            return self
+
+        key = (user_label, agent_label, swap_speakers)
+        if key not in self._views:
+            self._views[key] = Dialogue(
+                [relabel_turn(turn, *key) for turn in self.turns],
+                user_label,
+                agent_label,
+            )
+        return self._views[key]
+
+    @timed
+    def _get_text(self, tags: bool, start: int = 0) -> str:
+        if start:
+            # only the full dialogue is cached, since the start of a trimmed dialogue moves as turns are appended
+            return "\n".join(
+                turn.get_turn_with_tags() if tags else turn.get_turn()
+                for turn in self.turns[start:]
+            )
+        if tags not in self._texts:
+            self._texts[tags] = "\n".join(
+                turn.get_turn_with_tags() if tags else turn.get_turn()
+                for turn in self.turns
+            )
+        return self._texts[tags]
+
+    def get_dialogue(self, start: int = 0) -> str:
+        """Get dialogue constructed with only the speaker and text, from the turn at index `start`"""
+        return self._get_text(tags=False, start=start)
+
+    def get_dialogue_with_tags(self, start: int = 0) -> str:
+        """Get dialogue constructed with all tags, from the turn at index `start`"""
+        return self._get_text(tags=True, start=start)
+
+    @timed
+    def get_dialogue_as_messages(
+        self, format=None, tags=True, start: int = 0
+    ) -> list[dict[str, str]]:
+        """Get dialogue as a list of turns for Chat-style completions, from the turn at index `start`. The returned
+        list is a copy that can be extended, but the messages themselves are shared and must not be modified."""
+        key = (format, tags)
+        if key not in self._messages:
+            self._messages[key] = [
+                get_turn_as_message(turn, format, tags) for turn in self.turns
+            ]
+        return self._messages[key][start:]
+
+    def get_token_counts(
+        self, model: str, format: str | None = TEXT_FORMAT, tags: bool = False
+    ) -> list[int]:
+        """Get the number of tokens of each turn, as rendered in the dialogue text (the default) or as a chat message
+        in the given format. The counts are kept up to date as turns are appended and must not be modified."""
+        key = (model, format, tags)
+        if key not in self._token_counts:
+            self._token_counts[key] = [
+                count_turn_tokens(turn, model, format, tags) for turn in self.turns
+            ]
+            self._token_totals[key] = sum(self._token_counts[key])
+        return self._token_counts[key]
+
+    def count_dialogue_tokens(self, model: str, tags: bool = False) -> int:
+        """Count the tokens of the dialogue text. Turns are counted separately and joined by a newline each, so the
+        count may be a few tokens over the exact count of the joined text."""
+        self.get_token_counts(model, TEXT_FORMAT, tags)
+        return self._token_totals[model, TEXT_FORMAT, tags] + max(len(self.turns) - 1, 0)
+
+    def count_message_tokens(self, model: str, format: str = None, tags: bool = True) -> int:
+        """Count the tokens the dialogue adds to a chat request as messages in the given format"""
+        self.get_token_counts(model, format, tags)
+        return self._token_totals[model, format, tags]
 
     def get_paired_dialogue(self) -> tuple[str, dict[int, str]]:
         """Get dialogue constructed as a sequence of pairs of Agent/User turns:
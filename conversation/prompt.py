@@ -1,8 +1,10 @@
 from __future__ import annotations
 
+from types import MappingProxyType
 from typing import Any
 from typing import Dict
 from typing import List
+from typing import Mapping
 
 from constants import AGENT_LABEL
 from constants import PROMPT
@@ -12,8 +14,43 @@ from constants import TAGS
 from constants import USER_LABEL
 
 
+def freeze_settings(settings: Mapping[str, Any]) -> Mapping[str, Any]:
+    """Return a read-only copy of completion settings, with list values (e.g. stop sequences) copied to tuples and
+    mapping values (e.g. logit biases) copied to read-only mappings, so that the settings share no mutable state with
+    the caller"""
+    return MappingProxyType(
+        {
+            param: tuple(value)
+            if isinstance(value, list)
+            else MappingProxyType(dict(value))
+            if isinstance(value, Mapping)
+            else value
+            for param, value in settings.items()
+        }
+    )
+
+
+def thaw_settings(settings: Mapping[str, Any]) -> dict[str, Any]:
+    """Return a plain copy of read-only completion settings, with mapping values copied to dicts"""
+    return {
+        param: dict(value) if isinstance(value, Mapping) else value
+        for param, value in settings.items()
+    }
+
+
+def restore_prompt(cls: type, state: dict[str, Any]) -> Prompt:
+    """Recreate a pickled prompt from the values of its attributes"""
+    prompt = object.__new__(cls)
+    for name, value in state.items():
+        object.__setattr__(prompt, name, freeze_settings(value) if name == "settings" else value)
+    return prompt
+
+
 class Prompt:
-    """Base prompt class that holds a string prompt and all associated settings"""
+    """Base prompt class that holds a string prompt and all associated settings. Prompts are immutable templates that
+    are shared by concurrent conversations; per-call changes are made on a copy with `replace` or `with_settings`."""
+
+    __slots__ = ("prompt", "settings")
 
     def __init__(self, prompt: str, settings: dict[str, Any]):
         """
@@ -29,8 +66,40 @@ class Prompt:
                     "stop": ["User:", "Agent:"]
                 }
         """
-        self.prompt = prompt
-        self.settings = settings
+        object.__setattr__(self, "prompt", prompt)
+        object.__setattr__(self, "settings", freeze_settings(settings))
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def replace(self, **changes: Any) -> Prompt:
+        """Return a copy of the prompt with the given attributes replaced"""
+        prompt = object.__new__(type(self))
+        for cls in type(self).__mro__[:-1]:
+            for name in cls.__slots__:
+                value = changes[name] if name in changes else getattr(self, name)
+                if name == "settings" and name in changes:
+                    value = freeze_settings(value)
+                object.__setattr__(prompt, name, value)
+        return prompt
+
+    def __reduce__(self) -> tuple:
+        # read-only mappings can't be pickled, so the settings are pickled as plain dicts, e.g. to send a prompt to a
+        # worker process
+        state = {
+            name: getattr(self, name)
+            for cls in type(self).__mro__[:-1]
+            for name in cls.__slots__
+        }
+        state["settings"] = thaw_settings(self.settings)
+        return restore_prompt, (type(self), state)
+
+    def with_settings(self, **overrides: Any) -> Prompt:
+        """Return a copy of the prompt with the given settings overlaid on its settings"""
+        return self.replace(settings={**self.settings, **overrides})
 
 
 class StructuredPrompt(Prompt):
@@ -38,9 +107,11 @@ class StructuredPrompt(Prompt):
     a completion in a structured `tag: value` format, that is easily parseable using an ordered list of tags.
     """
 
+    __slots__ = ("tags",)
+
     def __init__(self, prompt: str, settings: dict[str, Any], tags: list[str]):
         super().__init__(prompt, settings)
-        self.tags = tags
+        object.__setattr__(self, "tags", tuple(tags))
 
     @classmethod
     def from_json(cls, structured_prompt: dict[str, Any]) -> StructuredPrompt:
@@ -69,6 +140,8 @@ class LessonPrompt(StructuredPrompt):
     """A structured prompt that is specifically designed to support a conversation. This necessitates a user and
     agent label to be able to properly generate a completion"""
 
+    __slots__ = ("user_label", "agent_label")
+
     def __init__(
         self,
         prompt: str,
@@ -77,10 +150,9 @@ class LessonPrompt(StructuredPrompt):
         user_label: str,
         agent_label: str,
     ):
-        super().__init__(prompt, settings, tags)
-        self.user_label = user_label
-        self.agent_label = agent_label
-        self.settings["stop"] = [f"{self.user_label}:"]
+        super().__init__(prompt, {**settings, "stop": [f"{user_label}:"]}, tags)
+        object.__setattr__(self, "user_label", user_label)
+        object.__setattr__(self, "agent_label", agent_label)
 
     @classmethod
     def from_json(cls, lesson_prompt: dict[str, Any]) -> LessonPrompt:
@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import logging
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Iterable
+
+logger = logging.getLogger(__name__)
+
+FENCE = "```"
+
+
+class ParsedTags(OrderedDict):
+    """Map of tag keys to parsed values, in the order of the tags, along with the tags that couldn't be parsed"""
+
+    missing: tuple[str, ...] = ()
+
+
+class TagParser:
+    """Parser for completions in a structured `tag: value` format, compiled once for an ordered list of tags.
+
+    Tags are parsed from a free-form string. There are a few basic assumptions:
+
+            1. The tags are present in the string in order
+            2. Each tag is followed by a colon
+            3. Tag keys will be parsed exactly without any lowercasing, punctuation removal, etc.
+            4. No tag will occur twice in the completion string
+
+    Parsing stops at the first tag that is absent from the rest of the completion, or occurs in it more than once;
+    the rest of the completion is then the value of the previous tag, and that tag and all later ones are missing.
+    """
+
+    def __init__(self, tags: Iterable[str]):
+        self.tags = tuple(tags)
+        self.markers = tuple(tag + ":" for tag in self.tags)
+        self._scanner = tuple(
+            (tag, marker, len(marker)) for tag, marker in zip(self.tags, self.markers)
+        )
+
+    @classmethod
+    @lru_cache(maxsize=256)
+    def for_tags(cls, tags: tuple[str, ...]) -> TagParser:
+        """Return a shared parser for an ordered tuple of tags"""
+        return cls(tags)
+
+    @staticmethod
+    def extract_fenced(completion: str, format: str = None) -> str:
+        """Return the contents of the fenced code blocks in a completion, e.g. ```yaml ... ```, or the completion
+        itself if it has none. An unterminated block, e.g. from a truncated completion, runs to the end.
+
+        A block opened with ```<format> starts right after the format, so that a block on a single line, e.g.
+        ```yaml Agent: hi```, keeps its contents. Other opening fences are followed by an info string up to the end of
+        the line; if there is no block after all, the fences are stripped from the completion instead."""
+        blocks = []
+        fence_start = completion.find(FENCE)
+        while fence_start != -1:
+            info_start = fence_start + len(FENCE)
+            if format and completion.startswith(format, info_start):
+                block_start = info_start + len(format)
+            else:
+                # skip the info string of the opening fence, e.g. `yaml`
+                block_start = completion.find("\n", info_start)
+                if block_start == -1:
+                    break
+            block_end = completion.find(FENCE, block_start)
+            blocks.append(completion[block_start : None if block_end == -1 else block_end])
+            fence_start = -1 if block_end == -1 else completion.find(FENCE, block_end + len(FENCE))
+
+        if blocks:
+            return "\n".join(blocks).strip()
+        if FENCE not in completion:
+            return completion
+        if format:
+            completion = completion.replace(f"{FENCE}{format}", "")
+        return completion.replace(FENCE, "").strip()
+
+    def parse(
+        self, completion: str, activity_id: str = None, turn_id: str = None
+    ) -> ParsedTags:
+        """Parse the tags from a completion by slicing it in place, without copying the rest of the completion
+
+        Each tag is found with one `find` from the end of the previous tag, and checked against duplicates with
+        another `find` over the rest of the completion, so the work grows with the number of tags times the length
+        of the completion; completions here carry only a handful of tags.
+
+        Parameters
+        ----------
+        completion : str
+            string containing tag keys and values
+
+        Returns
+        -------
+        ParsedTags
+            map of tag keys to parsed values, with the tags that couldn't be parsed in `missing`
+        """
+        parsed_tags = ParsedTags()
+        prev_tag, value_start = None, 0
+
+        for i, (tag, marker, marker_end) in enumerate(self._scanner):
+            start = completion.find(marker, value_start)
+            if start == -1 or completion.find(marker, start + marker_end) != -1:
+                logger.info(
+                    "activityId=%s :: turnId=%s :: Couldn't parse tag [%s] from completion: %s",
+                    activity_id,
+                    turn_id,
+                    tag,
+                    completion,
+                )
+                parsed_tags.missing = self.tags[i:]
+                break
+
+            if prev_tag is not None:
+                parsed_tags[prev_tag] = completion[value_start:start].strip()
+            prev_tag, value_start = tag, start + marker_end
+
+        if prev_tag is not None:
+            parsed_tags[prev_tag] = completion[value_start:].strip()
+
+        return parsed_tags
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import asyncio
 import base64
 import json
 import logging
@@ -7,24 +8,50 @@ import math
 from asyncio import create_subprocess_exec
 from asyncio import subprocess
 from collections import OrderedDict
+from functools import lru_cache
 import re
+from array import array
 from time import time
 from typing import Any
 from typing import AsyncGenerator
+from typing import Awaitable
+from typing import Callable
+from typing import Sequence
+from typing import TypeVar
 from typing import Tuple
 
-from transformers import GPT2TokenizerFast
-
+from api.profiling import timed
+from api.tokens import get_encoding
 from constants import DEFAULT_END_CONVERSATION_THRESHOLD
 from constants import END_CONVERSATION_TAG
+
 COMBINE_WHITESPACE = re.compile(r"\s+")
+WORD_SEPARATORS = (" ", "\t", "\n")
+END_OF_TEXT_TOKEN = "<|endoftext|>"
 
-tokenizer = GPT2TokenizerFast.from_pretrained("gpt2")
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(model: str = None) -> Callable[[str], list[int]]:
+    """Return a function that encodes text into token ids, loading the tokenizer on first use. Given a model, the
+    tiktoken encoding of that model is used so that token ids (e.g. for logit biases) match the model being called;
+    otherwise the GPT-2 tokenizer is used."""
+    if model is None:
+        # transformers is slow to import and loads the tokenizer from the HF cache, so only import it when needed
+        from transformers import GPT2TokenizerFast
+
+        tokenizer = GPT2TokenizerFast.from_pretrained("gpt2")
+        return lambda text: tokenizer(text)["input_ids"]
 
-def get_token_ids(text: str) -> list[int]:
-    return tokenizer(text)["input_ids"]
+    return get_encoding(model).encode
+
+
+@timed
+def get_token_ids(text: str, model: str = None) -> list[int]:
+    return get_tokenizer(model)(text)
 
 
 def process_agent_response(utterance: str) -> str:
@@ -40,39 +67,43 @@ def is_conversation_over(tags: dict[str, str]) -> bool:
 
 
 def override_end_conversation_tag(
-    word_logprobs: list[dict[str, Any]],
+    words: list[str],
+    word_logprobs: Sequence[float],
     threshold: float = DEFAULT_END_CONVERSATION_THRESHOLD,
 ) -> bool:
     """Assert the probability of the True/False value of the end-conversation tag is higher than the threshold.
-    For the END_CONVERSATION_TAG, look for the index of the final word, e.g. "Finished)", and check the value and
+    For the END_CONVERSATION_TAG, look up the index of the final word, e.g. "Finished)", and check the value and
     probability of the next word (the tag's value). By default return False.
     """
     end_conversation_final_word = END_CONVERSATION_TAG.split()[-1] + ":"
-    for i in range(len(word_logprobs) - 1):
 
-        # search for the end-conversation tag
-        curr_word = word_logprobs[i]["word"]
-        if end_conversation_final_word != curr_word:
-            continue
+    # search for the first end-conversation tag that is followed by a value
+    try:
+        i = words.index(end_conversation_final_word, 0, len(words) - 1)
+    except ValueError:
+        return False
 
-        next_word = word_logprobs[i + 1]["word"].lower()
-        next_prob = math.exp(word_logprobs[i + 1]["logprob"])
+    next_word = words[i + 1].lower()
+    next_prob = math.exp(word_logprobs[i + 1])
 
-        # if the tag's value is True and below the threshold, overwrite the value to False; else return as-is
-        if next_word == "true" and next_prob <= threshold:
-            logger.warning(
-                f"{END_CONVERSATION_TAG} logprob: {next_prob:.2f} lower than {threshold}; setting to False"
-            )
-            return True
-        break
+    # if the tag's value is True and below the threshold, overwrite the value to False; else return as-is
+    if next_word == "true" and next_prob <= threshold:
+        logger.warning(
+            f"{END_CONVERSATION_TAG} logprob: {next_prob:.2f} lower than {threshold}; setting to False"
+        )
+        return True
 
     return False
 
 
+@timed
 def process_dialogue_tags(
-    tags: OrderedDict[str, str], agent_label: str, word_logprobs: list[dict[str, Any]]
+    tags: OrderedDict[str, str],
+    agent_label: str,
+    words: list[str],
+    word_logprobs: Sequence[float],
 ) -> dict[str, str]:
-    """Post-process the parsed dialogue tags"""
+    """Post-process the parsed dialogue tags, given the words of the completion and their logprobs"""
     if not tags:
         return tags
 
@@ -80,77 +111,164 @@ def process_dialogue_tags(
     if agent_label in tags:
         tags[agent_label] = process_agent_response(tags[agent_label])
 
-    # add first tag from completion primer to word_logprobs with logprob=0 (100% confidence) since we added it manually
-    first_tag = next(iter(tags)) + ":"
-    word_logprobs = [
-        {"word": word, "logprob": 0} for word in first_tag.split()
-    ] + word_logprobs
-
     # confirm that end-conversation tag is over a threshold confidence
-    if END_CONVERSATION_TAG in tags and override_end_conversation_tag(word_logprobs):
-        tags[END_CONVERSATION_TAG] = "False"
+    if END_CONVERSATION_TAG in tags:
+        # add first tag from completion primer to the words with logprob=0 (100% confidence) since we added it manually
+        primer_words = (next(iter(tags)) + ":").split()
+        words = primer_words + words
+        word_logprobs = array("d", [0.0] * len(primer_words)) + array("d", word_logprobs)
+        if override_end_conversation_tag(words, word_logprobs):
+            tags[END_CONVERSATION_TAG] = "False"
 
     return tags
 
 
-def compute_word_logprobs(
-    token_logprobs: list[dict[str, Any]]
-) -> list[dict[str, float]]:
-    """Given the logprobs per token, compute the summed logprob for each whitespace-separated word"""
-    word_logprobs = []
-    curr_word, curr_logprob = "", 0
-
-    for row in token_logprobs:
-        tok, logprob = row["token"], row["logprob"]
-
-        if not tok.strip():
-            word_logprobs.append((curr_word, curr_logprob))
-            curr_word, curr_logprob = "", 0
-
-        elif tok.startswith((" ", "\t", "\n")) or tok == "<|endoftext|>":
-            word_logprobs.append((curr_word, curr_logprob))
-            curr_word, curr_logprob = tok.strip(), logprob
-
-        elif tok.endswith((" ", "\t", "\n")):
-            word_logprobs.append((curr_word + tok.strip(), curr_logprob + logprob))
-            curr_word, curr_logprob = "", 0
+@timed
+def compute_word_boundaries(
+    tokens: list[str], token_logprobs: Sequence[float]
+) -> tuple[list[str], array, array]:
+    """Given the tokens of a completion and their logprobs, compute the whitespace-separated words they form.
+
+    Returns
+    -------
+    words : List[str]
+        the words of the completion
+    word_logprobs : array
+        the summed logprob of each word
+    word_offsets : array
+        the index of the token each word starts at
+    """
+    words, word_logprobs, word_offsets = [], [], []
+    curr_word, curr_logprob, curr_offset = "", 0.0, 0
+
+    # single pass over the tokens, appending each word once it ends; the logprobs of a word are summed in token order
+    for i, (tok, logprob) in enumerate(zip(tokens, token_logprobs)):
+        stripped = tok.strip()
+
+        if not stripped:
+            if curr_word:
+                words.append(curr_word)
+                word_logprobs.append(curr_logprob)
+                word_offsets.append(curr_offset)
+            curr_word, curr_logprob, curr_offset = "", 0.0, i + 1
+
+        elif tok[0] in WORD_SEPARATORS or tok == END_OF_TEXT_TOKEN:
+            if curr_word:
+                words.append(curr_word)
+                word_logprobs.append(curr_logprob)
+                word_offsets.append(curr_offset)
+            curr_word, curr_logprob, curr_offset = stripped, logprob, i
+
+        elif tok[-1] in WORD_SEPARATORS:
+            words.append(curr_word + stripped)
+            word_logprobs.append(curr_logprob + logprob)
+            word_offsets.append(curr_offset)
+            curr_word, curr_logprob, curr_offset = "", 0.0, i + 1
 
         else:
             curr_word += tok
             curr_logprob += logprob
 
-    word_logprobs.append((curr_word, curr_logprob))
+    if curr_word:
+        words.append(curr_word)
+        word_logprobs.append(curr_logprob)
+        word_offsets.append(curr_offset)
 
+    return words, array("d", word_logprobs), array("l", word_offsets)
+
+
+@timed
+def compute_word_logprobs(
+    token_logprobs: list[dict[str, Any]]
+) -> list[dict[str, float]]:
+    """Given the logprobs per token, compute the summed logprob for each whitespace-separated word"""
+    words, word_logprobs, _ = compute_word_boundaries(
+        [row["token"] for row in token_logprobs],
+        [row["logprob"] for row in token_logprobs],
+    )
     return [
         {"word": word, "logprob": logprob}
-        for word, logprob in word_logprobs
-        if word != ""
+        for word, logprob in zip(words, word_logprobs)
     ]
 
 
+async def first_valid(
+    candidates: list[Awaitable[T]], is_valid: Callable[[T], bool]
+) -> T:
+    """Run candidate awaitables concurrently and return the result of the first to finish with a valid result,
+    cancelling the rest.
+
+    If no candidate is valid, the result of the first candidate (in the given order) that didn't raise is returned,
+    so that the outcome is the same as running that candidate alone; if all of them raised, the first exception is
+    raised.
+    """
+    tasks = [asyncio.ensure_future(candidate) for candidate in candidates]
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.exception() and is_valid(task.result()):
+                    return task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+    for task in tasks:
+        if not task.exception():
+            return task.result()
+    raise tasks[0].exception()
+
+
+def get_partial_match_length(text: str, tag: str) -> int:
+    """Return the length of the longest suffix of `text` that is a proper prefix of `tag`"""
+    for length in range(min(len(text), len(tag) - 1), 0, -1):
+        if text.endswith(tag[:length]):
+            return length
+    return 0
+
+
 async def stream_text_between_tags(
     response: AsyncGenerator, start_tag: str, end_tag: str = None
 ) -> AsyncGenerator:
-    """Only stream back the text between the specified tags"""
+    """Only stream back the text between the specified tags. Text is yielded as soon as it arrives, except for a
+    trailing part that could be the beginning of the end tag, which is held back until the next chunk. The response
+    is always consumed to the end, so that the full completion is available once streaming finishes."""
     buffer = ""
-    stream_directly = False
+    started, finished, leading = False, False, True
     async for text in response:
-
-        if buffer.endswith(start_tag):
-            stream_directly = True
-            buffer = ""
-            text = text.lstrip()
-
+        if finished:
+            continue
         buffer += text
 
-        if end_tag:
-            if buffer.endswith(end_tag):
-                stream_directly = False
-                buffer = ""
-
-            if buffer in end_tag:
+        # wait for the start tag, keeping only the part of the buffer that could be the beginning of it
+        if not started:
+            start = buffer.find(start_tag)
+            if start == -1:
+                buffer = buffer[len(buffer) - get_partial_match_length(buffer, start_tag) :]
                 continue
+            started = True
+            buffer = buffer[start + len(start_tag) :]
 
-        if stream_directly:
+        num_held = 0
+        if end_tag:
+            end = buffer.find(end_tag)
+            if end != -1:
+                finished = True
+                buffer = buffer[:end]
+            else:
+                num_held = get_partial_match_length(buffer, end_tag)
+        text, buffer = buffer[: len(buffer) - num_held], buffer[len(buffer) - num_held :]
+
+        # strip the whitespace between the start tag and the text
+        if leading:
+            text = text.lstrip()
+            leading = text == ""
+        if text:
+            yield text
+
+    # the response ended without the end tag, so the held back text wasn't the beginning of it
+    if started and not finished:
+        buffer = buffer.lstrip() if leading else buffer
+        if buffer:
             yield buffer
-            buffer = ""
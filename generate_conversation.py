@@ -4,23 +4,33 @@ from cuid import cuid
 import json
 import logging
 from collections import OrderedDict
+from functools import lru_cache
 from time import time
 from typing import Any
+from typing import AsyncIterator
+from typing import Callable
 
+from api.cache import is_sampled
 from api.completion import Completion
 from api.completion import CompletionType
+from api.metrics import get_metrics_registry
+from api.tracing import span
+from constants import CallType
 from constants import CHAT_COMPLETION_FORMAT
 from constants import END_CONVERSATION_TAG
 from constants import MAX_AGENT_REGENERATIONS
 from constants import MAX_AGENT_RESPONSE_LENGTH
 from constants import MAX_TURNS
 from constants import Speaker
+from conversation.context import get_context_start
 from conversation.dialogue import Dialogue, Turn
 from conversation.prompt import LessonPrompt, Prompt
 from conversation.prompt import StructuredPrompt
+from conversation.utils import first_valid
 from conversation.utils import get_token_ids
 from conversation.utils import is_conversation_over
 from conversation.utils import process_dialogue_tags
+from conversation.utils import stream_text_between_tags
 from utility_prompts.max_turns_prompt import MAX_TURNS_PROMPT
 
 logger = logging.getLogger(__name__)
@@ -31,9 +41,21 @@ DUMMY_MESSAGE_FORMAT = """Each assistant response should be a markdown YAML code
 DUMMY_MESSAGE_LENGTH = """The "{agentLabel}" response should never be more than {maxAgentResponseLength} words, so the previous response was too long. The following message contains a response of the appropriate length."""
 
 
+def get_dialogue(
+    turns: list[Turn] | Dialogue, user_label: str, agent_label: str
+) -> Dialogue:
+    """Get the turns as a Dialogue with the given speaker labels. An existing Dialogue is reused through a view, so
+    that its cached renderings are extended by new turns rather than rebuilt on every call."""
+    if isinstance(turns, Dialogue):
+        return turns.get_view(user_label, agent_label)
+    return Dialogue.from_turns(turns, user_label, agent_label)
+
+
 async def end_conversation_gracefully(
     dialogue: Dialogue,
     lesson_prompt: LessonPrompt,
+    activity_id: str = None,
+    turn_id: str = None,
 ) -> OrderedDict[str, str]:
     """Generate an agent response that responds to the previous user utterance and ends the conversation
 
@@ -58,7 +80,9 @@ async def end_conversation_gracefully(
         completion_primer=completion_primer,
         settings=utility_prompt.settings,
     )
-    await completion.generate_completion()
+    await completion.generate_completion(
+        activity_id=activity_id, turn_id=turn_id, call_type=CallType.END_CONVERSATION
+    )
 
     # parse tags from completion
     parsed_tags = completion.get_parsed_tags(utility_prompt.tags)
@@ -73,13 +97,56 @@ async def end_conversation_gracefully(
     return generated_tags
 
 
+@lru_cache(maxsize=256)
+def fill_prompt_guidelines(prompt: str, agent_label: str) -> str:
+    """Fill in the response guidelines of a lesson prompt. Memoized, since the same lesson prompt is filled in on every
+    agent turn of every conversation."""
+    guidelines = LESSON_PROMPT_GUIDELINES.format(
+        agentLabel=agent_label,
+        maxAgentResponseLength=MAX_AGENT_RESPONSE_LENGTH,
+    )
+    return prompt.replace(  # .format() fails if there are curly braces or json in the prompt
+        "{promptGuidelines}", guidelines
+    )
+
+
+def prepare_agent_prompt(
+    turns: list[Turn] | Dialogue, lesson_prompt: LessonPrompt
+) -> tuple[Dialogue, LessonPrompt]:
+    """Get the dialogue from the agent's point of view, and a copy of the lesson prompt with its response guidelines
+    filled in. The lesson prompt itself is shared by concurrent conversations and is left unchanged."""
+    dialogue = get_dialogue(turns, lesson_prompt.user_label, lesson_prompt.agent_label)
+    prompt = fill_prompt_guidelines(lesson_prompt.prompt, lesson_prompt.agent_label)
+    return dialogue, lesson_prompt.replace(prompt=prompt)
+
+
+def get_agent_turn(
+    generated_tags: OrderedDict[str, str], lesson_prompt: LessonPrompt, turn_id: str = None
+) -> tuple[Turn, bool]:
+    """Return the agent turn for the generated tags, with a new turn ID unless one is given, and whether it ends the
+    conversation"""
+    conversation_over = is_conversation_over(generated_tags)
+
+    return Turn(
+        turn_id=turn_id or cuid(),
+        speaker=Speaker.AGENT,
+        speaker_label=lesson_prompt.agent_label,
+        text=generated_tags[lesson_prompt.agent_label],
+        tags=OrderedDict(
+            [
+                (tag, value) for tag, value in generated_tags.items()
+            ]
+        ),
+    ), conversation_over
+
+
 async def generate_complete_agent_response(
     dialogue: Dialogue,
     lesson_prompt: LessonPrompt,
-    activity_id: str,
-    turn_id: str,
-    user_id: str,
-    call_type: str,
+    activity_id: str = None,
+    turn_id: str = None,
+    user_id: str = None,
+    call_type: str = None,
 ) -> tuple[OrderedDict[str, str], int]:
     """Generate all required tags for the agent response
 
@@ -90,30 +157,48 @@ async def generate_complete_agent_response(
     num_regenerations : int
         number of calls made to the completions endpoint to generate the agent response
     """
-    lesson_prompt.settings["stop"].append(f"{lesson_prompt.tags[0]}:")
-    prompt = f"{lesson_prompt.prompt}\n{dialogue.get_dialogue_with_tags()}"
+    # settings overlay for this response only; the lesson prompt's settings are shared and must not be modified
+    settings = {
+        **lesson_prompt.settings,
+        "stop": [*lesson_prompt.settings["stop"], f"{lesson_prompt.tags[0]}:"],
+    }
     generated_tags = OrderedDict()
 
     for gen_no in range(MAX_AGENT_REGENERATIONS):
 
-        # add generated tags and next dialogue tag to prime completion
-        prompt_with_tags = prompt + "".join(
+        # add generated tags and next dialogue tag to prime completion, trimming the oldest turns to fit the context
+        generated_text = "".join(
             f"\n{tag}: {value}" for tag, value in generated_tags.items()
         )
+        start = get_context_start(
+            dialogue,
+            lesson_prompt.prompt,
+            settings,
+            tags=True,
+            suffix=generated_text,
+        )
+        prompt_with_tags = (
+            f"{lesson_prompt.prompt}\n{dialogue.get_dialogue_with_tags(start)}{generated_text}"
+        )
         completion_primer = f"\n{lesson_prompt.tags[len(generated_tags)]}:"
         completion = Completion.create(
             prompt=prompt_with_tags,
             completion_primer=completion_primer,
-            settings=lesson_prompt.settings,
+            settings=settings,
         )
 
         # generate completion
-        await completion.generate_completion(
-            activity_id=activity_id,
-            turn_id=turn_id,
-            user_id=user_id,
-            call_type=call_type,
-        )
+        with span(
+            "agent.generation",
+            generation=gen_no + 1,
+            tag=lesson_prompt.tags[len(generated_tags)],
+        ):
+            await completion.generate_completion(
+                activity_id=activity_id,
+                turn_id=turn_id,
+                user_id=user_id,
+                call_type=call_type,
+            )
 
         # parse tags from completion and validate END_CONVERSATION_TAG confidence above threshold
         parsed_tags = completion.get_parsed_tags(
@@ -121,10 +206,12 @@ async def generate_complete_agent_response(
             activity_id=activity_id,
             turn_id=turn_id,
         )
+        logprobs = completion.completion_response.logprobs
         parsed_tags = process_dialogue_tags(
             parsed_tags,
             lesson_prompt.agent_label,
-            completion.completion_response.word_logprobs,
+            logprobs.words if logprobs else [],
+            logprobs.word_logprobs if logprobs else [],
         )
 
         # update generated tags with parsed tags
@@ -138,10 +225,10 @@ async def generate_complete_agent_response(
             == dialogue.get_last_utterance(Speaker.AGENT)
             and gen_no < MAX_AGENT_REGENERATIONS - 1
         ):
-            token_ids = get_token_ids(generated_tags[lesson_prompt.agent_label])
-            lesson_prompt.settings["logit_bias"] = {
-                token_id: -10 for token_id in token_ids
-            }
+            token_ids = get_token_ids(
+                generated_tags[lesson_prompt.agent_label], completion.get_model()
+            )
+            settings["logit_bias"] = {token_id: -10 for token_id in token_ids}
             generated_tags = OrderedDict()
             logger.warning(
                 "Agent text is the same as previous turn -- regenerating response."
@@ -173,32 +260,43 @@ async def generate_complete_agent_response_chat(
     """
     for gen_no in range(MAX_AGENT_REGENERATIONS):
 
-        messages = dialogue.get_dialogue_as_messages(format=CHAT_COMPLETION_FORMAT)
-
         # this is necessary to ensure that the agent response is in the specified format
-        if gen_no > 0:
-            messages.extend(
-                [
-                    {
-                        "role": "assistant",
-                        "content": completion.get_full_completion(),
-                    },
-                    {"role": "assistant", "content": dummy_message},
-                ]
-            )
+        retry_messages = (
+            [
+                {
+                    "role": "assistant",
+                    "content": completion.get_full_completion(),
+                },
+                {"role": "assistant", "content": dummy_message},
+            ]
+            if gen_no > 0
+            else []
+        )
+        start = get_context_start(
+            dialogue,
+            lesson_prompt.prompt,
+            lesson_prompt.settings,
+            format=CHAT_COMPLETION_FORMAT,
+            tags=True,
+            suffix=retry_messages,
+        )
 
         # generate completion
         completion = Completion.create(
             prompt=lesson_prompt.prompt,
-            messages=messages,
+            messages=dialogue.get_dialogue_as_messages(
+                format=CHAT_COMPLETION_FORMAT, start=start
+            ),
             settings=lesson_prompt.settings,
+            volatile_messages=retry_messages,
         )
-        await completion.generate_completion(
-            activity_id=activity_id,
-            turn_id=turn_id,
-            user_id=user_id,
-            call_type=call_type,
-        )
+        with span("agent.generation", generation=gen_no + 1):
+            await completion.generate_completion(
+                activity_id=activity_id,
+                turn_id=turn_id,
+                user_id=user_id,
+                call_type=call_type,
+            )
 
         # parse tags from completion
         generated_tags = completion.get_parsed_tags(
@@ -230,11 +328,28 @@ async def generate_complete_agent_response_chat(
     return generated_tags, gen_no + 1
 
 
+def is_valid_agent_response(
+    generated_tags: OrderedDict[str, str], lesson_prompt: LessonPrompt, dialogue: Dialogue
+) -> bool:
+    """Whether an agent response has all required tags and doesn't repeat the previous agent turn"""
+    return all(generated_tags.get(tag) for tag in lesson_prompt.tags) and generated_tags[
+        lesson_prompt.agent_label
+    ] != dialogue.get_last_utterance(Speaker.AGENT)
+
+
 async def generate_agent_response(
-    turns: list[Turn], lesson_prompt: LessonPrompt
+    turns: list[Turn] | Dialogue,
+    lesson_prompt: LessonPrompt,
+    speculative: int = 1,
+    activity_id: str = None,
+    turn_id: str = None,
 ) -> dict[str, Any]:
     """Generate an agent response using an input prompt and dialogue
 
+    With `speculative` > 1, that many candidate responses are generated concurrently for sampled prompts; the first
+    valid candidate is kept and the rest are cancelled. This trades completion cost for lower, less variable
+    latency per turn.
+
     request.data:
         {
             "turnId": string,
@@ -270,76 +385,240 @@ async def generate_agent_response(
         }
     """
     start_time = time()
-    call_type = "stepAgent"
+    call_type = CallType.AGENT
 
     # construct dialogue
-    dialogue = Dialogue.from_turns(turns, lesson_prompt.user_label, lesson_prompt.agent_label)
-    guidelines = LESSON_PROMPT_GUIDELINES.format(
-        agentLabel=lesson_prompt.agent_label,
-        maxAgentResponseLength=MAX_AGENT_RESPONSE_LENGTH,
-    )
-    lesson_prompt.prompt = lesson_prompt.prompt.replace(  # .format() fails if there are curly braces or json in the prompt
-        "{promptGuidelines}", guidelines
-    )
+    dialogue, lesson_prompt = prepare_agent_prompt(turns, lesson_prompt)
 
     # if dialogue is greater than MAX_TURNS, generate a special response that ends the conversation
     if len(dialogue) >= MAX_TURNS:
+        call_type = CallType.END_CONVERSATION
+        settings = StructuredPrompt.from_json(MAX_TURNS_PROMPT).settings
 
-        generated_tags = await end_conversation_gracefully(
-            dialogue, lesson_prompt
-        )
-        num_generations = 1
+        async def generate_candidate() -> tuple[OrderedDict[str, str], int]:
+            return await end_conversation_gracefully(dialogue, lesson_prompt, activity_id, turn_id), 1
+
+        def is_valid(candidate: tuple[OrderedDict[str, str], int]) -> bool:
+            return bool(candidate[0].get(lesson_prompt.agent_label))
 
     # query gpt-3 for agent response up to N times, to generate all required dialogue tags
     else:
+        settings = lesson_prompt.settings
         agent_response_generator = (
             generate_complete_agent_response
             if Completion.get_completion_type(lesson_prompt.settings)
             == CompletionType.TEXT
             else generate_complete_agent_response_chat
         )
-        generated_tags, num_generations = await agent_response_generator(
-            dialogue, lesson_prompt
+
+        async def generate_candidate() -> tuple[OrderedDict[str, str], int]:
+            return await agent_response_generator(
+                dialogue, lesson_prompt, activity_id=activity_id, turn_id=turn_id, call_type=call_type
+            )
+
+        def is_valid(candidate: tuple[OrderedDict[str, str], int]) -> bool:
+            return is_valid_agent_response(candidate[0], lesson_prompt, dialogue)
+
+    # identical requests return the same completion when sampling is off, so only speculate with the settings of a
+    # sampled prompt
+    num_candidates = speculative if is_sampled(settings) else 1
+    if num_candidates > 1:
+        generated_tags, num_generations = await first_valid(
+            [generate_candidate() for _ in range(num_candidates)], is_valid
         )
+    else:
+        generated_tags, num_generations = await generate_candidate()
+
+    registry = get_metrics_registry()
+    registry.counter(
+        "agent_responses_total", "Generated agent responses", ["call_type"]
+    ).inc(call_type=call_type)
+    registry.counter(
+        "agent_regenerations_total",
+        "Completion calls made to regenerate agent responses that failed validation",
+        ["call_type"],
+    ).inc(num_generations - 1, call_type=call_type)
+
+    return get_agent_turn(generated_tags, lesson_prompt, turn_id)
+
+
+class AgentResponseStream:
+    """Streams the agent text of a response as it is generated, for the chat completions endpoint. The dialogue tags
+    are parsed and validated once the completion finishes, after which `turn` and `conversation_over` hold the
+    response, as returned by `generate_agent_response`.
+
+    If the streamed completion fails validation, the response is regenerated without streaming and `regenerated` is
+    set; the streamed text is then superseded by `turn.text`. Responses that can't be streamed (text completions and
+    graceful endings) are yielded whole once generated. Only regenerated responses are speculated.
+
+    Attributes
+    ----------
+    turn : Optional[Turn]
+        the agent turn, once the stream is exhausted
+    conversation_over : Optional[bool]
+        whether the agent turn ends the conversation, once the stream is exhausted
+    time_to_first_token : Optional[float]
+        ms from the start of the response until the first agent text was yielded
+    regenerated : bool
+        whether the streamed text was superseded by a regenerated response
+    """
 
-    conversation_over = is_conversation_over(generated_tags)
+    def __init__(
+        self,
+        turns: list[Turn] | Dialogue,
+        lesson_prompt: LessonPrompt,
+        speculative: int = 1,
+        activity_id: str = None,
+        turn_id: str = None,
+    ):
+        self.turns = turns
+        self.lesson_prompt = lesson_prompt
+        self.speculative = speculative
+        self.activity_id = activity_id
+        self.turn_id = turn_id
+        self.turn = None
+        self.conversation_over = None
+        self.time_to_first_token = None
+        self.regenerated = False
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        t0 = time()
+        lesson_prompt = self.lesson_prompt
+        dialogue, lesson_prompt = prepare_agent_prompt(self.turns, lesson_prompt)
 
-    return Turn(
-        turn_id=cuid(),
-        speaker=Speaker.AGENT,
-        speaker_label=lesson_prompt.agent_label,
-        text=generated_tags[lesson_prompt.agent_label],
-        tags=OrderedDict(
-            [
-                (tag, value) for tag, value in generated_tags.items()
-            ]
-        ),
-    ), conversation_over
+        if (
+            len(dialogue) < MAX_TURNS
+            and Completion.get_completion_type(lesson_prompt.settings)
+            == CompletionType.CHAT
+        ):
+            start = get_context_start(
+                dialogue,
+                lesson_prompt.prompt,
+                lesson_prompt.settings,
+                format=CHAT_COMPLETION_FORMAT,
+                tags=True,
+            )
+            completion = Completion.create(
+                prompt=lesson_prompt.prompt,
+                messages=dialogue.get_dialogue_as_messages(
+                    format=CHAT_COMPLETION_FORMAT, start=start
+                ),
+                settings=lesson_prompt.settings,
+            )
+            try:
+                async for text in stream_text_between_tags(
+                    completion.generate_streamed_completion(
+                        activity_id=self.activity_id,
+                        turn_id=self.turn_id,
+                        call_type=CallType.AGENT,
+                    ),
+                    start_tag=f"{lesson_prompt.agent_label}:",
+                    end_tag="\n",
+                ):
+                    if self.time_to_first_token is None:
+                        self.time_to_first_token = (time() - t0) * 1000
+                    yield text
+
+                generated_tags = completion.get_parsed_tags(
+                    lesson_prompt.tags, format=CHAT_COMPLETION_FORMAT
+                )
+                if is_valid_agent_response(generated_tags, lesson_prompt, dialogue) and (
+                    len(generated_tags[lesson_prompt.agent_label].split())
+                    <= MAX_AGENT_RESPONSE_LENGTH
+                ):
+                    self.turn, self.conversation_over = get_agent_turn(
+                        generated_tags, lesson_prompt, self.turn_id
+                    )
+                else:
+                    logger.warning(
+                        f"activityId={self.activity_id} :: turnId={self.turn_id} :: "
+                        "Streamed agent response failed validation -- regenerating response."
+                    )
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error(
+                    f"activityId={self.activity_id} :: turnId={self.turn_id} :: "
+                    f"Streamed agent response failed with error: {e!r} -- regenerating response."
+                )
+
+        if self.turn is None:
+            self.regenerated = self.time_to_first_token is not None
+            if self.regenerated:
+                get_metrics_registry().counter(
+                    "agent_stream_regenerations_total",
+                    "Streamed agent responses superseded by a regenerated response",
+                ).inc()
+            self.turn, self.conversation_over = await generate_agent_response(
+                dialogue, lesson_prompt, self.speculative, self.activity_id, self.turn_id
+            )
+            if not self.regenerated:
+                self.time_to_first_token = (time() - t0) * 1000
+                yield self.turn.text
+
+        get_metrics_registry().histogram(
+            "agent_time_to_first_text_ms",
+            "Time from the start of a streamed agent response until its first text",
+            ["regenerated"],
+        ).observe(self.time_to_first_token, regenerated=str(self.regenerated).lower())
+
+        # CAREFUL: used for log-based metrics!
+        logger.info(
+            f"activityId={self.activity_id} :: turnId={self.turn_id} :: Agent response streamed in <latency:{(time() - t0) * 1000:.2f}ms> "
+            f"<timeToFirstToken:{self.time_to_first_token:.2f}ms> <regenerated:{self.regenerated}>"
+        )
+
+
+def stream_agent_response(
+    turns: list[Turn] | Dialogue,
+    lesson_prompt: LessonPrompt,
+    speculative: int = 1,
+    activity_id: str = None,
+    turn_id: str = None,
+) -> AgentResponseStream:
+    """Generate an agent response like `generate_agent_response`, streaming the agent text as it arrives:
+
+        stream = stream_agent_response(dialogue, lesson_prompt)
+        async for text in stream:
+            ...
+        agent_turn, conversation_over = stream.turn, stream.conversation_over
+    """
+    return AgentResponseStream(turns, lesson_prompt, speculative, activity_id, turn_id)
 
 
 async def generate_user_response(
-    turns: list[Turn], user_prompt: Prompt, user_label: str
+    turns: list[Turn] | Dialogue,
+    user_prompt: Prompt,
+    user_label: str,
+    activity_id: str = None,
+    turn_id: str = None,
 ) -> dict[str, Any]:
-    turns = [
-        Turn(
-            turn.id,
-            Speaker.AGENT if turn.speaker == Speaker.USER else Speaker.USER,
-            user_prompt.agent_label if turn.speaker == Speaker.USER else user_prompt.user_label,
-            turn.text,
-            {},
-        ) for turn in turns
-    ]
-    dialogue = Dialogue.from_turns(turns, user_prompt.user_label, user_prompt.agent_label)
+    # the simulated user sees the dialogue from its own point of view, with the speakers swapped
+    dialogue = turns if isinstance(turns, Dialogue) else Dialogue(turns)
+    dialogue = dialogue.get_view(
+        user_prompt.user_label, user_prompt.agent_label, swap_speakers=True
+    )
+    start = get_context_start(
+        dialogue,
+        user_prompt.prompt,
+        user_prompt.settings,
+        format=CHAT_COMPLETION_FORMAT,
+        tags=False,
+    )
     completion = Completion.create(
         prompt=user_prompt.prompt,
-        messages=dialogue.get_dialogue_as_messages(format=CHAT_COMPLETION_FORMAT, tags=False),
+        messages=dialogue.get_dialogue_as_messages(
+            format=CHAT_COMPLETION_FORMAT, tags=False, start=start
+        ),
         settings=user_prompt.settings,
     )
-    await completion.generate_completion()
-    user_response = completion.get_parsed_tags(user_prompt.tags, format=CHAT_COMPLETION_FORMAT)[user_prompt.agent_label]
+    await completion.generate_completion(
+        activity_id=activity_id, turn_id=turn_id, call_type=CallType.USER
+    )
+    user_response = completion.get_parsed_tags(
+        user_prompt.tags, format=CHAT_COMPLETION_FORMAT, activity_id=activity_id, turn_id=turn_id
+    )[user_prompt.agent_label]
 
     return Turn(
-        turn_id=cuid(),
+        turn_id=turn_id or cuid(),
         speaker=Speaker.USER,
         speaker_label=user_label,
         text=user_response,
@@ -350,8 +629,21 @@ async def generate_user_response(
 
 
 async def generate_conversation(
-        agent_prompt: LessonPrompt, user_prompt: Prompt, initial_agent_dialogue_tags: OrderedDict[str, str]
+        agent_prompt: LessonPrompt,
+        user_prompt: Prompt,
+        initial_agent_dialogue_tags: OrderedDict[str, str],
+        speculative: int = 1,
+        activity_id: str = None,
+        on_agent_text: Callable[[str, str], Any] = None,
 ) -> Dialogue:
+    """Simulate a conversation between the agent and the user, starting from the agent's initial dialogue tags, until
+    the agent ends it. Completion calls are logged and traced with the conversation's `activity_id` (a new one unless
+    given) and the ID of the turn they generate.
+
+    With `on_agent_text`, agent responses are streamed with `stream_agent_response`, and the callback is called with
+    the turn ID and each piece of agent text as it arrives. A streamed response that fails validation is regenerated
+    without streaming, and the agent turn in the dialogue then holds the regenerated text instead."""
+    activity_id = activity_id or cuid()
     first_turn = Turn(
         turn_id=cuid(),
         speaker=Speaker.AGENT,
@@ -360,12 +652,31 @@ async def generate_conversation(
         tags=initial_agent_dialogue_tags,
     )
 
-    turns = [first_turn]
+    dialogue = Dialogue([first_turn], agent_prompt.user_label, agent_prompt.agent_label)
     conversation_over = False
     while not conversation_over:
-        user_turn = await generate_user_response(turns, user_prompt, agent_prompt.user_label)
-        turns.append(user_turn)
-        agent_response, conversation_over = await generate_agent_response(turns, agent_prompt)
-        turns.append(agent_response)
-
-    return Dialogue.from_turns(turns, agent_prompt.user_label, agent_prompt.agent_label).get_dialogue()
+        with span("turn", turnNumber=len(dialogue) // 2 + 1):
+            turn_id = cuid()
+            with span("step.user", activityId=activity_id, turnId=turn_id):
+                user_turn = await generate_user_response(
+                    dialogue, user_prompt, agent_prompt.user_label, activity_id, turn_id
+                )
+            dialogue.append(user_turn)
+            turn_id = cuid()
+            with span(
+                "step.agent", speculative=speculative, activityId=activity_id, turnId=turn_id
+            ) as step_span:
+                if on_agent_text is None:
+                    agent_response, conversation_over = await generate_agent_response(
+                        dialogue, agent_prompt, speculative, activity_id, turn_id
+                    )
+                else:
+                    stream = stream_agent_response(dialogue, agent_prompt, speculative, activity_id, turn_id)
+                    async for text in stream:
+                        on_agent_text(turn_id, text)
+                    agent_response, conversation_over = stream.turn, stream.conversation_over
+                if step_span:
+                    step_span.set_attribute("conversationOver", conversation_over)
+            dialogue.append(agent_response)
+
+    return dialogue.get_dialogue()
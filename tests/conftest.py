@@ -0,0 +1,23 @@
+from __future__ import annotations
+
+import socket
+
+import pytest
+import tiktoken
+
+
+@pytest.fixture
+def tiktoken_encodings() -> None:
+    """Skip tests that count tokens when the tiktoken encodings can't be loaded, e.g. offline"""
+    try:
+        tiktoken.get_encoding("cl100k_base").encode("")
+    except Exception as e:  # pylint: disable=broad-except
+        pytest.skip(f"tiktoken encodings are unavailable: {e!r}")
+
+
+@pytest.fixture
+def unused_port() -> int:
+    """A free local port, e.g. for a stub server"""
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
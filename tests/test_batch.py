@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import asyncio
+import json
+
+import pytest
+
+import batch
+from api.stub_server import start_stub_server
+from api.stub_server import StubConfig
+from batch import iter_jobs
+from batch import parse_args
+from batch import read_scenarios
+from batch import run_conversations
+from batch import run_sharded_batch
+from batch import run_unordered
+
+TIMEOUT = 5
+SHARDED_BATCH_TIMEOUT = 60
+
+
+async def collect(results) -> list:
+    return [result async for result in results]
+
+
+def test_run_unordered_runs_every_item():
+    async def double(item: int) -> int:
+        await asyncio.sleep(0.001 * (item % 3))
+        return item * 2
+
+    results = asyncio.run(
+        asyncio.wait_for(collect(run_unordered(range(20), 4, double)), TIMEOUT)
+    )
+
+    assert sorted(results) == [item * 2 for item in range(20)]
+
+
+def test_run_unordered_raises_errors_of_the_items_iterable():
+    def items():
+        yield 1
+        raise ValueError("malformed item")
+
+    async def identity(item: int) -> int:
+        return item
+
+    with pytest.raises(ValueError, match="malformed item"):
+        asyncio.run(asyncio.wait_for(collect(run_unordered(items(), 4, identity)), TIMEOUT))
+
+
+def test_run_conversations_raises_on_malformed_scenario_spec(tmp_path):
+    path = tmp_path / "scenarios.jsonl"
+    path.write_text("{not json\n", encoding="utf-8")
+
+    with pytest.raises(ValueError):
+        asyncio.run(
+            asyncio.wait_for(
+                collect(run_conversations(iter_jobs(read_scenarios(str(path))), 4)), TIMEOUT
+            )
+        )
+
+
+@pytest.fixture
+def stub_api_port(monkeypatch, tiktoken_encodings, unused_port):
+    """Port of a stub server for the worker processes of a sharded batch, which read the API URL when they start"""
+    monkeypatch.setenv("OPENAI_URL", f"http://localhost:{unused_port}")
+    return unused_port
+
+
+def run_sharded_batch_with_stub_server(port: int, argv: list[str], num_workers: int = 2):
+    async def run():
+        config = StubConfig(latency_ms=1, latency_distribution="uniform", token_latency_ms=0, seed=0)
+        runner = await start_stub_server(config, port=port)
+        try:
+            return await run_sharded_batch(parse_args(argv), num_workers)
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(asyncio.wait_for(run(), SHARDED_BATCH_TIMEOUT))
+
+
+def test_sharded_batch_writes_results_in_job_order(tmp_path, stub_api_port, monkeypatch):
+    # hand out only a few jobs ahead of the next result to write
+    monkeypatch.setattr(batch, "BATCH_WORKER_REORDER_WINDOW", 2)
+    input_path, output_path = tmp_path / "scenarios.jsonl", tmp_path / "conversations.jsonl"
+    input_path.write_text(
+        '{"scenarioId": "a", "numConversations": 3}\n{"scenarioId": "b", "numConversations": 2}\n',
+        encoding="utf-8",
+    )
+
+    progress = run_sharded_batch_with_stub_server(
+        stub_api_port,
+        ["--input", str(input_path), "--output", str(output_path), "--concurrency", "4"],
+    )
+
+    results = [json.loads(line) for line in output_path.read_text(encoding="utf-8").splitlines()]
+    assert [(result["scenarioId"], result["conversationIndex"]) for result in results] == [
+        ("a", 0), ("a", 1), ("a", 2), ("b", 0), ("b", 1)
+    ]
+    assert all(result["error"] is None for result in results)
+    assert (progress.completed, progress.failed) == (5, 0)
+
+
+def test_sharded_batch_raises_when_a_worker_crashes(tmp_path, stub_api_port):
+    input_path = tmp_path / "scenarios.jsonl"
+    input_path.write_text('{"numConversations": 2}\n', encoding="utf-8")
+
+    # the workers fail to open a cache in a missing directory
+    with pytest.raises(RuntimeError, match="exited with code"):
+        run_sharded_batch_with_stub_server(
+            stub_api_port,
+            [
+                "--input", str(input_path),
+                "--output", str(tmp_path / "conversations.jsonl"),
+                "--cache", str(tmp_path / "missing" / "cache.sqlite"),
+            ],
+        )
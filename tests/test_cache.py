@@ -0,0 +1,32 @@
+from __future__ import annotations
+
+import sqlite3
+
+from api.cache import CompletionCache
+from api.cache import is_sampled
+
+
+def test_locked_database_does_not_fail_cache_writes(tmp_path, caplog):
+    path = str(tmp_path / "cache.sqlite")
+    cache = CompletionCache(path)
+    other_process = sqlite3.connect(path)
+    other_process.execute("BEGIN EXCLUSIVE")
+    cache._db.execute("PRAGMA busy_timeout = 10")  # pylint: disable=protected-access
+    try:
+        cache.set("key", {"text": "Hola"})
+        assert cache.get("key") == {"text": "Hola"}  # served from memory
+        assert "Completion cache write failed" in caplog.text
+    finally:
+        other_process.rollback()
+        other_process.close()
+
+    cache.set("other", {"text": "Adiós"})
+    cache.close()
+    assert CompletionCache(path).get("other") == {"text": "Adiós"}
+
+
+def test_is_sampled_treats_missing_temperature_as_default():
+    assert is_sampled({})
+    assert is_sampled({"temperature": None})
+    assert is_sampled({"temperature": 0.7})
+    assert not is_sampled({"temperature": 0})
@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import gc
+import tracemalloc
+
+from api.completion import CompletionResponse
+from api.completion import Logprobs
+from constants import MAX_LOGPROB_TOKENS
+
+USAGE = {"prompt_tokens": 50, "completion_tokens": 10, "total_tokens": 60}
+NUM_COMPLETIONS = 2000
+MAX_GROWTH_BYTES = 64 * 1024
+
+
+def get_chat_response(text: str = "Un café, por favor.") -> CompletionResponse:
+    return CompletionResponse(
+        text=text,
+        finish_reason="stop",
+        usage=USAGE,
+        latency=100.0,
+        message={"role": "assistant", "content": text},
+    )
+
+
+def get_text_response(num_tokens: int, start: int = 0) -> CompletionResponse:
+    tokens = [f" t{i}" for i in range(start, start + num_tokens)]
+    return CompletionResponse(
+        text="".join(tokens),
+        finish_reason="length",
+        usage=USAGE,
+        latency=100.0,
+        logprobs={"tokens": tokens, "token_logprobs": [-0.5] * num_tokens},
+    )
+
+
+def measure_growth(run, num_calls: int) -> int:
+    """Bytes still allocated after the second half of `num_calls` calls, relative to after the first half"""
+    tracemalloc.start()
+    try:
+        for _ in range(num_calls // 2):
+            run()
+        gc.collect()
+        baseline, _ = tracemalloc.get_traced_memory()
+        for _ in range(num_calls // 2):
+            run()
+        gc.collect()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return current - baseline
+
+
+def test_chat_completions_use_flat_memory():
+    def complete() -> None:
+        response = get_chat_response()
+        response.update(get_chat_response())
+        assert response.logprobs is None
+
+    assert measure_growth(complete, NUM_COMPLETIONS) < MAX_GROWTH_BYTES
+
+
+def test_updated_logprobs_use_flat_memory():
+    response = get_text_response(20)
+
+    def update() -> None:
+        response.update(get_text_response(20))
+
+    assert measure_growth(update, NUM_COMPLETIONS) < MAX_GROWTH_BYTES
+    assert len(response.logprobs) == MAX_LOGPROB_TOKENS
+
+
+def test_logprobs_keep_the_most_recent_tokens():
+    response = get_text_response(MAX_LOGPROB_TOKENS)
+    response.update(get_text_response(10, start=MAX_LOGPROB_TOKENS))
+
+    logprobs = response.logprobs
+    assert len(logprobs) == MAX_LOGPROB_TOKENS
+    assert logprobs.tokens[0] == " t10"
+    assert logprobs.tokens[-1] == f" t{MAX_LOGPROB_TOKENS + 9}"
+    assert logprobs.words[0] == "t10"
+    assert logprobs.words[-1] == f"t{MAX_LOGPROB_TOKENS + 9}"
+    assert list(logprobs.word_offsets[:2]) == [0, 1]
+
+
+def test_truncate_drops_words_starting_before_the_kept_tokens():
+    logprobs = Logprobs([" Hola", ",", " qué", " tal"], [-1.0, -0.5, -0.25, -0.125], max_tokens=2)
+
+    assert logprobs.tokens == [" qué", " tal"]
+    assert logprobs.words == ["qué", "tal"]
+    assert list(logprobs.word_logprobs) == [-0.25, -0.125]
@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+import tiktoken
+
+from conversation.utils import get_tokenizer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_TIME_BUDGET = 0.5  # seconds; the import takes well under 0.1s without transformers
+
+IMPORT_SCRIPT = """
+import json
+import sys
+from time import perf_counter
+
+t0 = perf_counter()
+import conversation.utils
+print(json.dumps({"seconds": perf_counter() - t0, "transformers": "transformers" in sys.modules}))
+"""
+
+
+def test_conversation_utils_imports_fast_without_transformers():
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    import_time = json.loads(result.stdout.strip().splitlines()[-1])
+
+    assert not import_time["transformers"], "importing conversation.utils imported transformers"
+    assert import_time["seconds"] < IMPORT_TIME_BUDGET
+
+
+@pytest.mark.parametrize("model", ["gpt-3.5-turbo", "gpt-4", "text-davinci-003"])
+def test_get_tokenizer_uses_the_tiktoken_encoding_of_the_model(model):
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+        encoding.encode("")
+    except Exception as e:  # pylint: disable=broad-except
+        pytest.skip(f"tiktoken encoding for {model} is unavailable: {e!r}")
+
+    text = "¿Qué desea tomar? Un café con leche, por favor."
+    assert get_tokenizer(model)(text) == encoding.encode(text)
@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import math
+
+import pytest
+
+from api.metrics import CloudMonitoringExporter
+from api.metrics import MetricsRegistry
+from api.metrics import to_prometheus
+from constants import CLOUD_MONITORING_MAX_TIME_SERIES_PER_REQUEST
+
+BUCKETS = (10, 20, 50)
+
+
+def test_histogram_places_exact_bounds_in_the_lower_bucket():
+    histogram = MetricsRegistry().histogram("latency_ms", "Latency", buckets=BUCKETS)
+    for value in (0, 10, 10.5, 20, 50, 51):
+        histogram.observe(value)
+    value = histogram.get()
+    assert value.bucket_counts == [2, 2, 1, 1]
+    assert value.count == 6
+    assert value.sum == pytest.approx(141.5)
+
+
+def test_histogram_percentile_interpolates_within_buckets():
+    histogram = MetricsRegistry().histogram("latency_ms", "Latency", buckets=BUCKETS)
+    assert math.isnan(histogram.percentile(50))
+    for value in (5, 10, 15, 100):
+        histogram.observe(value)
+    assert histogram.percentile(25) == pytest.approx(5)
+    assert histogram.percentile(50) == pytest.approx(10)
+    assert histogram.percentile(75) == pytest.approx(20)
+    # observations in the overflow bucket are estimated at the largest bound
+    assert histogram.percentile(100) == 50
+
+
+def test_prometheus_text_has_cumulative_buckets_and_escaped_labels():
+    registry = MetricsRegistry()
+    registry.counter("calls_total", "Calls", ["call_type"]).inc(3, call_type='say "hola"\\\n')
+    histogram = registry.histogram("latency_ms", "Latency", ["call_type"], buckets=BUCKETS)
+    for value in (5, 15, 100):
+        histogram.observe(value, call_type="agent")
+
+    lines = to_prometheus(registry).splitlines()
+    assert "# TYPE calls_total counter" in lines
+    assert 'calls_total{call_type="say \\"hola\\"\\\\\\n"} 3' in lines
+    assert "# TYPE latency_ms histogram" in lines
+    assert [line for line in lines if line.startswith("latency_ms_")] == [
+        'latency_ms_bucket{call_type="agent",le="10"} 1',
+        'latency_ms_bucket{call_type="agent",le="20"} 2',
+        'latency_ms_bucket{call_type="agent",le="50"} 2',
+        'latency_ms_bucket{call_type="agent",le="+Inf"} 3',
+        'latency_ms_sum{call_type="agent"} 120',
+        'latency_ms_count{call_type="agent"} 3',
+    ]
+
+
+def test_merge_adds_counters_and_histograms():
+    registry, worker_registry = MetricsRegistry(), MetricsRegistry()
+    registry.counter("calls_total", "Calls", ["call_type"]).inc(2, call_type="agent")
+    registry.histogram("latency_ms", "Latency", buckets=BUCKETS).observe(5)
+    worker_registry.counter("calls_total", "Calls", ["call_type"]).inc(3, call_type="agent")
+    worker_registry.counter("calls_total", "Calls", ["call_type"]).inc(1, call_type="user")
+    worker_registry.histogram("latency_ms", "Latency", buckets=BUCKETS).observe(15)
+    worker_registry.histogram("latency_ms", "Latency", buckets=BUCKETS).observe(100)
+
+    registry.merge(worker_registry)
+    assert registry.counter("calls_total", "Calls", ["call_type"]).get(call_type="agent") == 5
+    assert registry.counter("calls_total", "Calls", ["call_type"]).get(call_type="user") == 1
+    value = registry.histogram("latency_ms", "Latency", buckets=BUCKETS).get()
+    assert value.bucket_counts == [1, 1, 0, 1]
+    assert (value.count, value.sum) == (3, 120)
+
+    other_buckets = MetricsRegistry()
+    other_buckets.histogram("latency_ms", "Latency", buckets=(1, 2)).observe(1)
+    with pytest.raises(ValueError, match="different buckets"):
+        registry.merge(other_buckets)
+
+
+class FakeMetricServiceClient:
+    def __init__(self):
+        self.requests = []
+
+    def create_time_series(self, request):
+        self.requests.append(request)
+
+
+def test_cloud_monitoring_export_batches_time_series():
+    registry = MetricsRegistry()
+    counter = registry.counter("calls_total", "Calls", ["turn"])
+    num_counters = CLOUD_MONITORING_MAX_TIME_SERIES_PER_REQUEST + 1
+    for turn in range(num_counters):
+        counter.inc(turn=turn)
+    registry.histogram("latency_ms", "Latency", buckets=BUCKETS).observe(15)
+
+    client = FakeMetricServiceClient()
+    exporter = CloudMonitoringExporter("my-project", client=client)
+    assert exporter.export(registry) == num_counters + 1
+
+    assert [len(request["time_series"]) for request in client.requests] == [
+        CLOUD_MONITORING_MAX_TIME_SERIES_PER_REQUEST,
+        2,
+    ]
+    assert all(request["name"] == "projects/my-project" for request in client.requests)
+    time_series = [series for request in client.requests for series in request["time_series"]]
+    assert all(series["metric_kind"] == "CUMULATIVE" for series in time_series)
+    assert time_series[0]["value_type"] == "DOUBLE"
+    assert time_series[0]["points"][0]["value"] == {"double_value": 1.0}
+
+    distribution = time_series[-1]
+    assert distribution["metric"]["type"] == f"{exporter.metric_prefix}/latency_ms"
+    assert distribution["value_type"] == "DISTRIBUTION"
+    point = distribution["points"][0]
+    assert point["value"]["distribution_value"] == {
+        "count": 1,
+        "mean": 15.0,
+        "bucket_options": {"explicit_buckets": {"bounds": [10, 20, 50]}},
+        "bucket_counts": [0, 1, 0, 0],
+    }
+    interval = point["interval"]
+    assert (interval["start_time"]["seconds"], interval["start_time"]["nanos"]) <= (
+        interval["end_time"]["seconds"],
+        interval["end_time"]["nanos"],
+    )
@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import asyncio
+import inspect
+import time
+
+from api.metrics import get_metrics_registry
+from api.metrics import reset_metrics_registry
+from api.profiling import LoopLagMonitor
+from api.profiling import SamplingProfiler
+from api.profiling import set_timers_enabled
+from api.profiling import timed
+from conversation.dialogue import Dialogue
+from conversation.utils import compute_word_boundaries
+from conversation.utils import compute_word_logprobs
+
+TOKENS = ["Hola", ",", " un", " café", " con", " leche", "."]
+LOGPROBS = [-0.1, -0.2, -0.3, -0.4, -0.5, -0.6, -0.7]
+
+
+def get_function_durations():
+    return get_metrics_registry().metrics.get("function_duration_ms")
+
+
+def test_timed_functions_keep_their_signatures():
+    assert compute_word_boundaries.__wrapped__ is not None
+    assert inspect.signature(compute_word_boundaries) == inspect.signature(compute_word_boundaries.__wrapped__)
+    assert compute_word_logprobs.__name__ == "compute_word_logprobs"
+    assert compute_word_logprobs.__doc__ == compute_word_logprobs.__wrapped__.__doc__
+    assert inspect.signature(Dialogue.get_view) == inspect.signature(Dialogue.get_view.__wrapped__)
+
+
+def test_timed_records_nothing_while_timers_are_disabled():
+    reset_metrics_registry()
+    words, word_logprobs, word_offsets = compute_word_boundaries(TOKENS, LOGPROBS)
+    assert (words, word_logprobs, word_offsets) == compute_word_boundaries.__wrapped__(TOKENS, LOGPROBS)
+    assert words == ["Hola,", "un", "café", "con", "leche."]
+    assert get_function_durations() is None
+
+
+def test_timed_records_durations_while_timers_are_enabled():
+    reset_metrics_registry()
+
+    @timed
+    def add(a: int, b: int = 1) -> int:
+        return a + b
+
+    set_timers_enabled(True)
+    try:
+        assert add(1, b=2) == 3
+        assert compute_word_boundaries(TOKENS, LOGPROBS) == compute_word_boundaries.__wrapped__(TOKENS, LOGPROBS)
+    finally:
+        set_timers_enabled(False)
+
+    durations = get_function_durations()
+    assert durations.get(function=f"{add.__module__}.{add.__qualname__}").count == 1
+    assert durations.get(function="conversation.utils.compute_word_boundaries").count == 1
+
+
+def test_loop_lag_monitor_reports_blocking_calls(caplog):
+    reset_metrics_registry()
+
+    async def run() -> LoopLagMonitor:
+        async with LoopLagMonitor(interval=0.01) as monitor:
+            await asyncio.sleep(0.05)
+            time.sleep(0.3)  # blocks the event loop
+            await asyncio.sleep(0.05)
+        return monitor
+
+    monitor = asyncio.run(asyncio.wait_for(run(), timeout=10))
+    assert monitor.max_lag >= 200
+    assert monitor.histogram.percentile(100) > 100
+    assert "Event loop blocked" in caplog.text
+
+
+def test_sampling_profiler_writes_collapsed_stacks(tmp_path):
+    path = tmp_path / "profile.folded"
+
+    def busy_wait(seconds: float) -> None:
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            pass
+
+    with SamplingProfiler(str(path), interval=0.001):
+        busy_wait(0.2)
+
+    lines = path.read_text(encoding="utf-8").splitlines()
+    assert lines
+    stack, count = lines[0].rsplit(" ", 1)
+    assert int(count) > 0
+    assert any("busy_wait" in line for line in lines)
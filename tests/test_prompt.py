@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+import asyncio
+import copy
+import json
+from collections import defaultdict
+
+import pytest
+
+import batch
+from api import rate_limit
+from api.completion import ChatCompletion
+from api.completion import Completion
+from api.completion import TextCompletion
+from api.stub_server import start_stub_server
+from api.stub_server import StubConfig
+from api.utils import managed_session
+from batch import ConversationJob
+from batch import run_conversations
+from batch import Scenario
+from constants import AGENT_LABEL
+from constants import CallType
+from constants import LESSON
+from constants import PROMPT
+from constants import PROMPT_SETTINGS
+from constants import TAGS
+from constants import USER_LABEL
+from conversation.prompt import Prompt
+from sample_prompts.agent_prompt import agent_prompt as sample_agent_prompt
+
+NUM_CONVERSATIONS = 1000
+MAX_LOGIT_BIASES = 100  # token ids of a single agent response
+
+
+def test_nested_settings_are_read_only():
+    logit_bias = {"1234": -10}
+    prompt = Prompt("Agent:", {"model": "gpt-4", "logit_bias": logit_bias, "stop": ["User:"]})
+    logit_bias["1234"] = 10
+    assert prompt.settings["logit_bias"]["1234"] == -10
+    with pytest.raises(TypeError):
+        prompt.settings["logit_bias"]["1234"] = 10
+    with pytest.raises(TypeError):
+        prompt.with_settings(temperature=0).settings["logit_bias"]["1234"] = 10
+
+
+@pytest.mark.parametrize("completion_type", ["text", "chat"])
+def test_request_body_from_read_only_settings_is_json(completion_type):
+    prompt = Prompt(
+        "Agent:",
+        {"model": "gpt-4", "completion_type": completion_type, "logit_bias": {"1234": -10}, "stop": ["User:"]},
+    )
+    completion = Completion.create(prompt=prompt.prompt, settings=prompt.settings)
+    body = completion.prepare_request_body()
+    assert body["logit_bias"] == {"1234": -10}
+    body["logit_bias"]["1234"] = 10
+    assert prompt.settings["logit_bias"]["1234"] == -10
+    json.dumps(body)
+
+
+def test_concurrent_conversations_share_prompts_without_modifying_them(
+    monkeypatch, tiktoken_encodings, unused_port
+):
+    text_lesson = {
+        PROMPT: sample_agent_prompt.prompt,
+        PROMPT_SETTINGS: {
+            **sample_agent_prompt.settings,
+            "completion_type": "text",
+            "model": "text-davinci-003",
+            "logprobs": 1,
+        },
+        TAGS: list(sample_agent_prompt.tags),
+        USER_LABEL: sample_agent_prompt.user_label,
+        AGENT_LABEL: sample_agent_prompt.agent_label,
+    }
+    scenarios = [
+        Scenario.from_json({}, default_id="chat"),
+        Scenario.from_json({LESSON: text_lesson}, default_id="text"),
+    ]
+    prompts = [prompt for s in scenarios for prompt in (s.lesson_prompt, s.user_prompt)]
+    templates = [(prompt.prompt, copy.deepcopy(dict(prompt.settings))) for prompt in prompts]
+
+    base_url = f"http://localhost:{unused_port}"
+    monkeypatch.setattr(TextCompletion, "api_url", f"{base_url}/v1/completions")
+    monkeypatch.setattr(ChatCompletion, "api_url", f"{base_url}/v1/chat/completions")
+    # the stub server doesn't enforce rate limits, and pacing would only slow the conversations down
+    monkeypatch.setattr(rate_limit, "OPENAI_MODEL_RATE_LIMITS", {})
+
+    # the prompts each conversation is generated from
+    conversation_prompts = []
+    generate_conversation = batch.generate_conversation
+
+    async def record_prompts(agent_prompt, user_prompt, *args, **kwargs):
+        conversation_prompts.append((agent_prompt, user_prompt))
+        return await generate_conversation(agent_prompt, user_prompt, *args, **kwargs)
+
+    monkeypatch.setattr(batch, "generate_conversation", record_prompts)
+
+    # the settings of the requests of each call type, which must not vary with the turn or conversation
+    request_settings = defaultdict(set)
+    num_logit_biases = defaultdict(int)
+
+    async def record_request(**kwargs) -> None:
+        request = kwargs["request"]
+        key = (kwargs["completion_type"], kwargs["call_type"])
+        if kwargs["call_type"] != CallType.END_CONVERSATION:
+            settings = {k: v for k, v in request.items() if k not in ("prompt", "messages", "logit_bias")}
+            request_settings[key].add(json.dumps(settings, sort_keys=True))
+        num_logit_biases[key] = max(num_logit_biases[key], len(request.get("logit_bias") or {}))
+
+    monkeypatch.setattr(Completion, "log_completion", staticmethod(record_request))
+
+    async def run() -> list[dict]:
+        config = StubConfig(latency_ms=5, latency_distribution="fixed", token_latency_ms=0, seed=0)
+        runner = await start_stub_server(config, port=unused_port)
+        try:
+            jobs = (ConversationJob(scenarios[i % len(scenarios)], i) for i in range(NUM_CONVERSATIONS))
+            async with managed_session():
+                return [result async for result in run_conversations(jobs, NUM_CONVERSATIONS)]
+        finally:
+            await runner.cleanup()
+
+    results = asyncio.run(asyncio.wait_for(run(), 120))
+
+    assert all(result["error"] is None for result in results)
+    assert len(conversation_prompts) == NUM_CONVERSATIONS
+    assert {(id(agent_prompt), id(user_prompt)) for agent_prompt, user_prompt in conversation_prompts} == {
+        (id(s.lesson_prompt), id(s.user_prompt)) for s in scenarios
+    }
+    for prompt, (text, settings) in zip(prompts, templates):
+        assert prompt.prompt == text, "a shared prompt was modified"
+        assert dict(prompt.settings) == settings, "the settings of a shared prompt were modified"
+    assert {completion_type for completion_type, _ in request_settings} == {"chat", "text"}
+    for key, settings in request_settings.items():
+        assert len(settings) == 1, f"{key} settings vary across turns or conversations: {settings}"
+    for key, num in num_logit_biases.items():
+        assert num <= MAX_LOGIT_BIASES, f"{key} logit biases accumulate"
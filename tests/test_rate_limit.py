@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import asyncio
+import multiprocessing
+
+import pytest
+
+from api import completion as completion_module
+from api.completion import Completion
+from api.rate_limit import get_rate_limiter
+from api.rate_limit import RateLimiter
+from api.rate_limit import set_shared_rate_limits
+from api.rate_limit import SharedRateLimits
+from api.retry import RetryPolicy
+from api.utils import Response
+from constants import OPENAI_MODEL_RATE_LIMITS
+
+MODEL = "gpt-4"
+
+
+@pytest.mark.parametrize(
+    "error_type, num_reserved",
+    [
+        # the request never reached the API
+        ("ClientConnectorError", 1000),
+        # the API most likely received the request and counted its tokens
+        ("TimeoutError", 2000),
+        ("ServerDisconnectedError", 2000),
+    ],
+)
+def test_tokens_are_only_refunded_for_attempts_that_fail_to_connect(monkeypatch, error_type, num_reserved):
+    responses = [
+        Response(-1, {}, {"error": {"type": error_type, "message": error_type}}),
+        Response(200, {}, {"choices": []}),
+    ]
+
+    async def post_request(url, data, headers, timeout):
+        return responses.pop(0)
+
+    monkeypatch.setattr(completion_module, "post_request", post_request)
+
+    async def request() -> tuple[float, float]:
+        rate_limiter = get_rate_limiter(MODEL)
+        capacity = rate_limiter.tokens.level
+        _, num_retries = await Completion._request_with_retries(  # pylint: disable=protected-access
+            "http://localhost",
+            {"model": MODEL},
+            {},
+            "activity",
+            "turn",
+            retry_policy=RetryPolicy(base_delay=0.0, max_delay=0.0),
+            num_tokens=1000,
+        )
+        assert num_retries == 1
+        return capacity, rate_limiter.tokens.level
+
+    capacity, level = asyncio.run(asyncio.wait_for(request(), timeout=10))
+    # the bucket refills slightly in between
+    assert capacity - num_reserved <= level < capacity - num_reserved + 10
+
+
+def consume_shared_budget(shared: SharedRateLimits, num_tokens: int) -> None:
+    async def acquire() -> None:
+        set_shared_rate_limits(shared)
+        await get_rate_limiter(MODEL).acquire(num_tokens)
+
+    asyncio.run(acquire())
+
+
+def test_rate_limit_budget_is_shared_between_processes():
+    context = multiprocessing.get_context("spawn")
+    shared = SharedRateLimits(context)
+    capacity = OPENAI_MODEL_RATE_LIMITS[MODEL]["tpm"]
+    process = context.Process(target=consume_shared_budget, args=(shared, capacity // 2))
+    process.start()
+    process.join(timeout=30)
+    assert process.exitcode == 0
+
+    async def acquire() -> float:
+        rate_limiter = RateLimiter(capacity, capacity, MODEL, shared)
+        await rate_limiter.acquire(1)
+        return rate_limiter.tokens.level
+
+    level = asyncio.run(asyncio.wait_for(acquire(), timeout=10))
+    # the budget used by the other process is gone, apart from what has been refilled since
+    assert capacity // 2 - 1 <= level < capacity * 0.6
@@ -0,0 +1,39 @@
+from __future__ import annotations
+
+from api.recording import Cassette
+from api.recording import CassetteMode
+
+URL = "https://api.openai.com/v1/chat/completions"
+REQUEST = {"model": "gpt-3.5-turbo", "messages": [{"role": "user", "content": "Hola"}]}
+
+
+def record_and_load(tmp_path, headers, response_data) -> Cassette:
+    path = str(tmp_path / "cassette.jsonl")
+    cassette = Cassette(path, CassetteMode.RECORD)
+    cassette.record(URL, REQUEST, 200, headers, response_data)
+    cassette.close()
+    return Cassette(path, CassetteMode.REPLAY)
+
+
+def test_replayed_headers_are_case_insensitive(tmp_path):
+    cassette = record_and_load(
+        tmp_path,
+        {"openai-processing-ms": "123", "retry-after": "2"},
+        {"choices": []},
+    )
+
+    status, headers, data = cassette.replay(URL, REQUEST)
+
+    assert status == 200
+    assert data == {"choices": []}
+    assert float(headers.get("Openai-Processing-Ms")) == 123
+    assert headers.get("Retry-After") == "2"
+
+
+def test_binary_responses_round_trip(tmp_path):
+    audio = bytes(range(256)) * 4  # not valid UTF-8
+    cassette = record_and_load(tmp_path, {"content-type": "audio/mpeg"}, audio)
+
+    _, _, data = cassette.replay(URL, REQUEST)
+
+    assert data == audio
@@ -0,0 +1,25 @@
+from __future__ import annotations
+
+import pytest
+
+from api.retry import RetryPolicy
+
+
+@pytest.mark.parametrize(
+    "headers, expected",
+    [
+        ({"retry-after-ms": "1500"}, 1.5),
+        ({"retry-after-ms": "soon", "Retry-After": "2"}, 2.0),
+        ({"retry-after-ms": "nan", "x-ratelimit-reset-tokens": "3s"}, 3.0),
+        ({"retry-after-ms": "-5", "Retry-After": "garbage", "x-ratelimit-reset-requests": "1m0s"}, 60.0),
+        ({"retry-after-ms": "garbage"}, None),
+    ],
+)
+def test_malformed_retry_headers_fall_back(headers, expected):
+    assert RetryPolicy.get_server_delay(headers) == expected
+
+
+def test_malformed_retry_after_ms_uses_computed_backoff():
+    policy = RetryPolicy(base_delay=1.0, max_delay=10.0)
+    delay = policy.get_delay(1.0, {"retry-after-ms": "garbage"})
+    assert 1.0 <= delay <= 3.0
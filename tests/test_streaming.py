@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from api.completion import ChatCompletion
+from api.completion import TextCompletion
+from api.metrics import reset_metrics_registry
+from api.stub_server import start_stub_server
+from api.stub_server import StubConfig
+from api.utils import managed_session
+from batch import Scenario
+from conversation.utils import stream_text_between_tags
+from generate_conversation import generate_conversation
+
+TIMEOUT = 30
+
+
+async def iter_chunks(chunks: list[str]):
+    for chunk in chunks:
+        yield chunk
+
+
+def stream(chunks: list[str], start_tag: str = "Agent:", end_tag: str = "\n") -> list[str]:
+    async def collect() -> list[str]:
+        return [text async for text in stream_text_between_tags(iter_chunks(chunks), start_tag, end_tag)]
+
+    return asyncio.run(collect())
+
+
+@pytest.mark.parametrize(
+    "chunks",
+    [
+        ["Thought: greet\nAgent: ¡Hola! ¿Qué", " desea?\nEnd: False"],
+        ["Thought: greet\nAg", "ent: ¡Hola! ¿Qué desea?\nEnd: False"],
+        ["Thought: greet\nAgent", ":", " ¡Hola! ¿Qué desea?\nEnd: False"],
+        ["Thought: greet\nAgent: ¡Hola! ¿Qué desea?", "\nEnd: False"],
+        list("Thought: greet\nAgent: ¡Hola! ¿Qué desea?\nEnd: False"),
+    ],
+)
+def test_tags_split_across_chunks(chunks):
+    assert "".join(stream(chunks)) == "¡Hola! ¿Qué desea?"
+
+
+def test_partial_end_tag_is_held_back_until_it_is_ruled_out():
+    chunks = ["<a>¡Hola! <", "b> ¿Qué desea?</", "a> ignored"]
+    assert stream(chunks, start_tag="<a>", end_tag="</a>") == ["¡Hola! ", "<b> ¿Qué desea?"]
+
+
+def test_text_is_yielded_before_the_end_tag_arrives():
+    texts = stream(["Agent: ¡Hola!", " ¿Qué", " desea?\n"])
+    assert texts == ["¡Hola!", " ¿Qué", " desea?"]
+
+
+@pytest.mark.parametrize(
+    "chunks, expected",
+    [
+        (["Thought: greet\nAgent: ¡Hola!", " ¿Qué desea?"], "¡Hola! ¿Qué desea?"),
+        (["Agent: ¡Hola! ¿Qué desea?", "\r"], "¡Hola! ¿Qué desea?\r"),
+        (["Agent:   "], ""),
+        (["Thought: greet\nAge"], ""),
+    ],
+)
+def test_stream_ends_without_end_tag(chunks, expected):
+    assert "".join(stream(chunks)) == expected
+
+
+@pytest.fixture
+def stub_api(monkeypatch, tiktoken_encodings, unused_port):
+    """Point completions at a local stub server"""
+    port = unused_port
+    monkeypatch.setattr(TextCompletion, "api_url", f"http://localhost:{port}/v1/completions")
+    monkeypatch.setattr(ChatCompletion, "api_url", f"http://localhost:{port}/v1/chat/completions")
+    return StubConfig(latency_ms=0, latency_distribution="fixed", token_latency_ms=0, seed=0), port
+
+
+def test_conversation_streams_agent_text(stub_api):
+    config, port = stub_api
+    registry = reset_metrics_registry()
+    streamed = {}
+
+    def on_agent_text(turn_id: str, text: str) -> None:
+        streamed[turn_id] = streamed.get(turn_id, "") + text
+
+    scenario = Scenario.from_json({"scenarioId": "cafe"}, "1")
+
+    async def run() -> str:
+        runner = await start_stub_server(config, port=port)
+        try:
+            async with managed_session():
+                return await generate_conversation(
+                    scenario.lesson_prompt,
+                    scenario.user_prompt,
+                    scenario.initial_dialogue_tags,
+                    on_agent_text=on_agent_text,
+                )
+        finally:
+            await runner.cleanup()
+
+    conversation = asyncio.run(asyncio.wait_for(run(), TIMEOUT))
+    assert streamed
+    for text in streamed.values():
+        assert f"{scenario.lesson_prompt.agent_label}: {text}\n" in conversation + "\n"
+    time_to_first_text = registry.histogram(
+        "agent_time_to_first_text_ms", "", ["regenerated"]
+    ).get(regenerated="false")
+    assert time_to_first_text.count == len(streamed)
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+
+import pytest
+
+from conversation.tag_parser import TagParser
+
+TAGS = ["Thought", "Agent"]
+
+
+def reference_parse_tags(completion, tags):
+    """The original split-based `Completion.parse_tags_from_completion`, without logging"""
+    text = completion
+    parsed_tags = OrderedDict()
+    prev_tag = "dummy_tag"
+
+    for tag in tags:
+        try:
+            prev_tag_value, text = text.split(tag + ":")
+            parsed_tags[prev_tag] = prev_tag_value.strip()
+            prev_tag = tag
+        except ValueError:
+            break
+
+    parsed_tags[prev_tag] = text.strip()
+    parsed_tags.pop("dummy_tag")
+
+    return parsed_tags
+
+
+def reference_get_parsed_tags(completion, tags, format=None):
+    """The original `Completion.get_parsed_tags`, stripping code fences with `str.replace`"""
+    if format:
+        completion = completion.replace(f"```{format}", "").replace("```", "").strip()
+    return reference_parse_tags(completion, tags)
+
+
+@pytest.mark.parametrize(
+    "completion",
+    [
+        "```yaml\nThought: greet\nAgent: hi\n```",
+        "```yaml\nThought: greet\nAgent: hi",
+        "```yaml Thought: greet Agent: hi```",
+        "```yamlThought: greet\nAgent: hi```",
+        "Thought: greet\nAgent: hi\n```",
+        "Thought: greet\nAgent: hi",
+    ],
+)
+def test_fenced_completion_matches_reference(completion):
+    extracted = TagParser.extract_fenced(completion, "yaml")
+    assert "```" not in extracted
+    assert TagParser.for_tags(tuple(TAGS)).parse(extracted) == reference_get_parsed_tags(completion, TAGS, "yaml")
+
+
+def test_fenced_blocks_are_joined():
+    completion = "Sure!\n```yaml\nThought: greet\n```\nand\n```\nAgent: hi\n```"
+    assert TagParser.extract_fenced(completion, "yaml") == "Thought: greet\n\n\nAgent: hi"
+
+
+@pytest.mark.parametrize(
+    "completion",
+    [
+        "Thought: greet\nAgent: hi",
+        "Thought: greet\nAgent: hi\nAgent: bye",
+        "Thought: greet\nThought: again\nAgent: hi",
+        "Agent: hi\nThought: greet",
+        "no tags at all",
+    ],
+)
+def test_parse_matches_reference(completion):
+    assert TagParser.for_tags(tuple(TAGS)).parse(completion) == reference_parse_tags(completion, TAGS)
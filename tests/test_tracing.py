@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from api import completion as completion_module
+from api.completion import ChatCompletion
+from api.completion import TextCompletion
+from api.retry import RetryPolicy
+from api.stub_server import start_stub_server
+from api.stub_server import StubConfig
+from api.tracing import InMemorySpanExporter
+from api.tracing import Tracer
+from api.utils import Response
+from batch import batch_session
+from batch import ConversationJob
+from batch import run_job
+from batch import Scenario
+
+TIMEOUT = 30
+
+
+@pytest.fixture
+def stub_api(monkeypatch, tiktoken_encodings, unused_port):
+    """Point completions at a local stub server, failing the first request with a retryable server error"""
+    port = unused_port
+    monkeypatch.setattr(TextCompletion, "api_url", f"http://localhost:{port}/v1/completions")
+    monkeypatch.setattr(ChatCompletion, "api_url", f"http://localhost:{port}/v1/chat/completions")
+    monkeypatch.setattr(RetryPolicy, "get_backoff", lambda self, prev_delay: 0.0)
+
+    post_request = completion_module.post_request
+    num_requests = 0
+
+    async def flaky_post_request(*args, **kwargs):
+        nonlocal num_requests
+        num_requests += 1
+        if num_requests == 1:
+            return Response(500, {}, {"error": {"type": "server_error", "message": "Internal error"}})
+        return await post_request(*args, **kwargs)
+
+    monkeypatch.setattr(completion_module, "post_request", flaky_post_request)
+    return StubConfig(latency_ms=0, latency_distribution="fixed", token_latency_ms=0, seed=0), port
+
+
+def test_conversation_span_tree(stub_api):
+    config, port = stub_api
+    exporter = InMemorySpanExporter()
+
+    async def run() -> dict:
+        runner = await start_stub_server(config, port=port)
+        try:
+            async with batch_session(tracer=Tracer([exporter])):
+                return await run_job(ConversationJob(Scenario.from_json({"scenarioId": "cafe"}, "1"), 0))
+        finally:
+            await runner.cleanup()
+
+    result = asyncio.run(asyncio.wait_for(run(), TIMEOUT))
+    assert result["error"] is None
+
+    spans = exporter.get_finished_spans()
+    spans_by_id = {s.span_id: s for s in spans}
+
+    def get_ancestors(s) -> list:
+        """The span and its ancestors, from the root down"""
+        ancestors = [s]
+        while ancestors[0].parent_span_id is not None:
+            ancestors.insert(0, spans_by_id[ancestors[0].parent_span_id])
+        return ancestors
+
+    (conversation,) = [s for s in spans if s.parent_span_id is None]
+    assert conversation.name == "conversation"
+    assert conversation.attributes["scenarioId"] == "cafe"
+    activity_id = conversation.attributes["activityId"]
+
+    requests = [s for s in spans if s.name == "http.request"]
+    assert requests
+    for request in requests:
+        ancestors = get_ancestors(request)
+        names = [s.name for s in ancestors]
+        assert names[:2] == ["conversation", "turn"]
+        assert names[2] in ("step.user", "step.agent")
+        assert names[-2:] == ["completion", "http.request"]
+        step, completion = ancestors[2], ancestors[-2]
+        assert step.attributes["activityId"] == completion.attributes["activityId"] == activity_id
+        assert step.attributes["turnId"] == completion.attributes["turnId"]
+
+    steps = [s for s in spans if s.name.startswith("step.")]
+    assert len({s.attributes["turnId"] for s in steps}) == len(steps)
+
+    # the first request failed and was retried within the same completion span
+    first_completion = spans_by_id[requests[0].parent_span_id]
+    attempts = [s for s in requests if s.parent_span_id == first_completion.span_id]
+    assert [(s.attributes["attempt"], s.attributes["status"]) for s in attempts] == [(1, 500), (2, 200)]
+    assert any(s.name == "retry.sleep" and s.parent_span_id == first_completion.span_id for s in spans)
+
+    otlp_spans = exporter.to_otlp()["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    assert len(otlp_spans) == len(spans)
+    assert {s["traceId"] for s in otlp_spans} == {f"{conversation.trace_id:032x}"}